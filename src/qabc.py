@@ -1,19 +1,49 @@
 #!/usr/bin/python3
 
+import bisect
+import difflib
+import fnmatch
 import os
 import gettext
-import subprocess
+import json
+import queue
+import re
+import shlex
+import shutil
+import sys
+import tempfile
+import time
 import uuid
-
-from PyQt5.QtCore import (QFile,
+import zlib
+from array import array
+
+START_TIME = time.perf_counter()  # Reference for time to first paint
+
+from PyQt5.QtCore import (pyqtSignal,
+                          QAbstractTableModel,
+                          QEvent,
+                          QFile,
+                          QFileSystemWatcher,
+                          QMimeData,
+                          QModelIndex,
+                          QObject,
                           QRegExp,
                           QSettings,
                           QSize,
                           QSortFilterProxyModel,
+                          QStandardPaths,
                           Qt,
+                          QThread,
+                          QTimer,
                           QT_VERSION_STR,
                           QUrl)
-from PyQt5.QtGui import QFont, QIcon, QKeySequence, QStandardItemModel
+from PyQt5.QtGui import (QColor,
+                         QFont,
+                         QIcon,
+                         QKeySequence,
+                         QSyntaxHighlighter,
+                         QTextBlockUserData,
+                         QTextCharFormat)
 from PyQt5.QtWidgets import (QAbstractItemView,
                              QAction,
                              QApplication,
@@ -23,8 +53,11 @@ from PyQt5.QtWidgets import (QAbstractItemView,
                              QFileDialog,
                              QGridLayout,
                              QHBoxLayout,
+                             QInputDialog,
                              QLabel,
                              QLineEdit,
+                             QListWidget,
+                             QListWidgetItem,
                              QMainWindow,
                              QMessageBox,
                              QPushButton,
@@ -33,12 +66,29 @@ from PyQt5.QtWidgets import (QAbstractItemView,
                              QSlider,
                              QSpinBox,
                              QTableView,
+                             QTableWidget,
+                             QTableWidgetItem,
                              QTabWidget,
                              QTextEdit,
+                             QTreeWidget,
+                             QTreeWidgetItem,
                              QVBoxLayout,
                              QWidget)
-from PyQt5.QtSvg import QSvgWidget
-from PyQt5.QtMultimedia import QMediaContent, QMediaPlayer, QMediaPlaylist
+# QtSvg, QtMultimedia, concurrent.futures and multiprocessing are imported
+# on first use to speed up startup.
+
+# The core module is installed with the shared data, out of the PATH
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             os.pardir, 'share', 'qabc'))
+from qabccore import (AbcLinter,
+                      RenderCache,
+                      RenderService,
+                      Tune,
+                      TuneBook,
+                      TuneFeatures,
+                      TuneStatistics,
+                      lintSummary,
+                      lintSummaries)
 
 PROGRAM_NAME = "Qabc"
 EXECUTABLE_NAME = "qabc"
@@ -53,6 +103,8 @@ MAIL = "mdomlop@gmail.com"
 SOURCE = "https://github.com/mdomlop/qabc"
 LICENSE = "GPLv3+"  # Read LICENSE file.
 
+STARTUP_TARGET = 300  # Milliseconds to first paint of the main window
+
 COPYRIGHT = '''
 Copyright: 2017 Manuel Domínguez López <mdomlop@gmail.com>
 License: GPL-3.0+
@@ -75,158 +127,710 @@ License: GPL-3.0+
 '''
 
 
-class TuneBook():
-    def __init__(self):
-        self.tunes = []
-        self.index = 0
-        self.path = None
-
-    def loadFile(self, path):
-        ''' Adds a tune file to the tunes DB '''
-        if not path:
-            return(0)
-        if not os.path.isfile(path):
-            return(1)
+class JournalWriter(QThread):
+    ''' Writes to the journal file in background, so edits never wait
+    for the disk. Tasks are (action, lines) tuples. '''
 
+    def __init__(self, path, parent=None):
+        super(JournalWriter, self).__init__(parent)
         self.path = path
-        self.tunes = []  # Database containing all tunes
-        self.tunesSaved = []
+        self.queue = queue.Queue()
+
+    def run(self):
+        while True:
+            task = self.queue.get()
+            if task is None:
+                break
+            action, lines = task
+            try:
+                if action == 'append':
+                    with open(self.path, "a") as f:
+                        f.write(''.join(lines))
+                        f.flush()
+                        os.fsync(f.fileno())
+                elif action == 'compact':  # Replaced at once, never half
+                    with open(self.path + '.tmp', "w") as f:
+                        f.write(''.join(lines))
+                        f.flush()
+                        os.fsync(f.fileno())
+                    os.replace(self.path + '.tmp', self.path)
+                elif action == 'clear' and os.path.exists(self.path):
+                    os.remove(self.path)
+            except OSError:
+                print("I can't write the journal file")
+
+
+class TuneJournal():
+    ''' Append only journal of the unsaved edits of tunes, to recover them
+    after a crash. Every line is a JSON object with the position of the
+    tune, the CRC of its text in the tunebook and the edited text. '''
+
+    COMPACT = 200  # Lines written before rewriting only the last ones
 
+    def __init__(self):
+        self.writer = None
+        self.pending = {}  # Edits not written yet, by position
+        self.latest = {}  # Last edit written, by position
+        self.lines = 0  # Lines in the journal file
+
+    @staticmethod
+    def journalPath(bookPath):
+        folder = os.path.join(QStandardPaths.writableLocation(
+            QStandardPaths.GenericDataLocation), EXECUTABLE_NAME, 'journal')
+        os.makedirs(folder, exist_ok=True)
+        name = '%08x' % zlib.crc32(os.path.abspath(bookPath).encode())
+        return(os.path.join(folder, name + '.journal'))
+
+    @staticmethod
+    def crc(text):
+        return(zlib.crc32(text.encode()))
+
+    def open(self, bookPath):
+        self.close()
+        self.pending = {}
+        self.latest = {}
+        self.lines = 0
+        self.writer = JournalWriter(self.journalPath(bookPath))
+        self.writer.start()
+
+    def read(self):
+        ''' Last (crc, text) of every tune found in the journal '''
+        entries = {}
         try:
-            with open(self.path, "r") as f:
-                text = f.read()
-        except:
-            text = None
+            with open(self.writer.path, "r") as f:
+                for line in f:
+                    try:
+                        e = json.loads(line)
+                        entries[e['i']] = (e['h'], e['t'])
+                    except (ValueError, KeyError):
+                        pass  # Line cut by a crash
+        except OSError:
+            pass
+        return(entries)
+
+    def note(self, pos, original, text):
+        ''' Remembers an edit. It is written on next flush(). '''
+        if self.writer:
+            self.pending[pos] = (self.crc(original), text)
+
+    def flush(self):
+        if not self.writer or not self.pending:
+            return
+        self.latest.update(self.pending)
+        self.lines += len(self.pending)
+        if self.lines > self.COMPACT:
+            self.lines = len(self.latest)
+            self.writer.queue.put(('compact', self.dump(self.latest)))
+        else:
+            self.writer.queue.put(('append', self.dump(self.pending)))
+        self.pending = {}
+
+    @staticmethod
+    def dump(entries):
+        return([json.dumps({'i': pos, 'h': h, 't': t}) + '\n'
+                for pos, (h, t) in entries.items()])
+
+    def clear(self):
+        if self.writer:
+            self.pending = {}
+            self.latest = {}
+            self.lines = 0
+            self.writer.queue.put(('clear', None))
+
+    def close(self):
+        if self.writer:
+            self.flush()
+            self.writer.queue.put(None)
+            self.writer.wait()
+            self.writer = None
+
+
+class TuneBookLinter(QThread):
+    ''' Lints many tunes in a pool of worker processes '''
+
+    checked = pyqtSignal(list)  # (row, text, (errors, warnings))
+    BATCH = 500  # Results sent to the interface at once
+    CHUNK = 100  # Tunes linted by a worker at once
+
+    def __init__(self, tunes, parent=None):
+        super(TuneBookLinter, self).__init__(parent)
+        self.tunes = tunes  # (row, text)
+
+    def run(self):
+        import concurrent.futures
+        import multiprocessing
+        context = multiprocessing.get_context('spawn')
+        texts = [text for row, text in self.tunes]
+        aux = []
+        with concurrent.futures.ProcessPoolExecutor(
+                mp_context=context) as pool:
+            jobs = [pool.submit(lintSummaries, texts[n:n + self.CHUNK])
+                    for n in range(0, len(texts), self.CHUNK)]
+            tunes = iter(self.tunes)
+            for job in jobs:
+                if self.isInterruptionRequested():
+                    for job in jobs:
+                        job.cancel()  # Only running jobs are waited for
+                    return
+                for summary, (row, text) in zip(job.result(), tunes):
+                    aux.append((row, text, summary))
+                    if len(aux) == self.BATCH:
+                        self.checked.emit(aux)
+                        aux = []
+        if aux:
+            self.checked.emit(aux)
 
-        f.close()
 
-        if text:
-            aux = []
-            for line in text.split('\n'):
-                if line.startswith('X:'):
-                    if aux:
-                        self.tunes.append('\n'.join(aux))
-                        aux = []
-                if line:
-                    aux.append(line)
+class TuneBookLoader(QThread):
+    ''' Reads a tunebook file in background and sends its tunes by batches '''
 
-            self.tunes.append('\n'.join(aux))  # Add last
-            self.ntunes = len(self.tunes)
-            # list.copy() is like list[:]
-            self.backup = self.tunes.copy()  # Backup tunebook for restore().
+    tunesLoaded = pyqtSignal(list, list)  # Tunes and their headers
+    BATCH = 200  # Tunes sent to the interface at once
 
-    def save(self, text):
-        self.tunes[self.index] = text
+    def __init__(self, path, parent=None):
+        super(TuneBookLoader, self).__init__(parent)
+        self.path = path
 
+    def run(self):
+        aux = []
+        headers = []
         try:
-            with open(self.path, "w") as f:
-                for i in self.tunes:
-                    f.write(i + '\n')
+            with open(self.path, "r") as f:
+                for tune in TuneBook.split(f):
+                    if self.isInterruptionRequested():
+                        return
+                    aux.append(tune)
+                    headers.append(TuneBook.headers(tune))
+                    if len(aux) == self.BATCH:
+                        self.tunesLoaded.emit(aux, headers)
+                        aux = []
+                        headers = []
         except:
-            print("I can't save the tunebook file")
+            print("I can't read the tunebook file")
+        if aux:
+            self.tunesLoaded.emit(aux, headers)
+
+
+class RenderPool(QObject):
+    ''' Renders in a pool of threads shared by all the tunebooks, keeping
+    the results in a RenderCache. Results are (data, messages) tuples,
+    given to callbacks in the interface thread. '''
+
+    done = pyqtSignal(object, object, object)  # Key, future and size()
+    WORKERS = 2
+
+    def __init__(self, render, cache, parent=None):
+        super(RenderPool, self).__init__(parent)
+        self.render = render
+        self.cache = cache
+        import concurrent.futures
+        self.executor = concurrent.futures.ThreadPoolExecutor(self.WORKERS)
+        self.waiting = {}  # Callbacks of the renders running, by key
+        self.done.connect(self.deliver)
+
+    def svg(self, text, callback):
+        ''' Calls callback with the text, the SVG and the messages '''
+        self.submit(RenderCache.key('svg', text),
+                    lambda: self.render.svg(text),
+                    lambda svg, messages: callback(text, svg, messages))
+
+    def midi(self, text, folder, tempo, semitones, callback):
+        ''' Calls callback with the path of a MIDI file of folder and the
+        messages '''
+        self.submit(RenderCache.key('midi', text, tempo, semitones),
+                    lambda: self.render.midiFile(text, folder, tempo,
+                                                 semitones),
+                    callback, os.path.getsize)
+
+    def submit(self, key, function, callback, size=len):
+        ''' Renders with function unless the result is cached or being
+        rendered. size gives the bytes kept by the cache for the data of
+        a result. '''
+        result = self.cache.get(key)
+        if result is not None:
+            callback(*result)
+        elif key in self.waiting:  # Same render already asked
+            self.waiting[key].append(callback)
+        else:
+            self.waiting[key] = [callback]
+            future = self.executor.submit(function)
+            future.add_done_callback(lambda f: self.done.emit(key, f, size))
+
+    def deliver(self, key, future, size):
+        ''' Gives the result to the callbacks waiting for it, or None and
+        the error of a failed render. Failed renders are not kept, so they
+        are tried again. '''
+        try:
+            result = future.result()
+            if result[0]:
+                self.cache.put(key, result, size(result[0]) + len(result[1]))
+        except Exception as e:  # Of any engine
+            result = (None, _("I can't render the tune: ") + str(e))
+        finally:
+            callbacks = self.waiting.pop(key, ())
+        for callback in callbacks:
+            callback(*result)
 
-        f.close()
-        self.tunesSaved[self.index] = self.tunes[self.index]
+    def shutdown(self):
+        self.done.disconnect()
+        self.executor.shutdown(wait=True)
 
-    def reindex(self):
-        n = 0
-        for i in self.tunes:
-            tune = Tune()
-            tune.load(i)
-            tune.setField('X:', n + 1)
-            self.tunes[n] = tune.text
-            n += 1
 
-    def sort(self):
-        aux = []
-        aux2 = []
-        n = 0
-        for i in self.tunes:
-            tune = Tune()
-            tune.load(i)
-            aux.append((tune.getField('T'), n))
-            n += 1
-        # Sorting array by first member (Title):
-        aux = sorted(aux, key=lambda t: t[0])
-        for i in aux:
-            aux2.append(self.tunes[i[1]])
-        self.tunes = aux2.copy()
+class FeatureIndexer(QObject):
+    ''' Computes the similarity vectors of tunebooks in a background
+    thread, a chunk at a time, so related tunes are shown while it works '''
 
-    def restore(self):
-        self.tunes = self.backup.copy()
+    done = pyqtSignal(object, object, object)  # Table, job and future
+    indexed = pyqtSignal(object)  # Table with new vectors
+    CHUNK = 2000  # Tunes by job
 
-    def add(self, tune):  # To the last
-        self.tunes.append(tune)
-        self.ntunes += 1
+    def __init__(self, parent=None):
+        super(FeatureIndexer, self).__init__(parent)
+        import concurrent.futures
+        self.executor = concurrent.futures.ThreadPoolExecutor(1)
+        self.running = {}  # Job of the tables being indexed
+        self.done.connect(self.deliver)
+
+    def index(self, table):
+        ''' Computes the vectors missing in the tunebook of a table '''
+        if table in self.running or table.loader:
+            return(0)
+        refs = table.features.missing(table.book.tunes)[:self.CHUNK]
+        if not len(refs):
+            return(0)
+        snapshot = table.book.snapshot()
+        future = self.executor.submit(TuneFeatures.compute, snapshot, refs)
+        self.running[table] = future
+        future.add_done_callback(
+            lambda f: self.done.emit(table, (snapshot, refs), f))
+
+    def deliver(self, table, job, future):
+        ''' Keeps the vectors of a job and starts the next one. Tunes of
+        a failed job are left without vector. '''
+        self.running.pop(table, None)
+        try:
+            matrix = future.result()
+        except Exception as e:
+            print("I can't compute the similarity of the tunes: " + str(e))
+            return(0)
+        if table.features.store(*job, matrix):
+            self.indexed.emit(table)
+            self.index(table)
+
+    def shutdown(self):
+        self.done.disconnect()
+        for future in self.running.values():
+            future.cancel()  # Only the running job is waited for
+        self.executor.shutdown(wait=True)
+
+
+class HeaderColumn():
+    ''' Values of a header field for every tune, stored as codes of a
+    table of distinct values, so values repeated in many tunes, like
+    "reel", "6/8" or "Dmaj", are kept once '''
+
+    def __init__(self, values=()):
+        self.values = []  # Distinct values by code
+        self.codes = {}  # Code of every value
+        self.rows = array('i')  # Code of every row
+        self.extend(values)
+
+    def code(self, value):
+        code = self.codes.get(value)
+        if code is None:
+            code = len(self.values)
+            self.values.append(value)
+            self.codes[value] = code
+        return(code)
+
+    def extend(self, values):
+        self.rows.extend(map(self.code, values))
+
+    def __len__(self):
+        return(len(self.rows))
+
+    def __getitem__(self, n):
+        if isinstance(n, slice):
+            return([self.values[code] for code in self.rows[n]])
+        return(self.values[self.rows[n]])
+
+    def __setitem__(self, n, value):
+        if isinstance(n, slice):
+            self.rows[n] = array('i', map(self.code, value))
+        else:
+            self.rows[n] = self.code(value)
 
-    def insert(self, pos, tune):  # At the position + 1
-        self.tunes.insert(pos, tune)
-        self.ntunes += 1
+    def __delitem__(self, n):
+        del self.rows[n]
 
-    def remove(self, pos):
-        self.tunes.pop(pos)
-        self.ntunes -= 1
+    def snapshot(self):
+        ''' Copy of the column for other threads, as rows may be added,
+        changed or removed meanwhile '''
+        column = HeaderColumn()
+        column.values = list(self.values)
+        column.rows = array('i', self.rows)
+        return(column)
 
+    def size(self):
+        ''' Bytes used by the column '''
+        return(sys.getsizeof(self.values) + sys.getsizeof(self.codes)
+               + sys.getsizeof(self.rows)
+               + sum(sys.getsizeof(i) for i in self.values))
 
-class Tune():
-    def __init__(self):
-        self.load()
+    def memory(self):
+        ''' Bytes used by the column and bytes the same values would use
+        as a list of strings '''
+        used = self.size()
+        plain = sys.getsizeof([None] * len(self)) \
+            + sum(sys.getsizeof(self.values[i]) for i in self.rows)
+        return(used, plain)
 
-    def load(self, text=None):
-        if text:
-            self.text = text
-        else:
-            self.text = ''
-        self.original = tuneBook.tunes[tuneBook.index]
 
-    def hasField(self, key):
-        for i in self.text.split('\n'):
-            if i.startswith(key):
-                return(True)
-        return(False)
+class TuneTableModel(QAbstractTableModel):
+    ''' Tune headers stored by columns and given to the view by chunks '''
 
-    def getField(self, key):
-        sep = ':'
-        comment = '%'
-        for i in self.text.split('\n'):
-            if i.startswith(key):
-                v = i.split(sep)[1]
-                if comment in v:
-                    v = v.split(comment)[0]
-                return(v.strip())
-        return('')
-
-    def setField(self, key, value):
-        lines = []
-
-        if value == 'Default':
+    X, T, R, M, K, V = range(6)  # Column indices
+    CHUNK = 100  # Rows added to the view by every fetchMore()
+    MIME = 'application/x-qabc-tunes'  # Dragged tunes
+
+    def __init__(self, parent=None):
+        super(TuneTableModel, self).__init__(parent)
+        self.titles = (_("Index"), _("Title"), _("Rhythm"), _("Meter"),
+                       _("Key"), _("Check"))
+        self.columns = tuple(HeaderColumn() for i in range(4))  # T, R, M, K
+        self.problems = []  # (errors, warnings) or None if not checked
+        self.summaries = {}  # Every different (errors, warnings) once
+        # Sorted arrays of rows by normalized value of R:, M: and K:
+        self.valueRows = {self.R: {}, self.M: {}, self.K: {}}
+        self.shown = 0  # Rows already known by the view
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
             return(0)
+        return(self.shown)
 
-        if self.hasField(key):
-            for l in self.text.split('\n'):
-                if l.startswith(key):
-                    l = key + str(value)
-                lines.append(l)
-        else:
-            for l in self.text.split('\n'):
-                if l.startswith('X:'):
-                    lines.append(l)
-                    l = key + str(value)  # Insert value line
-                    lines.append(l)
+    def columnCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return(0)
+        return(len(self.titles))
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return(None)
+        if index.column() == self.V:
+            return(self.problemsData(self.problems[index.row()], role))
+        if role != Qt.DisplayRole:
+            return(None)
+        if index.column() == self.X:
+            return(index.row())
+        return(self.columns[index.column() - 1][index.row()])
+
+    def problemsData(self, problems, role):
+        if problems is None:
+            return(None)
+        errors, warnings = problems
+        if role == Qt.DisplayRole:
+            if errors:
+                return(str(errors) + " " + _("errors"))
+            if warnings:
+                return(str(warnings) + " " + _("warnings"))
+            return(_("OK"))
+        if role == Qt.ForegroundRole:
+            if errors:
+                return(QColor('red'))
+            if warnings:
+                return(QColor('darkorange'))
+        return(None)
+
+    def setProblems(self, results):
+        ''' Stores (row, (errors, warnings)) results of the linter '''
+        rows = []
+        for row, problems in results:
+            if row < len(self.problems):
+                problems = self.summaries.setdefault(problems, problems)
+                self.problems[row] = problems
+                rows.append(row)
+        if rows:
+            self.dataChanged.emit(self.index(min(rows), self.V),
+                                  self.index(max(rows), self.V))
+
+    def flags(self, index):
+        flags = super(TuneTableModel, self).flags(index)
+        if index.isValid():
+            flags |= Qt.ItemIsDragEnabled
+        return(flags)
+
+    def supportedDragActions(self):
+        return(Qt.CopyAction | Qt.MoveAction)
+
+    def mimeTypes(self):
+        return([self.MIME])
+
+    def mimeData(self, indexes):
+        ''' Positions of the dragged tunes '''
+        rows = sorted(set(i.row() for i in indexes))
+        data = QMimeData()
+        data.setData(self.MIME, ','.join(map(str, rows)).encode())
+        return(data)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return(self.titles[section])
+        return(None)
+
+    @staticmethod
+    def normalize(column, value):
+        ''' Spelling used to index and query a header value '''
+        return(TuneBook.normalize(
+            'K:' if column == TuneTableModel.K else None, value))
+
+    def appendHeaders(self, headers):
+        ''' Stores headers of new tunes. They will reach the view with
+        fetchMore(), or at once if the view has not rows enough yet '''
+        row = len(self.columns[0])
+        for column, values in zip(self.columns, zip(*headers)):
+            column.extend(values)
+        self.problems.extend([None] * len(headers))
+        self.indexRows(range(row, len(self.columns[0])))
+        if self.shown < self.CHUNK:
+            self.fetchMore(QModelIndex())
+
+    def indexRows(self, rows):
+        ''' Adds rows to valueRows. Rows after the last indexed one are
+        appended, others are inserted in order. '''
+        for col, index in self.valueRows.items():
+            values = self.columns[col - 1]
+            for n in rows:
+                key = self.normalize(col, values[n])
+                if key not in index:
+                    index[key] = array('i')
+                if index[key] and index[key][-1] > n:
+                    bisect.insort(index[key], n)
                 else:
-                    lines.append(l)
-
-        self.text = '\n'.join(lines)
-
-    def transpose(self, semitones):
-        buff = self.original.encode()
-        t = subprocess.run(
-            ('abc2abc', '-', '-t', str(semitones)),
-            input=buff, stdout=subprocess.PIPE)
-        self.text = t.stdout.decode()
+                    index[key].append(n)
+
+    def unindexRows(self, rows):
+        for col, index in self.valueRows.items():
+            values = self.columns[col - 1]
+            for n in rows:
+                index[self.normalize(col, values[n])].remove(n)
+
+    def spliceHeaders(self, start, end, headers):
+        ''' Replaces the rows from start to end by the given headers '''
+        common = min(end - start, len(headers))
+        self.unindexRows(range(start, start + common))
+        for n in range(common):
+            for column, value in zip(self.columns, headers[n]):
+                column[start + n] = value
+            self.problems[start + n] = None
+        self.indexRows(range(start, start + common))
+        if common and start < self.shown:
+            self.dataChanged.emit(
+                self.index(start, 0),
+                self.index(min(start + common, self.shown) - 1, self.V))
+
+        pos = start + common
+        if len(headers) > common:
+            extra = headers[common:]
+            visible = pos <= self.shown
+            if visible:
+                self.beginInsertRows(QModelIndex(), pos, pos + len(extra) - 1)
+            for column, values in zip(self.columns, zip(*extra)):
+                column[pos:pos] = values
+            self.problems[pos:pos] = [None] * len(extra)
+            if visible:
+                self.shown += len(extra)
+                self.endInsertRows()
+        elif end > pos:
+            stop = min(end, self.shown)
+            if pos < stop:
+                self.beginRemoveRows(QModelIndex(), pos, stop - 1)
+            for column in self.columns:
+                del column[pos:end]
+            del self.problems[pos:end]
+            if pos < stop:
+                self.shown -= stop - pos
+                self.endRemoveRows()
+        else:
+            return
+
+        # Rows were shifted: rebuild the index and renumber the X column
+        for index in self.valueRows.values():
+            index.clear()
+        self.indexRows(range(len(self.columns[0])))
+        if pos < self.shown:
+            self.dataChanged.emit(self.index(pos, self.X),
+                                  self.index(self.shown - 1, self.X))
+
+    def canFetchMore(self, parent):
+        if parent.isValid():
+            return(False)
+        return(self.shown < len(self.columns[0]))
+
+    def fetchMore(self, parent):
+        if parent.isValid():
+            return
+        n = min(self.CHUNK, len(self.columns[0]) - self.shown)
+        if n > 0:
+            self.beginInsertRows(QModelIndex(), self.shown, self.shown + n - 1)
+            self.shown += n
+            self.endInsertRows()
+
+
+class AbcBlockData(QTextBlockUserData):
+    ''' Tokens of a line of abc code kept by AbcHighlighter '''
+
+    def __init__(self, key, fields, bars, problems):
+        super(AbcBlockData, self).__init__()
+        self.key = key  # Key of a field line, like 'T:', or None
+        self.fields = fields  # (key, value) of field lines, like ('T:', ...)
+        self.bars = bars  # Bars ended in this line
+        self.problems = problems  # Found by AbcLinter.lintLine()
+
+
+class AbcHighlighter(QSyntaxHighlighter):
+    ''' Highlights abc code. Qt only calls highlightBlock() for the lines
+    changed by an edit (and the next ones if their state changes), so the
+    token index kept in the block data is updated incrementally. Block
+    states number the AbcLinter contexts, so lines are also linted
+    incrementally. Tokens are those of AbcLinter, only some of them
+    with a format. '''
+
+    def __init__(self, document):
+        super(AbcHighlighter, self).__init__(document)
+        self.generation = 0  # Incremented on every highlighted line
+        self.cache = {}
+        self.linter = AbcLinter()
+        self.contexts = [AbcLinter.START]  # Indexed by block state
+        self.states = {AbcLinter.START: 0}
+
+        self.formats = {}
+        for name, color, bold, italic in (('key', 'darkblue', True, False),
+                                          ('field', 'darkblue', False, False),
+                                          ('comment', 'gray', False, True),
+                                          ('chord', 'darkgreen', False, False),
+                                          ('deco', 'purple', False, False),
+                                          ('inline', 'darkblue', False, False),
+                                          ('bar', 'darkred', True, False),
+                                          ('grace', 'darkcyan', False, False)):
+            f = QTextCharFormat()
+            f.setForeground(QColor(color))
+            if bold:
+                f.setFontWeight(QFont.Bold)
+            f.setFontItalic(italic)
+            self.formats[name] = f
+
+    @staticmethod
+    def fieldValue(line):
+        ''' Value of a field line, with the rules of Tune.getField() '''
+        v = line.split(':')[1]
+        if '%' in v:
+            v = v.split('%')[0]
+        return(v.strip())
+
+    def highlightBlock(self, text):
+        self.generation += 1
+        state = self.previousBlockState()
+        if state == -1:
+            state = 0
+        context = self.contexts[state]
+        problems, nextContext = self.linter.lintLine(text, context)
+        key = None
+        fields = []
+        bars = 0
+
+        field = AbcLinter.FIELD.match(text)
+        if text.startswith('%'):
+            self.setFormat(0, len(text), self.formats['comment'])
+        elif field:
+            key = field.group(0)
+            fields.append((key, self.fieldValue(text)))
+            self.setFormat(0, 2, self.formats['key'])
+            comment = text.find('%')
+            if comment < 0:
+                self.setFormat(2, len(text) - 2, self.formats['field'])
+            else:
+                self.setFormat(2, comment - 2, self.formats['field'])
+                self.setFormat(comment, len(text) - comment,
+                               self.formats['comment'])
+        else:
+            for m in AbcLinter.TOKENS.finditer(text):
+                kind = m.lastgroup
+                if kind in self.formats:
+                    self.setFormat(m.start(), m.end() - m.start(),
+                                   self.formats[kind])
+                if kind == 'bar' and context[0] and m.start() > 0:
+                    bar = m.group(0)
+                    if not (bar[0] == '[' and bar[1:2].isdigit()):  # [2
+                        bars += 1  # Bar lines at line start do not end a bar
+                elif kind == 'inline':
+                    inline = m.group(0).strip('[]')
+                    fields.append((inline[:2], self.fieldValue(inline)))
+
+        if nextContext not in self.states:
+            self.states[nextContext] = len(self.contexts)
+            self.contexts.append(nextContext)
+        self.setCurrentBlockState(self.states[nextContext])
+        self.setCurrentBlockUserData(AbcBlockData(key, fields, bars,
+                                                  problems))
+
+    def blocksData(self):
+        block = self.document().firstBlock()
+        while block.isValid():
+            data = block.userData()
+            if data is not None:
+                yield data
+            block = block.next()
+
+    def cached(self, name, function):
+        if self.cache.get('generation') != self.generation:
+            self.cache = {'generation': self.generation}
+        if name not in self.cache:
+            self.cache[name] = function()
+        return(self.cache[name])
+
+    def field(self, key):
+        ''' First value of a field, like Tune.getField(), from the index '''
+        def find():
+            for data in self.blocksData():
+                for k, v in data.fields:
+                    if k == key:
+                        return(v)
+            return('')
+        return(self.cached(key, find))
+
+    def bars(self):
+        return(self.cached('bars',
+                           lambda: sum(d.bars for d in self.blocksData())))
+
+    def problems(self):
+        ''' (line number, severity, message) of every problem found '''
+        def find():
+            problems = []
+            keys = []
+            block = self.document().firstBlock()
+            state = 0
+            while block.isValid():
+                data = block.userData()
+                if data is not None:
+                    if data.key:
+                        keys.append(data.key)
+                    problems += [(block.blockNumber() + 1, s, m)
+                                 for s, m in data.problems]
+                    state = max(block.userState(), 0)
+                block = block.next()
+            problems += [(0, s, m) for s, m in
+                         self.linter.finish(keys, self.contexts[state])]
+            return(problems)
+        return(self.cached('problems', find))
+
+    def errors(self):
+        return([p for p in self.problems() if p[1] == AbcLinter.ERROR])
 
 
 class NewTuneForm(QWidget):
+    tuneAccepted = pyqtSignal(str, bool)  # Text and if it is inserted
+
     def __init__(self, parent=None):
         super(NewTuneForm, self).__init__(parent)
 
@@ -234,6 +838,7 @@ class NewTuneForm(QWidget):
         self.setWindowIcon(QIcon.fromTheme(EXECUTABLE_NAME))
 
         self.textEdit = QTextEdit()
+        self.highlighter = AbcHighlighter(self.textEdit.document())
         label = QLabel(_("New tune"))
         self.resize(QSize(500, 400))
 
@@ -272,15 +877,464 @@ class NewTuneForm(QWidget):
         self.setLayout(mainLayout)
 
     def accept(self):
-        tune = self.textEdit.toPlainText()
-        if self.addRadioButton.isChecked():
-            mainWindow.addTune(tune)
-        else:
-            mainWindow.insertTune(tune)
+        self.tuneAccepted.emit(self.textEdit.toPlainText(),
+                               self.insertRadioButton.isChecked())
         self.textEdit.clear()
         self.close()
 
 
+class BatchEditForm(QWidget):
+    ''' Rewrites header fields of many tunes at once '''
+
+    PREVIEW = 50  # Changed tunes shown by preview
+
+    def __init__(self, editor, parent=None):
+        super(BatchEditForm, self).__init__(parent)
+        self.editor = editor  # MainWindow applying the changes
+
+        self.setWindowTitle(PROGRAM_NAME + ' ' + _("(Batch edit)"))
+        self.setWindowIcon(QIcon.fromTheme(EXECUTABLE_NAME))
+        self.resize(QSize(600, 500))
+
+        self.rules = []
+
+        self.fieldComboBox = QComboBox()
+        self.fieldComboBox.setEditable(True)
+        for i in ('T:', 'C:', 'O:', 'R:', 'M:', 'L:', 'Q:', 'K:', 'N:', 'S:',
+                  'Z:'):
+            self.fieldComboBox.addItem(i)
+
+        self.actionComboBox = QComboBox()
+        self.actionComboBox.addItem(_("Set"), 'set')
+        self.actionComboBox.addItem(_("Delete"), 'delete')
+        self.actionComboBox.addItem(_("Replace"), 'replace')
+
+        self.valueLineEdit = QLineEdit()
+        self.valueLineEdit.setPlaceholderText(_("Value or pattern"))
+        self.replaceLineEdit = QLineEdit()
+        self.replaceLineEdit.setPlaceholderText(_("Replacement"))
+
+        btnAddRule = QPushButton(_("Add rule"), self)
+        btnAddRule.setIcon(QIcon.fromTheme("list-add"))
+        btnAddRule.clicked.connect(self.addRule)
+
+        btnClearRules = QPushButton(_("Clear rules"), self)
+        btnClearRules.setIcon(QIcon.fromTheme("edit-clear"))
+        btnClearRules.clicked.connect(self.clearRules)
+
+        ruleLayout = QHBoxLayout()
+        ruleLayout.addWidget(self.fieldComboBox)
+        ruleLayout.addWidget(self.actionComboBox)
+        ruleLayout.addWidget(self.valueLineEdit)
+        ruleLayout.addWidget(self.replaceLineEdit)
+        ruleLayout.addWidget(btnAddRule)
+        ruleLayout.addWidget(btnClearRules)
+
+        self.rulesLabel = QLabel()
+
+        self.allRadioButton = QRadioButton(_("All tunes"), self)
+        self.filteredRadioButton = QRadioButton(_("Filtered tunes"), self)
+        self.allRadioButton.setChecked(True)
+
+        radioLayout = QHBoxLayout()
+        radioLayout.addWidget(self.allRadioButton)
+        radioLayout.addWidget(self.filteredRadioButton)
+        radioLayout.addStretch()
+
+        self.previewView = QTextEdit()
+        self.previewView.setReadOnly(True)
+
+        btnPreview = QPushButton(_("Preview"), self)
+        btnPreview.setIcon(QIcon.fromTheme("document-preview"))
+        btnPreview.clicked.connect(self.preview)
+
+        btnApply = QPushButton(_("Apply"), self)
+        btnApply.setIcon(QIcon.fromTheme("dialog-ok"))
+        btnApply.setToolTip(_("Apply the rules and save the tunebook"))
+        btnApply.clicked.connect(self.apply)
+
+        self.btnUndo = QPushButton(_("Undo"), self)
+        self.btnUndo.setIcon(QIcon.fromTheme("edit-undo"))
+        self.btnUndo.setToolTip(_("Undo the last applied rules"))
+        self.btnUndo.setEnabled(False)
+        self.btnUndo.clicked.connect(self.undo)
+
+        btnClose = QPushButton(_("Close"), self)
+        btnClose.setIcon(QIcon.fromTheme("window-close"))
+        btnClose.clicked.connect(self.close)
+
+        btnLayout = QHBoxLayout()
+        btnLayout.addWidget(btnClose)
+        btnLayout.addWidget(self.btnUndo)
+        btnLayout.addWidget(btnPreview)
+        btnLayout.addWidget(btnApply)
+
+        mainLayout = QGridLayout()
+        mainLayout.addLayout(ruleLayout, 0, 0)
+        mainLayout.addWidget(self.rulesLabel, 1, 0)
+        mainLayout.addLayout(radioLayout, 2, 0)
+        mainLayout.addWidget(self.previewView, 3, 0)
+        mainLayout.addLayout(btnLayout, 4, 0, Qt.AlignRight)
+        self.setLayout(mainLayout)
+
+        self.showRules()
+
+    def addRule(self):
+        key = self.fieldComboBox.currentText().strip()
+        if not key.endswith(':'):
+            key += ':'
+        action = self.actionComboBox.currentData()
+        value = self.valueLineEdit.text()
+
+        if action == 'set':
+            rule = (action, key, value)
+        elif action == 'delete':
+            rule = (action, key)
+        else:
+            replacement = self.replaceLineEdit.text()
+            try:
+                re.compile(value).sub(replacement, '')  # Checks groups
+            except (re.error, IndexError) as e:
+                QMessageBox.warning(self, _("Batch edit"),
+                                    _("Wrong pattern:") + " " + str(e))
+                return(0)
+            rule = (action, key, value, replacement)
+
+        self.rules.append(rule)
+        self.showRules()
+
+    def clearRules(self):
+        self.rules = []
+        self.showRules()
+
+    def showRules(self):
+        if self.rules:
+            self.rulesLabel.setText(
+                '; '.join(' '.join(rule) for rule in self.rules))
+        else:
+            self.rulesLabel.setText(_("No rules"))
+
+    def rows(self):
+        if self.filteredRadioButton.isChecked():
+            return(self.editor.tuneTable.filteredRows())
+        return(None)
+
+    def preview(self):
+        self.previewView.clear()
+        n = 0
+        for row, old, new in self.editor.tuneBook.rewrite(self.rules,
+                                                         self.rows()):
+            if n < self.PREVIEW:
+                diff = difflib.unified_diff(old.split('\n'),
+                                            new.split('\n'),
+                                            lineterm='', n=0)
+                lines = [l for l in diff
+                         if l[:1] in '+-' and l[:3] not in ('---', '+++')]
+                self.previewView.append('<b>' + str(row) + '</b>')
+                self.previewView.append('\n'.join(lines))
+            n += 1
+        self.previewView.append(str(n) + " " + _("tunes will change"))
+
+    def apply(self):
+        if self.rules:
+            changes = self.editor.rewriteTunes(self.rules, self.rows())
+            self.previewView.setText(str(len(changes)) + " "
+                                     + _("tunes changed"))
+
+    def undo(self):
+        n = self.editor.revertTunes()
+        if n:
+            self.previewView.setText(str(n) + " " + _("tunes restored"))
+        else:
+            self.previewView.setText(_("The tunebook changed after the "
+                                       "rules were applied"))
+
+
+class SetListItem():
+    ''' A tune of a set list and the MIDI file rendered for it '''
+
+    def __init__(self, text, title):
+        self.text = text
+        self.title = title
+        self.tempo = 0  # Of the tune when 0
+        self.semitones = 0
+        self.path = None  # MIDI file, when rendered
+        self.failed = False  # No MIDI file could be rendered
+        self.messages = ''
+
+
+class SetList(QWidget):
+    ''' Tunes played one after another. Their MIDI files are rendered in
+    background when they are queued or changed, with the tempo and the
+    transposition of every tune, so they are ready before they are played.
+    Tunes are added to the playlist of the player as they are ready, and
+    those that failed to render are skipped. '''
+
+    TITLE, TEMPO, TRANSPOSE, STATE = range(4)  # Column indices
+    started = pyqtSignal()
+
+    def __init__(self, pool, parent=None):
+        super(SetList, self).__init__(parent)
+        self.pool = pool
+        self.folder = None  # Of the MIDI files, made on first use
+        self.items = []
+        self.player = None  # Created by play() on first use
+        self.playlist = None
+        self.playing = False
+        self.queued = 0  # Items passed to the playlist or skipped
+        self.rows = []  # Item row of every tune of the playlist
+
+        self.table = QTableWidget(0, 4)
+        self.table.setHorizontalHeaderLabels(
+            (_("Title"), _("Tempo"), _("Transpose"), _("State")))
+        self.table.verticalHeader().setVisible(False)
+        self.table.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.table.setSelectionBehavior(QAbstractItemView.SelectRows)
+        self.table.setSelectionMode(QAbstractItemView.SingleSelection)
+        self.table.horizontalHeader().setStretchLastSection(True)
+
+        buttons = QHBoxLayout()
+        for icon, tip, slot in (
+                ('media-playback-start', _("Play the set"), self.play),
+                ('media-playback-stop', _("Stop"), self.stop),
+                ('go-up', _("Move up"), lambda: self.moveItem(-1)),
+                ('go-down', _("Move down"), lambda: self.moveItem(1)),
+                ('list-remove', _("Remove from the set"), self.removeItem),
+                ('edit-clear', _("Clear the set"), self.clear)):
+            button = QPushButton(QIcon.fromTheme(icon), '', self)
+            button.setToolTip(tip)
+            button.clicked.connect(slot)
+            buttons.addWidget(button)
+        buttons.addStretch()
+
+        mainLayout = QVBoxLayout()
+        mainLayout.addWidget(self.table)
+        mainLayout.addLayout(buttons)
+        self.setLayout(mainLayout)
+
+    def addTune(self, text, title):
+        item = SetListItem(text, title)
+        self.items.append(item)
+        self.showItems()
+        self.render(item)
+
+    def showItems(self):
+        self.table.setRowCount(len(self.items))
+        for row, item in enumerate(self.items):
+            self.table.setItem(row, self.TITLE, QTableWidgetItem(item.title))
+            tempo = QSpinBox()
+            tempo.setRange(0, 400)
+            tempo.setSingleStep(10)
+            tempo.setSpecialValueText(_("Default"))
+            tempo.setValue(item.tempo)
+            tempo.valueChanged.connect(
+                lambda value, item=item: self.setTempo(item, value))
+            self.table.setCellWidget(row, self.TEMPO, tempo)
+            semitones = QSpinBox()
+            semitones.setRange(-12, 12)
+            semitones.setValue(item.semitones)
+            semitones.valueChanged.connect(
+                lambda value, item=item: self.setSemitones(item, value))
+            self.table.setCellWidget(row, self.TRANSPOSE, semitones)
+            self.showState(item)
+
+    def showState(self, item):
+        if item.path:
+            state = item.messages or _("Ready")
+        elif item.messages:
+            state = item.messages
+        elif item.failed:
+            state = _("No MIDI file")
+        else:
+            state = _("Rendering")
+        row = self.items.index(item)
+        self.table.setItem(row, self.STATE, QTableWidgetItem(state.strip()))
+
+    def setTempo(self, item, value):
+        item.tempo = value
+        self.render(item)
+
+    def setSemitones(self, item, value):
+        item.semitones = value
+        self.render(item)
+
+    def render(self, item):
+        if self.folder is None:
+            self.folder = tempfile.mkdtemp(prefix=EXECUTABLE_NAME)
+        item.path = None
+        item.failed = False
+        item.messages = ''
+        self.showState(item)
+        settings = (item.tempo, item.semitones)
+        self.pool.midi(item.text, self.folder, item.tempo or None,
+                       item.semitones,
+                       lambda path, messages: self.rendered(
+                           item, settings, path, messages))
+
+    def rendered(self, item, settings, path, messages):
+        if item not in self.items or settings != (item.tempo, item.semitones):
+            return(0)  # Removed or changed meanwhile
+        item.path = path
+        item.failed = not path
+        item.messages = messages
+        self.showState(item)
+        row = self.items.index(item)
+        if self.playing and path and row in self.rows \
+                and self.rows.index(row) > self.playlist.currentIndex():
+            self.replaceMedia(self.rows.index(row), path)  # Old settings
+        self.feed()
+
+    def play(self):
+        from PyQt5.QtMultimedia import QMediaPlayer, QMediaPlaylist
+        if self.player is None:
+            self.player = QMediaPlayer(self)
+            self.playlist = QMediaPlaylist(self)
+            self.playlist.setPlaybackMode(QMediaPlaylist.Sequential)
+            self.playlist.currentIndexChanged.connect(self.selectPlaying)
+            self.player.setPlaylist(self.playlist)
+        self.stop()
+        self.playing = True
+        self.started.emit()
+        self.feed()
+
+    def feed(self):
+        ''' Adds to the playlist the tunes ready, in order, and plays on if
+        the player ran out of them '''
+        if not self.playing:
+            return(0)
+        from PyQt5.QtMultimedia import QMediaContent, QMediaPlayer
+        first = len(self.rows)
+        while self.queued < len(self.items):
+            item = self.items[self.queued]
+            if not item.path and not item.failed:
+                break  # Rendering yet
+            if item.path:
+                url = QUrl.fromLocalFile(item.path)
+                self.playlist.addMedia(QMediaContent(url))
+                self.rows.append(self.queued)
+            self.queued += 1
+        if len(self.rows) > first and \
+                self.player.state() != QMediaPlayer.PlayingState:
+            self.playlist.setCurrentIndex(first)
+            self.player.play()
+
+    def replaceMedia(self, n, path):
+        from PyQt5.QtMultimedia import QMediaContent
+        self.playlist.removeMedia(n)
+        self.playlist.insertMedia(n, QMediaContent(QUrl.fromLocalFile(path)))
+
+    def selectPlaying(self, n):
+        if 0 <= n < len(self.rows):
+            self.table.selectRow(self.rows[n])
+
+    def stop(self):
+        self.playing = False
+        if self.player:
+            self.player.stop()
+            self.playlist.clear()
+        self.queued = 0
+        self.rows = []
+
+    def moveItem(self, step):
+        row = self.table.currentRow()
+        if 0 <= row < len(self.items) and 0 <= row + step < len(self.items):
+            self.stop()
+            items = self.items
+            items[row], items[row + step] = items[row + step], items[row]
+            self.showItems()
+            self.table.selectRow(row + step)
+
+    def removeItem(self):
+        row = self.table.currentRow()
+        if 0 <= row < len(self.items):
+            self.stop()
+            del self.items[row]
+            self.showItems()
+
+    def clear(self):
+        self.stop()
+        self.items = []
+        self.showItems()
+
+    def close(self):
+        self.stop()
+        if self.folder:
+            shutil.rmtree(self.folder, ignore_errors=True)
+
+
+class StatisticsView(QWidget):
+    ''' Statistics of a tunebook, exported as CSV or JSON '''
+
+    def __init__(self, parent=None):
+        super(StatisticsView, self).__init__(parent)
+        self.report = None
+
+        self.tree = QTreeWidget()
+        self.tree.setColumnCount(3)
+        self.tree.setHeaderLabels((_("Value"), _("Tunes"), "%"))
+        self.tree.setRootIsDecorated(True)
+
+        self.exportButton = QPushButton(QIcon.fromTheme('document-export'),
+                                        _("Export..."), self)
+        self.exportButton.clicked.connect(self.export)
+        self.exportButton.setEnabled(False)
+
+        buttons = QHBoxLayout()
+        buttons.addStretch()
+        buttons.addWidget(self.exportButton)
+
+        mainLayout = QVBoxLayout()
+        mainLayout.addWidget(self.tree)
+        mainLayout.addLayout(buttons)
+        self.setLayout(mainLayout)
+
+    def showReport(self, report):
+        self.report = report
+        self.exportButton.setEnabled(report is not None)
+        self.tree.clear()
+        if report is None:
+            return(0)
+        total = max(report['tunes'], 1)
+
+        def add(parent, name, count=None):
+            texts = [name]
+            if count is not None:
+                texts += [str(count), "%.1f" % (100 * count / total)]
+            item = QTreeWidgetItem(parent, texts)
+            item.setTextAlignment(1, Qt.AlignRight)
+            item.setTextAlignment(2, Qt.AlignRight)
+            return(item)
+
+        add(self.tree, _("Tunes"), report['tunes'])
+        for field, name in TuneStatistics.FIELDS:
+            section = add(self.tree, name + " (" + str(len(report[field]))
+                          + ")")
+            for value, count in report[field]:
+                add(section, value, count)
+        section = add(self.tree, _("Missing fields"))
+        for field, count in report['missing'].items():
+            add(section, field, count)
+        section = add(self.tree, _("Length in bars"))
+        for name, value in report.get('bars', {}).items():
+            add(section, name + ": " + str(value))
+        for name, count in report['lengths']:
+            add(section, name, count)
+        self.tree.resizeColumnToContents(0)
+
+    def export(self):
+        path, kind = QFileDialog.getSaveFileName(
+            self, _("Export statistics"), _("statistics") + ".csv",
+            _("CSV files") + " (*.csv);;" + _("JSON files") + " (*.json)")
+        if not path:
+            return(0)
+        if not os.path.splitext(path)[1]:
+            path += '.json' if 'json' in kind else '.csv'
+        try:
+            TuneStatistics.export(self.report, path)
+        except OSError:
+            print("I can't write the statistics file")
+
+
 class AboutDialog(QWidget):
     def __init__(self, parent=None):
         super(AboutDialog, self).__init__(parent)
@@ -426,16 +1480,172 @@ class TranslationTab(QWidget):
         self.setLayout(mainLayout)
 
 
-class TuneTable(QWidget):
+class TuneFilterThread(QThread):
+    ''' Tests candidate rows of the tune table in background. The rows
+    and the values tested are snapshots, as the table may change during
+    the search. '''
 
-    X, T, R, M, K = range(5)  # Column indices
+    filtered = pyqtSignal(int, list, int)  # Generation, rows, rows searched
 
-    def __init__(self):
-        super(TuneTable, self).__init__()
+    def __init__(self, generation, candidates, accepts, limit, parent=None):
+        super(TuneFilterThread, self).__init__(parent)
+        self.generation = generation
+        self.candidates = candidates  # Rows to test
+        self.accepts = accepts  # Row test, None accepts every candidate
+        self.limit = limit  # New rows may arrive while searching
+
+    def run(self):
+        accepts = self.accepts
+        result = []
+        try:
+            for n, row in enumerate(self.candidates):
+                if not n % 5000 and self.isInterruptionRequested():
+                    return
+                if accepts is None or accepts(row):
+                    result.append(row)
+        except Exception as e:  # A failed search finds nothing
+            print("I can't filter the tunes: " + str(e))
+            result = []
+        self.filtered.emit(self.generation, result, self.limit)
+
+
+class TuneQuery():
+    ''' Conjunctive query over tune headers, like "K:D R:reel T:kid*".
+    Words without field apply to the column selected for filtering.
+    R:, M: and K: are answered with the indices of TuneTableModel, the
+    other words are tested row by row on the rows left. '''
+
+    FIELDS = {'T': TuneTableModel.T, 'R': TuneTableModel.R,
+              'M': TuneTableModel.M, 'K': TuneTableModel.K}
+
+    def __init__(self, text, column, caseSensitive=False):
+        try:
+            words = shlex.split(text)
+        except ValueError:  # Unbalanced quotes
+            words = text.split()
+        self.terms = []  # (column, test of a raw value)
+        self.indexed = []  # (column, test of a normalized value)
+        for word in words:
+            field, sep, value = word.partition(':')
+            if sep and field.upper() in self.FIELDS:
+                col = self.FIELDS[field.upper()]
+            else:
+                col, value = column, word
+            if col == TuneTableModel.T:
+                search = TuneTable.compileFilter(value, QRegExp.Wildcard,
+                                                 caseSensitive)
+                self.terms.append((col, search))
+            else:
+                test = self.valueTest(TuneTableModel.normalize(col, value))
+                self.indexed.append((col, test))
+
+    @staticmethod
+    def valueTest(pattern):
+        if set(pattern) & set('*?['):
+            return(lambda v: fnmatch.fnmatchcase(v, pattern))
+        return(lambda v: v == pattern)
+
+    def candidates(self, model, limit):
+        ''' Rows below limit matching the indexed fields, by intersection
+        of the sorted arrays of every matching value. Called from the
+        interface thread, as the indices change while tunes load. '''
+        if not self.indexed:
+            return(range(limit))
+        sets = []
+        for col, test in self.indexed:
+            rows = set()
+            for key, keyRows in model.valueRows[col].items():
+                if test(key):
+                    rows.update(keyRows)
+            sets.append(rows)
+        sets.sort(key=len)
+        rows = sets[0].intersection(*sets[1:])
+        return(sorted(r for r in rows if r < limit))
+
+    def unindexedAccepts(self, columns):
+        ''' Test of the words not answered by candidates(), on columns
+        like those of TuneTableModel or snapshots of them '''
+        if not self.terms:
+            return(None)
+        terms = [(columns[col - 1], search)
+                 for col, search in self.terms]
+        return(lambda row: all(search and search(values[row])
+                               for values, search in terms))
+
+    def accepts(self, model):
+        ''' Test of every word for a single row '''
+        unindexed = self.unindexedAccepts(model.columns)
+        indexed = [(col, model.columns[col - 1], test)
+                   for col, test in self.indexed]
+
+        def accepts(row):
+            for col, values, test in indexed:
+                if not test(TuneTableModel.normalize(col, values[row])):
+                    return(False)
+            return(unindexed is None or unindexed(row))
+        return(accepts)
+
+
+class TuneFilterProxyModel(QSortFilterProxyModel):
+    ''' Shows the rows found by a TuneFilterThread. Rows loaded after
+    the search are matched here directly. '''
+
+    def __init__(self, parent=None):
+        super(TuneFilterProxyModel, self).__init__(parent)
+        self.setFilter()
+
+    def setFilter(self, accepts=None, rows=(), limit=0):
+        self.accepts = accepts  # None shows all rows
+        self.rows = set(rows)
+        self.limit = limit
+        self.invalidateFilter()
+
+    def filterAcceptsRow(self, row, parent):
+        if self.accepts is None:
+            return(True)
+        if row < self.limit:
+            return(row in self.rows)
+        return(bool(self.accepts(row)))
+
+
+class TuneTable(QWidget):
+    ''' Table of the tunes of a tunebook '''
+
+    tuneSelected = pyqtSignal(int)  # Position in the tunebook
+    tunesDropped = pyqtSignal(object, list, bool)  # Source view, rows, move
+    tunesChanged = pyqtSignal()  # Tunes added, edited or removed
 
-        self.proxyModel = QSortFilterProxyModel()
+    X, T, R, M, K = range(5)  # Column indices
+    SAMPLE = 50  # Rows measured to estimate column widths
+    LINT_LOCAL = 200  # Fewer unchecked tunes are linted without the pool
+    DEBOUNCE = 250  # Milliseconds without typing before filtering
+    QUERY = -1  # Filter syntax of TuneQuery, out of QRegExp.PatternSyntax
+
+    def __init__(self, book, parent=None):
+        super(TuneTable, self).__init__(parent)
+        self.book = book
+        self.loader = None
+        self.journal = TuneJournal()
+        self.features = TuneFeatures()  # Similarity vectors
+        self.statistics = TuneStatistics()
+        self.report = None  # Statistics, until the tunes change
+        self.draft = None  # (position, text) edited when the tab was left
+        self.used = 0  # When the tab was shown the last time
+        self.evicted = False  # Tunes freed, to read again when shown
+        self.filterActions = []  # Filter widgets in the main window
+
+        self.proxyModel = TuneFilterProxyModel()
         self.proxyModel.setDynamicSortFilter(True)
-        self.proxyModel.setFilterKeyColumn(self.T)
+
+        self.lintCache = {}  # (errors, warnings) by hash of the tune text
+        self.linterThread = None
+        self.filterGeneration = 0  # Discards results of older searches
+        self.filterThreads = []
+        self.lastFilter = None  # (column, syntax, case, pattern, rows, limit)
+        self.filterTimer = QTimer(self)
+        self.filterTimer.setSingleShot(True)
+        self.filterTimer.setInterval(self.DEBOUNCE)
+        self.filterTimer.timeout.connect(self.startFilter)
 
         self.proxyView = QTableView()
         self.proxyView.setModel(self.proxyModel)
@@ -443,7 +1653,11 @@ class TuneTable(QWidget):
         self.proxyView.verticalHeader().setVisible(False)
         self.proxyView.setEditTriggers(QAbstractItemView.NoEditTriggers)
         self.proxyView.setSelectionBehavior(QAbstractItemView.SelectRows)
-        self.proxyView.setSelectionMode(QAbstractItemView.SingleSelection)
+        self.proxyView.setSelectionMode(QAbstractItemView.ExtendedSelection)
+        self.proxyView.setDragEnabled(True)
+        self.proxyView.setDragDropMode(QAbstractItemView.DragDrop)
+        self.proxyView.setDefaultDropAction(Qt.CopyAction)
+        self.proxyView.viewport().installEventFilter(self)
         self.proxyView.selectionModel().selectionChanged.connect(self.itemSelected)
 
         self.filterCaseSensitivityCheckBox = QCheckBox("Case sensitive")
@@ -457,6 +1671,9 @@ class TuneTable(QWidget):
         self.filterSyntaxComboBox.addItem("Fixed string", QRegExp.FixedString)
         self.filterSyntaxComboBox.addItem("Wildcard", QRegExp.Wildcard)
         self.filterSyntaxComboBox.addItem("Regular expression", QRegExp.RegExp)
+        self.filterSyntaxComboBox.addItem("Query", self.QUERY)
+        self.filterSyntaxComboBox.setItemData(
+            3, _("Fields to match, like: K:D R:reel T:kid*"), Qt.ToolTipRole)
 
         self.filterColumnComboBox = QComboBox()
         self.filterColumnComboBox.addItem("Title")
@@ -480,50 +1697,178 @@ class TuneTable(QWidget):
 
     def setSourceModel(self, model):
         self.proxyModel.setSourceModel(model)
+        self.lastFilter = None  # Rows found belong to the old model
+        if self.filterPatternLineEdit.text():
+            self.startFilter()
 
     def filterRegExpChanged(self):
-        syntax_nr = self.filterSyntaxComboBox.itemData(self.filterSyntaxComboBox.currentIndex())
-        syntax = QRegExp.PatternSyntax(syntax_nr)
+        self.filterTimer.start()
 
-        if self.filterCaseSensitivityCheckBox.isChecked():
-            caseSensitivity = Qt.CaseSensitive
+    def filterColumnChanged(self):
+        self.filterTimer.start()
+
+    @staticmethod
+    def compileFilter(pattern, syntax, caseSensitive):
+        ''' Returns the search method of a Python regular expression
+        equivalent to a QRegExp filter, or None if pattern is wrong '''
+        if syntax == QRegExp.FixedString:
+            expr = re.escape(pattern)
+        elif syntax == QRegExp.Wildcard:
+            expr = ''
+            for part in re.split(r'(\*|\?|\[[^\]]*\])', pattern):
+                if part == '*':
+                    expr += '.*'
+                elif part == '?':
+                    expr += '.'
+                elif part.startswith('[') and part.endswith(']'):
+                    expr += part
+                else:
+                    expr += re.escape(part)
         else:
-            caseSensitivity = Qt.CaseInsensitive
-
-        regExp = QRegExp(self.filterPatternLineEdit.text(),
-                         caseSensitivity, syntax)
-        self.proxyModel.setFilterRegExp(regExp)
+            expr = pattern
+        try:
+            return(re.compile(expr, 0 if caseSensitive else re.I).search)
+        except re.error:
+            return(None)
+
+    @staticmethod
+    def narrows(old, new, syntax):
+        ''' True if every row matching new also matches old '''
+        if syntax == QRegExp.FixedString:
+            return(old in new)
+        if syntax == QRegExp.Wildcard:
+            return(new.startswith(old) and not set(old) & set('[\\'))
+        return(False)
 
-    def filterColumnChanged(self):
-        self.proxyModel.setFilterKeyColumn(self.filterColumnComboBox.currentIndex() + 1)
-
-    def createABCModel(self):
-        model = QStandardItemModel(0, 5)
-
-        model.setHeaderData(self.X, Qt.Horizontal, "Index")
-        model.setHeaderData(self.T, Qt.Horizontal, "Title")
-        model.setHeaderData(self.R, Qt.Horizontal, "Rhythm")
-        model.setHeaderData(self.M, Qt.Horizontal, "Meter")
-        model.setHeaderData(self.K, Qt.Horizontal, "Key")
-
-        x = 0
-        for i in tuneBook.tunes:
-            tune = Tune()
-            tune.load(i)
-            t = tune.getField('T:')
-            r = tune.getField('R:')
-            m = tune.getField('M:')
-            k = tune.getField('K:')
-
-            model.insertRow(0)
-            model.setData(model.index(0, self.X), x)
-            model.setData(model.index(0, self.T), t)
-            model.setData(model.index(0, self.R), r)
-            model.setData(model.index(0, self.M), m)
-            model.setData(model.index(0, self.K), k)
-            x += 1
+    def startFilter(self):
+        self.filterTimer.stop()
+        self.filterGeneration += 1
+        for thread in self.filterThreads:
+            thread.requestInterruption()
+
+        model = self.proxyModel.sourceModel()
+        pattern = self.filterPatternLineEdit.text()
+        column = self.filterColumnComboBox.currentIndex() + 1
+        syntax = self.filterSyntaxComboBox.itemData(
+            self.filterSyntaxComboBox.currentIndex())
+        case = self.filterCaseSensitivityCheckBox.isChecked()
+
+        if model is None or not pattern:
+            self.lastFilter = None
+            self.proxyModel.setFilter()
+            return
+
+        limit = len(model.columns[0])
+        if syntax == self.QUERY:
+            query = TuneQuery(pattern, column, case)
+            accepts = query.accepts(model)
+            candidates = query.candidates(model, limit)
+            test = query.unindexedAccepts(
+                [c.snapshot() for c in model.columns])
+            narrow = False
+        else:
+            search = self.compileFilter(pattern, syntax, case)
+            if search is None:  # Wrong regular expression shows nothing
+                self.lastFilter = None
+                self.proxyModel.setFilter(lambda row: False)
+                return
+            values = model.columns[column - 1]
+            frozen = values.snapshot()  # For the thread
+            accepts = lambda row: search(values[row])
+            test = lambda row: search(frozen[row])
+            candidates = range(limit)
+            narrow = True
+
+        last = self.lastFilter
+        if (narrow and last and last[:3] == (column, syntax, case)
+                and self.narrows(last[3], pattern, syntax)):
+            rows, lastLimit = last[4], last[5]
+            candidates = rows + list(range(lastLimit, limit))
+
+        thread = TuneFilterThread(self.filterGeneration, candidates, test,
+                                  limit, self)
+        key = (column, syntax, case, pattern)
+        thread.filtered.connect(
+            lambda g, rows, limit: self.filterDone(g, key, accepts, rows, limit))
+        thread.finished.connect(lambda: self.filterThreads.remove(thread))
+        thread.finished.connect(thread.deleteLater)
+        self.filterThreads.append(thread)
+        thread.start()
+
+    def filterDone(self, generation, key, accepts, rows, limit):
+        if generation != self.filterGeneration:
+            return
+        self.lastFilter = key + (rows, limit)
+        self.proxyModel.setFilter(accepts, rows, limit)
+
+    def createABCModel(self, tunes=()):
+        model = TuneTableModel()
+        model.appendHeaders([TuneBook.headers(i) for i in tunes])
         return model
 
+    def appendHeaders(self, headers):
+        model = self.proxyModel.sourceModel()
+        estimate = not model.shown
+        model.appendHeaders(headers)
+        if estimate:
+            self.estimateColumnWidths()
+
+    def estimateColumnWidths(self):
+        ''' Sizes columns from a sample of rows instead of all of them '''
+        model = self.proxyModel.sourceModel()
+        metrics = self.proxyView.fontMetrics()
+        header = self.proxyView.horizontalHeader()
+        n = len(model.columns[0])
+        step = max(n // self.SAMPLE, 1)
+        for col in range(model.columnCount()):
+            values = [model.titles[col]]
+            if col == self.X:
+                values.append(str(n))
+            elif col == TuneTableModel.V:
+                values.append(model.problemsData((99, 0), Qt.DisplayRole))
+            else:
+                values += model.columns[col - 1][::step]
+            width = max(metrics.width(str(v)) for v in values)
+            header.resizeSection(col, width + 2 * metrics.averageCharWidth())
+
+    def filteredRows(self):
+        ''' Positions of all the tunes accepted by the filter, loaded by
+        the view or not. None if there is not filter. '''
+        proxy = self.proxyModel
+        if proxy.accepts is None:
+            return(None)
+        n = len(proxy.sourceModel().columns[0])
+        return(sorted(proxy.rows)
+               + [r for r in range(proxy.limit, n) if proxy.accepts(r)])
+
+    def selectedRows(self):
+        ''' Positions in the tunebook of the selected tunes '''
+        rows = self.proxyView.selectionModel().selectedRows()
+        return(sorted(self.proxyModel.mapToSource(i).row() for i in rows))
+
+    def eventFilter(self, watched, event):
+        ''' Takes the tunes dragged from the table of other tunebook.
+        Dragging with Shift moves them. '''
+        if event.type() in (QEvent.DragEnter, QEvent.DragMove, QEvent.Drop):
+            source = event.source()
+            mime = TuneTableModel.MIME
+            if not event.mimeData().hasFormat(mime) \
+                    or source is self.proxyView \
+                    or not isinstance(source, QTableView):
+                event.ignore()
+                return(True)
+            if event.type() == QEvent.Drop:
+                data = bytes(event.mimeData().data(mime)).decode()
+                rows = [int(i) for i in data.split(',') if i]
+                move = event.dropAction() == Qt.MoveAction
+                event.setDropAction(Qt.CopyAction)  # Moved by us, not Qt
+                event.accept()
+                self.tunesDropped.emit(source, rows, move)
+            else:
+                event.acceptProposedAction()
+            return(True)
+        return(super(TuneTable, self).eventFilter(watched, event))
+
     def getTableViewValue(self, row, column, widget):
         coordinates = widget.model().index(row, column)
         return(widget.model().data(coordinates))
@@ -533,19 +1878,134 @@ class TuneTable(QWidget):
         column = self.X
         index = self.getTableViewValue(row, column, self.proxyView)
         if index != None and index >= 0:  # Prevent Nonetype selected and allow 0 index
-            tuneBook.index = int(index)
-            mainWindow.showTune()
+            self.tuneSelected.emit(int(index))
+
+    def statisticsReport(self):
+        ''' Statistics of the tunebook, computed from the header index
+        again only after the tunes change '''
+        model = self.proxyModel.sourceModel()
+        if self.report is None and model is not None and not self.loader:
+            fields = ('T:', 'R:', 'M:', 'K:')  # Of model.columns
+            self.report = self.statistics.report(
+                self.book.tunes,
+                {field: (column.rows, column.values)
+                 for field, column in zip(fields, model.columns)},
+                TuneBook.normalize)
+        return(self.report)
+
+    def showRow(self, pos):
+        ''' Selects a tune in the table, or only shows it if the table
+        does not list it '''
+        model = self.proxyModel.sourceModel()
+        index = QModelIndex()
+        if model is not None and pos < model.rowCount():
+            index = self.proxyModel.mapFromSource(model.index(pos, self.X))
+        if index.isValid():
+            self.proxyView.setCurrentIndex(index)
+            self.proxyView.scrollTo(index)
+        else:
+            self.tuneSelected.emit(pos)
 
-    def reloadTable(self):
-        app.setOverrideCursor(Qt.WaitCursor)
+    def clearTable(self):
         self.setSourceModel(self.createABCModel())
-        self.proxyView.resizeColumnsToContents()
-        app.restoreOverrideCursor()
+
+    def memorySize(self):
+        ''' Bytes used by the tunes and headers of the tunebook '''
+        model = self.proxyModel.sourceModel()
+        size = self.book.tunes.size() + self.features.size() \
+            + self.statistics.size()
+        if model is not None:
+            size += sum(column.size() for column in model.columns)
+        return(size)
+
+    def evict(self):
+        ''' Frees the tunes and headers of a tunebook not shown. They are
+        read again from its file when it is shown. '''
+        self.stopLinter()
+        self.book.unload()
+        self.clearTable()
+        self.lintCache = {}
+        self.features = TuneFeatures()
+        self.statistics = TuneStatistics()
+        self.report = None
+        self.evicted = True
+
+    def reloadTable(self):
+        QApplication.setOverrideCursor(Qt.WaitCursor)
+        self.setSourceModel(self.createABCModel(self.book.tunes))
+        self.estimateColumnWidths()
+        QApplication.restoreOverrideCursor()
+        self.checkTunes()
+
+    def checkTunes(self):
+        ''' Lints the tunebook and shows the results in the Check column.
+        Results are cached by text, so only changed tunes are linted. '''
+        self.report = None
+        self.tunesChanged.emit()
+        self.stopLinter()
+        model = self.proxyModel.sourceModel()
+        known = []
+        missing = []
+        for row, text in enumerate(self.book.tunes):
+            summary = self.lintCache.get(hash(text))
+            if summary is None:
+                missing.append((row, text))
+            else:
+                known.append((row, summary))
+        if len(missing) < self.LINT_LOCAL:
+            for row, text in missing:
+                summary = lintSummary(text)
+                self.lintCache[hash(text)] = summary
+                known.append((row, summary))
+            missing = []
+        model.setProblems(known)
+        if missing:
+            self.linterThread = TuneBookLinter(missing, self)
+            self.linterThread.checked.connect(
+                lambda results, model=model: self.tunesChecked(model, results))
+            self.linterThread.start()
+
+    def applySplices(self, splices):
+        ''' Updates the table with the tunes changed by TuneBook.reread() '''
+        model = self.proxyModel.sourceModel()
+        for start, end, tunes in splices:
+            model.spliceHeaders(start, end,
+                                [TuneBook.headers(i) for i in tunes])
+        self.lastFilter = None  # Rows found may have been shifted
+        if self.filterPatternLineEdit.text():
+            self.startFilter()
+        self.checkTunes()
+
+    def tunesChecked(self, model, results):
+        for row, text, summary in results:
+            self.lintCache[hash(text)] = summary
+        if model is self.proxyModel.sourceModel():
+            model.setProblems([(row, summary)
+                               for row, text, summary in results])
+
+    def stopLinter(self):
+        if self.linterThread:
+            self.linterThread.checked.disconnect()
+            self.linterThread.requestInterruption()
+            self.linterThread.wait()
+            self.linterThread = None
 
 
 class MainWindow(QMainWindow):
-    def __init__(self):
+    RELATED = 10  # Related tunes listed
+    def __init__(self, tuneBook):
         super(MainWindow, self).__init__()
+        self.tuneTable = None  # Table of the tab shown
+        self.tuneBook = None  # And its tunebook
+        self.uses = 0  # Tabs shown, to know the least recently used
+        self.render = RenderService()
+        self.renderCache = RenderCache()
+        self.renderPool = RenderPool(self.render, self.renderCache, self)
+        self.setList = SetList(self.renderPool)
+        self.featureIndexer = FeatureIndexer(self)
+        self.featureIndexer.indexed.connect(self.relatedIndexed)
+        self.setList.started.connect(self.stopTune)
+        self.svgText = None  # Last text sent to render
 
         self.createActions()
 
@@ -555,6 +2015,8 @@ class MainWindow(QMainWindow):
 
         self.statusT = QLabel()
         self.statusR = QLabel()
+        self.statusBars = QLabel()
+        self.statusLint = QLabel()
         self.statusK = QLabel()
 
         self.comboTempo = QComboBox()
@@ -580,58 +2042,425 @@ class MainWindow(QMainWindow):
         self.sliderZoom.setValue(0)
         self.sliderZoom.valueChanged.connect(self.svgZoom)
 
-        self.svgWidget = QSvgWidget()
-        self.svgPalette = self.svgWidget.palette()
-        self.svgPalette.setColor(self.svgWidget.backgroundRole(), Qt.white)
-
+        self.svgWidget = None  # Created by createSvgWidget() on first use
         self.svgScroll = QScrollArea()
-        self.svgScroll.setWidget(self.svgWidget)
 
         self.textEdit = QTextEdit()
+        self.highlighter = AbcHighlighter(self.textEdit.document())
         self.textEdit.textChanged.connect(self.autoUpdateInterface)
+        self.textEdit.textChanged.connect(self.journalEdit)
 
         self.logView = QTextEdit()
 
-        self.mediaPlayer = QMediaPlayer()
-        self.playList = QMediaPlaylist()
-        self.tuneTable = TuneTable()
+        self.statisticsView = StatisticsView()
+        self.statisticsTimer = QTimer(self)  # Waits for changes to settle
+        self.statisticsTimer.setSingleShot(True)
+        self.statisticsTimer.setInterval(300)
+        self.statisticsTimer.timeout.connect(self.updateStatistics)
+
+        self.relatedView = QListWidget()
+        self.relatedView.itemActivated.connect(self.showRelated)
+
+        self.mediaPlayer = None  # Created by createMediaPlayer() on first use
+        self.playList = None
+        self.aboutDialog = None
+        self.newTuneForm = None
+        self.batchEditForm = None
+        self.rewritten = None  # Undo operation of the last batch edit
+        self.firstPaint = None
+
+        self.journalTimer = QTimer(self)
+        self.journalTimer.setInterval(2000)
+        self.journalTimer.timeout.connect(self.flushJournals)
+        self.journalTimer.start()
+
+        self.watcher = QFileSystemWatcher(self)
+        self.watcher.fileChanged.connect(self.fileChanged)
+        self.changedFiles = set()
+        self.watcherTimer = QTimer(self)  # Waits for writes to settle
+        self.watcherTimer.setSingleShot(True)
+        self.watcherTimer.setInterval(500)
+        self.watcherTimer.timeout.connect(self.syncFiles)
+
+        self.bookTabs = QTabWidget()
+        self.bookTabs.setDocumentMode(True)
+        self.bookTabs.setTabsClosable(True)
+        self.bookTabs.setMovable(True)
+        self.bookTabs.tabBar().setAcceptDrops(True)
+        self.bookTabs.tabBar().setChangeCurrentOnDrag(True)
+        self.bookTabs.currentChanged.connect(self.bookChanged)
+        self.bookTabs.tabCloseRequested.connect(self.closeBook)
 
         self.createMenus()
         self.createToolBars()
         self.createDockWindows()
         self.createStatusBar()
         self.readSettings()
-
-        try:
-            f = sys.argv[1]
-        except:
-            f = None
-
-        if f:
+        self.addBook(tuneBook)
+
+    def paintEvent(self, event):
+        super(MainWindow, self).paintEvent(event)
+        if self.firstPaint is None:
+            self.firstPaint = round((time.perf_counter() - START_TIME) * 1000)
+            self.logView.append(_("First paint: ") + str(self.firstPaint) + " ms")
+            if self.firstPaint > STARTUP_TARGET:
+                self.logView.append(_("Startup is slower than ")
+                                    + str(STARTUP_TARGET) + " ms")
+
+    def openArgFile(self):
+        ''' Opens the files passed in command line once the window is
+        shown '''
+        for f in sys.argv[1:]:
             self.openFile(f)
 
+    def tables(self):
+        return([self.bookTabs.widget(i) for i in range(self.bookTabs.count())])
+
+    def addBook(self, book):
+        ''' Opens a tab for a tunebook and shows it '''
+        table = TuneTable(book, self)
+        table.tuneSelected.connect(self.selectTune)
+        table.tunesChanged.connect(
+            lambda: table is self.tuneTable and self.statisticsTimer.start())
+        table.tunesDropped.connect(
+            lambda view, rows, move: self.dropTunes(view, table, rows, move))
+        if not self.toggleShowIndexAct.isChecked():
+            table.proxyView.setColumnHidden(0, True)
+        for widget in (table.filterPatternLabel, table.filterPatternLineEdit,
+                       None, table.filterColumnComboBox,
+                       None, table.filterSyntaxComboBox,
+                       None, table.filterCaseSensitivityCheckBox):
+            if widget is None:
+                action = self.filterToolBar.addSeparator()
+            else:
+                action = self.filterToolBar.addWidget(widget)
+            action.setVisible(False)
+            table.filterActions.append(action)
+        self.bookTabs.setCurrentIndex(
+            self.bookTabs.addTab(table, _("New tunebook")))
+        return(table)
+
+    def bookChanged(self, index):
+        ''' Shows the tunebook of the current tab, keeping the text being
+        edited in the tunebook left '''
+        table = self.bookTabs.widget(index)
+        if table is None or table is self.tuneTable:
+            return(0)
+        old = self.tuneTable
+        if old is not None:
+            old.draft = None
+            if old.book.tunes:
+                text = self.textEdit.toPlainText()
+                if text != old.book.tunes[old.book.index]:
+                    old.draft = (old.book.index, text)
+            for action in old.filterActions:
+                action.setVisible(False)
+        for action in table.filterActions:
+            action.setVisible(True)
+
+        self.tuneTable = table
+        self.tuneBook = table.book
+        self.uses += 1
+        table.used = self.uses
+        self.updateHistoryActions()
+        self.updateStatistics()
+        if table.evicted:
+            self.textEdit.clear()
+            self.loadBook(table)
+        elif table.book.tunes:
+            self.showTune()
+        else:
+            self.textEdit.clear()
+        self.evictBooks()
+
+    def closeBook(self, index):
+        table = self.bookTabs.widget(index)
+        if self.bookModified(table):
+            q = _("There are unsaved changes. Save them?")
+            buttonReply = QMessageBox.question(
+                self, _("Close"), q,
+                QMessageBox.Save | QMessageBox.Discard | QMessageBox.Cancel,
+                QMessageBox.Cancel)
+            if buttonReply == QMessageBox.Cancel:
+                return(0)
+            if buttonReply == QMessageBox.Save:
+                self.saveBook(table)
+        self.releaseBook(table)
+        path = table.book.path
+        if path in self.watcher.files() and \
+                [t.book.path for t in self.tables()].count(path) == 1:
+            self.watcher.removePath(path)
+        for action in table.filterActions:
+            self.filterToolBar.removeAction(action)
+        if table is self.tuneTable:
+            self.tuneTable = None
+        self.bookTabs.removeTab(index)
+        table.deleteLater()
+        if not self.bookTabs.count():
+            self.addBook(TuneBook())
+
+    def closeCurrentBook(self):
+        self.closeBook(self.bookTabs.currentIndex())
+
+    def releaseBook(self, table):
+        table.journal.clear()  # Nothing left to recover
+        table.journal.close()
+        self.stopLoader(table)
+        table.stopLinter()
+
+    def evictBooks(self):
+        ''' Frees the least recently shown tunebooks while the open ones
+        use more memory than the budget. Tunebooks with changes not saved
+        are kept. '''
+        tables = self.tables()
+        used = sum(t.memorySize() for t in tables)
+        for table in sorted(tables, key=lambda t: t.used):
+            if used <= self.memoryBudget:
+                break
+            if table is self.tuneTable or table.evicted or table.loader \
+                    or not table.book.path or self.bookModified(table):
+                continue
+            used -= table.memorySize()
+            table.evict()
+            self.logView.append(_("FREED: ") + table.book.path)
+
+    def bookModified(self, table):
+        if table is self.tuneTable:
+            return(self.isModified())
+        return(table.book.isModified() or table.draft is not None)
+
+    def saveBook(self, table):
+        if table is self.tuneTable:
+            self.save()
+            return(0)
+        if table.draft:
+            table.book.setTune(*table.draft)
+            table.draft = None
+        table.book.write()
+        table.journal.clear()
+        table.reloadTable()
+
     def closeEvent(self, event):
+        tables = [t for t in self.tables() if self.bookModified(t)]
+        if tables:
+            q = _("There are unsaved changes. Save them?")
+            buttonReply = QMessageBox.question(
+                self, _("Exit"), q,
+                QMessageBox.Save | QMessageBox.Discard | QMessageBox.Cancel,
+                QMessageBox.Cancel)
+            if buttonReply == QMessageBox.Cancel:
+                event.ignore()
+                return(0)
+            if buttonReply == QMessageBox.Save:
+                for table in tables:
+                    self.saveBook(table)
+        for table in self.tables():
+            self.releaseBook(table)
+        self.setList.close()
+        self.featureIndexer.shutdown()
+        self.renderPool.shutdown()
         self.midi.remove()
-        app.quit()
+        QApplication.quit()
+
+    def isModified(self):
+        if not self.tuneBook.tunes:
+            return(False)
+        text = self.textEdit.toPlainText()
+        return(self.tuneBook.isModified()
+               or text != self.tuneBook.tunes[self.tuneBook.index])
+
+    def flushJournals(self):
+        for table in self.tables():
+            table.journal.flush()
+
+    def journalEdit(self):
+        if self.tuneBook.tunes and not self.tuneTable.loader:
+            journal = self.tuneTable.journal
+            original = self.tuneBook.tunes[self.tuneBook.index]
+            text = self.textEdit.toPlainText()
+            if text != original or self.tuneBook.index in journal.latest:
+                journal.note(self.tuneBook.index, original, text)
+
+    def recoverJournal(self, table):
+        ''' Offers the edits left in the journal by a crash '''
+        book = table.book
+        entries = table.journal.read()
+        positions = {}
+        for pos, text in enumerate(book.tunes):
+            positions.setdefault(TuneJournal.crc(text), pos)
+        texts = []
+        for pos, (crc, text) in entries.items():
+            if pos >= len(book.tunes) or \
+                    TuneJournal.crc(book.tunes[pos]) != crc:
+                pos = positions.get(crc)  # Tune was moved
+            if pos is not None and text != book.tunes[pos]:
+                texts.append((pos, text))
+        if not texts:
+            table.journal.clear()
+            return(0)
+
+        q = _("Unsaved changes of") + " " + str(len(texts)) + " " \
+            + _("tunes were found from a previous session.\nRecover them?")
+        buttonReply = QMessageBox.question(self, _("Recover"), q,
+                                           QMessageBox.Yes | QMessageBox.No,
+                                           QMessageBox.Yes)
+        table.journal.clear()
+        if buttonReply == QMessageBox.No:
+            return(0)
+        for pos, text in texts:
+            table.journal.note(pos, book.tunes[pos], text)
+        book.edit(texts)
+        table.reloadTable()
+        if table is self.tuneTable:
+            self.showTune()
+            self.updateHistoryActions()
+        self.logView.append(_("RECOVERED: ") + str(len(texts)) + " "
+                            + _("tunes"))
 
     def openFile(self, f=None):
+        ''' Opens a tunebook in a new tab, or shows its tab if it is
+        already open '''
         if f:
             select = f
         else:
             select = QFileDialog.getOpenFileName(self, _("Open file"))[0]
 
         if select:
-            tuneBook.loadFile(select)
+            for n, table in enumerate(self.tables()):
+                if table.book.path and os.path.abspath(table.book.path) \
+                        == os.path.abspath(select):
+                    self.bookTabs.setCurrentIndex(n)
+                    return(0)
+            if self.tuneBook.path or self.tuneBook.tunes:
+                self.addBook(TuneBook())
+            self.loadBook(self.tuneTable, select)
+
+    def loadBook(self, table, path=None):
+        ''' Reads the file of a tunebook in background. Without path the
+        file is read again, keeping the current position. '''
+        book = table.book
+        index = 0 if path else book.index
+        path = path or book.path
+        self.stopLoader(table)
+        table.journal.close()
+        book.begin(path)
+        book.index = index
+        table.evicted = False
+        table.clearTable()
+        n = self.bookTabs.indexOf(table)
+        self.bookTabs.setTabText(n, os.path.basename(path))
+        self.bookTabs.setTabToolTip(n, path)
+        if path not in self.watcher.files():
+            self.watcher.addPath(path)
+        table.loadStart = time.perf_counter()
+        table.loader = TuneBookLoader(path, self)
+        table.loader.tunesLoaded.connect(
+            lambda tunes, headers: self.tunesLoaded(table, tunes, headers))
+        table.loader.finished.connect(lambda: self.loadFinished(table))
+        table.loader.start()
+
+    def stopLoader(self, table):
+        if table.loader:
+            table.loader.tunesLoaded.disconnect()
+            table.loader.finished.disconnect()
+            table.loader.requestInterruption()
+            table.loader.wait()
+            table.loader = None
+
+    def tunesLoaded(self, table, tunes, headers):
+        book = table.book
+        shown = book.index < len(book.tunes)
+        book.extend(tunes)
+        table.appendHeaders(headers)
+        if not shown and book.index < len(book.tunes) \
+                and table is self.tuneTable:
             self.showTune()
-            for i in tuneBook.tunes:
-                tuneBook.tunesSaved.append(i)
-            self.tuneTable.reloadTable()
-            if not self.toggleShowIndexAct.isChecked():
-                self.tuneTable.proxyView.setColumnHidden(0, True)
+
+    def loadFinished(self, table):
+        table.loader = None
+        book = table.book
+        book.finish()
+        if book.index >= book.ntunes:
+            book.index = max(book.ntunes - 1, 0)
+        table.estimateColumnWidths()
+        table.checkTunes()
+        table.journal.open(book.path)
+        if table is self.tuneTable:
+            self.updateHistoryActions()
+        self.recoverJournal(table)
+        ms = round((time.perf_counter() - table.loadStart) * 1000)
+        self.logView.append(_("LOADED: ") + str(book.ntunes) + " "
+                            + _("tunes in") + " " + str(ms) + " ms")
+        self.evictBooks()
+
+    def fileChanged(self, path):
+        self.changedFiles.add(path)
+        self.watcherTimer.start()
+
+    def syncFiles(self):
+        for table in self.tables():
+            path = table.book.path
+            if path not in self.changedFiles:
+                continue
+            if table.loader:  # Still loading, try later
+                self.watcherTimer.start()
+                continue
+            self.changedFiles.discard(path)
+            if not table.evicted:  # Else it is read when shown
+                self.syncFile(table)
+
+    def syncFile(self, table):
+        ''' Brings in the changes made to the tunebook file by other
+        programs, reloading only the tunes that changed '''
+        book = table.book
+        current = table is self.tuneTable
+        if not os.path.isfile(book.path):
+            self.logView.append(_("FILE REMOVED: ") + book.path)
+            return(0)
+        if book.path not in self.watcher.files():
+            self.watcher.addPath(book.path)  # File was replaced
+        if book.fileStamp() == book.stamp:  # Written by us
+            return(0)
+
+        if current:
+            text = self.textEdit.toPlainText()
+            edited = book.tunes and text != book.tunes[book.index]
+        else:
+            edited = table.draft is not None
+        if edited or book.isModified():
+            q = _("The tunebook was changed by another program.\n"
+                  "Reload it? Unsaved changes will be lost.") \
+                + "\n" + book.path
+            buttonReply = QMessageBox.question(self, _("Reload"), q,
+                                               QMessageBox.Yes | QMessageBox.No,
+                                               QMessageBox.No)
+            if buttonReply == QMessageBox.No:
+                book.stamp = book.fileStamp()  # Ask on next change
+                return(0)
+
+        shown = book.tunes[book.index] if book.tunes else None
+        splices = book.reread()
+        table.applySplices(splices)
+        table.draft = None
+        if current:
+            self.updateHistoryActions()
+            if edited or not book.tunes or shown != book.tunes[book.index]:
+                self.showTune()
+        self.logView.append(_("RELOADED: ") + str(sum(len(t) for s, e, t in splices))
+                            + " " + _("tunes changed by another program"))
+
+    def selectTune(self, pos):
+        self.tuneBook.index = pos
+        self.showTune()
 
     def showTune(self):
-        if tuneBook.tunes:
-            self.textEdit.setText(tuneBook.tunes[tuneBook.index])
+        if self.tuneBook.tunes:
+            text = self.tuneBook.tunes[self.tuneBook.index]
+            draft = self.tuneTable.draft
+            if draft and draft[0] == self.tuneBook.index:
+                text = draft[1]  # Edited before leaving the tab
+            self.tuneTable.draft = None
+            self.textEdit.setText(text)
             self.comboTempo.setCurrentIndex(0)
             self.transposeSpinBox.setValue(0)
             if not self.toggleAutorefreshAct.isChecked():
@@ -642,72 +2471,191 @@ class MainWindow(QMainWindow):
             self.updateInterface()
 
     def updateInterface(self):
-        tune = Tune()
-        tune.load(self.textEdit.toPlainText())
-        t = tune.getField('T:')
+        t = self.highlighter.field('T:')
         self.logView.append(_("SHOWING: ") + t)
         self.sliderZoom.setValue(0)
         self.updateStatus()
         self.updateTitle()
         self.updateSvg()
         self.updateMIDI()
+        self.updateRelated()
 
     def updateStatus(self):
-        tune = Tune()
-        tune.load(self.textEdit.toPlainText())
-        t = tune.getField('T:')
-        r = tune.getField('R:')
-        k = tune.getField('K:')
+        t = self.highlighter.field('T:')
+        r = self.highlighter.field('R:')
+        k = self.highlighter.field('K:')
         self.statusT.setText(t)
         self.statusK.setText(k)
         self.statusR.setText(r.title())
+        self.statusBars.setText(str(self.highlighter.bars()) + " "
+                                + _("bars"))
+        problems = self.highlighter.problems()
+        errors = len(self.highlighter.errors())
+        if errors:
+            self.statusLint.setText(str(errors) + " " + _("errors"))
+        elif problems:
+            self.statusLint.setText(str(len(problems)) + " " + _("warnings"))
+        else:
+            self.statusLint.setText('')
+
+    def updateRelated(self):
+        ''' Lists the tunes most similar to the one being edited '''
+        if not self.toggleShowRelatedAct.isChecked() \
+                or not self.tuneBook.tunes:
+            return(0)
+        self.relatedView.clear()
+        try:
+            vector = TuneFeatures.vector(self.textEdit.toPlainText())
+        except ImportError:
+            self.relatedView.addItem(_("Related tunes need NumPy"))
+            return(0)
+        table = self.tuneTable
+        self.featureIndexer.index(table)
+        tunes = self.tuneBook.tunes
+        for row, score in table.features.nearest(
+                tunes, vector, self.RELATED, exclude=self.tuneBook.index):
+            t, r, m, k = TuneBook.headers(tunes[row])
+            item = QListWidgetItem("%d%%  %s (%s, %s)"
+                                   % (round(100 * score), t, r, k))
+            item.setData(Qt.UserRole, row)
+            self.relatedView.addItem(item)
+        if table in self.featureIndexer.running:
+            self.relatedView.addItem(_("Comparing with more tunes..."))
+
+    def updateStatistics(self):
+        if not self.toggleShowStatisticsAct.isChecked():
+            return(0)
+        try:
+            report = self.tuneTable.statisticsReport()
+        except ImportError:
+            report = None
+            self.logView.append(_("Statistics need NumPy"))
+        self.statisticsView.showReport(report)
+
+    def relatedIndexed(self, table):
+        if table is self.tuneTable:
+            self.updateRelated()
+
+    def showRelated(self, item):
+        row = item.data(Qt.UserRole)
+        if row is not None:
+            self.tuneTable.showRow(row)
+
+    def memoryReport(self):
+        ''' Logs the memory used by the tunebook and the table compared
+        with the same data kept as strings '''
+        model = self.tuneTable.proxyModel.sourceModel()
+        parts = [(_("Tunes"), self.tuneBook.tunes.memory())]
+        if model is not None:
+            parts += [(title, column.memory()) for title, column
+                      in zip(model.titles[1:], model.columns)]
+        parts.append((_("Total"), (sum(p[1][0] for p in parts),
+                                   sum(p[1][1] for p in parts))))
+        for name, (used, plain) in parts:
+            self.logView.append(
+                _("MEMORY: ") + name + ": " + "%.1f KiB" % (used / 1024)
+                + " (" + _("as strings") + ": " + "%.1f KiB" % (plain / 1024)
+                + ", " + "%.1fx" % (plain / max(used, 1)) + ")")
+        tables = self.tables()
+        self.logView.append(
+            _("MEMORY: ") + _("Open tunebooks") + ": " + str(len(tables))
+            + ", " + "%.1f KiB" % (sum(t.memorySize() for t in tables) / 1024)
+            + " " + _("of") + " " + "%.1f KiB" % (self.memoryBudget / 1024))
+        cache = self.renderCache
+        self.logView.append(
+            _("MEMORY: ") + _("Render cache") + ": " + str(len(cache.items))
+            + " " + _("scores") + ", " + "%.1f KiB" % (cache.size / 1024)
+            + ", " + str(cache.hits) + " " + _("hits") + ", "
+            + str(cache.misses) + " " + _("misses"))
+
+    def renderReport(self):
+        ''' Logs the renders made by every engine and their times '''
+        for name, task, calls, failures, mean, slowest in self.render.report():
+            self.logView.append(
+                _("RENDER: ") + name + " " + task + ": " + str(calls) + " "
+                + _("calls") + ", " + str(failures) + " " + _("failed") + ", "
+                + "%.1f ms" % (mean * 1000) + " " + _("mean") + ", "
+                + "%.1f ms" % (slowest * 1000) + " " + _("slowest"))
 
     def updateTitle(self):
-        if self.textEdit.toPlainText() == tuneBook.tunes[tuneBook.index]:
+        if not self.tuneBook.tunes or \
+                self.textEdit.toPlainText() == self.tuneBook.tunes[self.tuneBook.index]:
             self.setWindowTitle(PROGRAM_NAME)
         else:
             self.setWindowTitle(PROGRAM_NAME + '*')
 
+    def logProblems(self):
+        ''' Logs the problems found by the linter. True if some is an error,
+        then the tune is not sent to abcm2ps nor abc2midi. '''
+        for line, severity, message in self.highlighter.problems():
+            if severity == AbcLinter.ERROR:
+                self.logView.append(_("ERROR") + " " + str(line) + ": "
+                                    + message)
+            else:
+                self.logView.append(_("WARNING") + " " + str(line) + ": "
+                                    + message)
+        return(bool(self.highlighter.errors()))
+
     def updateSvg(self):
-        buff = self.textEdit.toPlainText().encode()
-        svg = subprocess.run(
-            ('abcm2ps', '-q', '-g', '-', '-O', '-'),
-            input=buff, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        if svg.stderr:
-            self.logView.append(svg.stderr.decode())
+        if self.logProblems():
+            self.logView.append(_("SVG SKIPPED"))
+            return(0)
+        self.svgText = self.textEdit.toPlainText()
+        self.renderPool.svg(self.svgText, self.svgRendered)
+
+    def svgRendered(self, text, svg, messages):
+        if text != self.svgText:  # Tune changed while rendering
+            return(0)
+        if messages:
+            self.logView.append(messages)
         else:
             self.logView.append(_("SVG OK"))
-        self.svgWidget.load(svg.stdout)
+        if svg is None:
+            return(0)
+        self.createSvgWidget()
+        self.svgWidget.load(svg)
         self.svgFit(self.musicDock.width())
         self.svgWidget.setAutoFillBackground(True)
         self.svgWidget.setPalette(self.svgPalette)
 
+    def createSvgWidget(self):
+        if self.svgWidget is None:
+            from PyQt5.QtSvg import QSvgWidget
+            self.svgWidget = QSvgWidget()
+            self.svgPalette = self.svgWidget.palette()
+            self.svgPalette.setColor(self.svgWidget.backgroundRole(), Qt.white)
+            self.svgScroll.setWidget(self.svgWidget)
+
+    def createMediaPlayer(self):
+        if self.mediaPlayer is None:
+            from PyQt5.QtMultimedia import QMediaPlayer, QMediaPlaylist
+            self.mediaPlayer = QMediaPlayer()
+            self.playList = QMediaPlaylist()
+
     def svgFit(self, w):
+        if self.svgWidget is None:
+            return(0)
         hw = self.svgWidget.sizeHint().width()
         hh = self.svgWidget.sizeHint().height()
         h  = hh * w / hw
         self.svgWidget.resize(round(w), round(h))
 
     def exportMIDI(self):
-        outfile = self.midi.fileName()
-        buff = self.textEdit.toPlainText().encode()
-
-        if not self.comboTempo.currentIndex():
-            cmd = ('abc2midi', '-', '-silent', '-o', outfile)
-        else:
+        if self.highlighter.errors():
+            self.logView.append(_("MIDI SKIPPED"))
+            return(0)
+        tempo = None
+        if self.comboTempo.currentIndex():
             tempo = self.comboTempo.currentText()
-            cmd = ('abc2midi', '-', '-silent', '-Q', tempo, '-o', outfile)
-
-        midi = subprocess.run(cmd, input=buff, stderr=subprocess.PIPE)
-        if midi.stderr:
-            self.logView.append(midi.stderr.decode())
+        messages = self.render.midi(self.textEdit.toPlainText(),
+                                    self.midi.fileName(), tempo)
+        if messages:
+            self.logView.append(messages)
         else:
             self.logView.append(_("MIDI OK"))
 
     def exportMIDItoFile(self):
-        tune = Tune()
-        tune.load(self.textEdit.toPlainText())
-        defname = tune.getField('T:') + '.mid'
+        defname = self.highlighter.field('T:') + '.mid'
         select = QFileDialog.getSaveFileName(self, _("Export to MIDI file"),
                                              defname)[0]
         if select:
@@ -716,6 +2664,8 @@ class MainWindow(QMainWindow):
 
     def updateMIDI(self):
         if self.togglePlayAct.isChecked():
+            from PyQt5.QtMultimedia import QMediaContent, QMediaPlaylist
+            self.createMediaPlayer()
             self.exportMIDI()
             url = QUrl.fromLocalFile(self.midi.fileName())
             mediaContent = QMediaContent(url)
@@ -742,6 +2692,26 @@ class MainWindow(QMainWindow):
         else:
             self.logDock.hide()
 
+    def toggleShowSetList(self):
+        if self.toggleShowSetListAct.isChecked():
+            self.setListDock.show()
+        else:
+            self.setListDock.hide()
+
+    def toggleShowStatistics(self):
+        if self.toggleShowStatisticsAct.isChecked():
+            self.statisticsDock.show()
+            self.updateStatistics()
+        else:
+            self.statisticsDock.hide()
+
+    def toggleShowRelated(self):
+        if self.toggleShowRelatedAct.isChecked():
+            self.relatedDock.show()
+            self.updateRelated()
+        else:
+            self.relatedDock.hide()
+
     def toggleShowTable(self):
         if self.toggleShowTableAct.isChecked():
             self.tableDock.show()
@@ -767,24 +2737,45 @@ class MainWindow(QMainWindow):
             self.helpMenu.setTearOffEnabled(False)
 
     def toggleShowIndex(self, coln):
-        if self.toggleShowIndexAct.isChecked():
-            self.tuneTable.proxyView.setColumnHidden(0, False)
+        for table in self.tables():
+            table.proxyView.setColumnHidden(
+                0, not self.toggleShowIndexAct.isChecked())
+
+    def stopTune(self):
+        ''' Leaves the player to the set list '''
+        self.togglePlayAct.setChecked(False)
+        if self.mediaPlayer:
+            self.mediaPlayer.stop()
+
+    def addToSetList(self):
+        ''' Queues the selected tunes, or the one being edited '''
+        rows = self.tuneTable.selectedRows()
+        if len(rows) > 1:
+            texts = [self.tuneBook.tunes[row] for row in rows]
+        elif self.tuneBook.tunes:
+            texts = [self.textEdit.toPlainText()]
         else:
-            self.tuneTable.proxyView.setColumnHidden(0, True)
+            return(0)
+        for text in texts:
+            self.setList.addTune(text, TuneBook.headers(text, ('T:',))[0])
+        self.toggleShowSetListAct.setChecked(True)
+        self.setListDock.show()
 
     def togglePlay(self):
         if self.togglePlayAct.isChecked():
             self.updateMIDI()
             self.mediaPlayer.stop()
             self.mediaPlayer.play()
-        else:
+        elif self.mediaPlayer:
             self.mediaPlayer.stop()
 
     def save(self):
         ''' Copy current text to tunebook tune and write tunebook to disk.
         If tunebook was reindexed or reordered, it will save such changes.'''
-        tuneBook.save(self.textEdit.toPlainText())
+        self.tuneBook.save(self.textEdit.toPlainText())
+        self.tuneTable.journal.clear()
         self.updateTitle()
+        self.updateHistoryActions()
         oldindex = self.tuneTable.proxyView.currentIndex().row()
         self.tuneTable.reloadTable()
         self.tuneTable.proxyView.setCurrentIndex(self.tuneTable.proxyView.model().index(max(oldindex, 0), 0))
@@ -798,27 +2789,51 @@ class MainWindow(QMainWindow):
         if buttonReply == QMessageBox.No:
             return(0)
         else:
-            tuneBook.restore()
+            self.tuneBook.restore()
             self.tuneTable.reloadTable()
             self.showTune()
+            self.updateHistoryActions()
 
     def reindex(self):
-        tuneBook.reindex()
+        self.tuneBook.reindex()
         self.showTune()
+        self.updateHistoryActions()
+
+    def undo(self):
+        self.tuneBook.undo()
+        self.historyChanged()
+
+    def redo(self):
+        self.tuneBook.redo()
+        self.historyChanged()
+
+    def historyChanged(self):
+        self.tuneTable.reloadTable()
+        self.showTune()
+        self.updateHistoryActions()
+
+    def updateHistoryActions(self):
+        self.undoAct.setEnabled(bool(self.tuneBook.undoStack))
+        self.redoAct.setEnabled(bool(self.tuneBook.redoStack))
+        if self.batchEditForm is not None:
+            self.batchEditForm.btnUndo.setEnabled(self.canRevertTunes())
 
     def sort(self):
-        tuneBook.sort()
+        self.tuneBook.sort()
         self.tuneTable.reloadTable()
         self.showTune()
+        self.updateHistoryActions()
 
     def transpose(self):
         semitones = self.transposeSpinBox.value()
-        tune = Tune()
-        tune.load(self.textEdit.toPlainText())
-        tune.transpose(semitones)
+        tune = Tune(self.textEdit.toPlainText(),
+                    self.tuneBook.tunes[self.tuneBook.index])
+        tune.transpose(semitones, self.render)
         self.textEdit.setText(tune.text)
 
     def svgZoom(self):
+        if self.svgWidget is None:
+            return(0)
         perc = self.sliderZoom.value()
         w = self.svgWidget.sizeHint().width()
         h = self.svgWidget.sizeHint().height()
@@ -839,31 +2854,170 @@ class MainWindow(QMainWindow):
         self.textEdit.clearFocus()
         self.copyTuneAct.setEnabled(not self.isCopied())
 
+    def acceptTune(self, tune, insert):
+        if insert:
+            self.insertTune(tune)
+        else:
+            self.addTune(tune)
+
     def addTune(self, tune):
-        tuneBook.add(tune)
+        self.tuneBook.add(tune)
         self.tuneTable.reloadTable()
+        self.updateHistoryActions()
 
     def insertTune(self, tune):
         pos = self.tuneTable.proxyView.currentIndex().row()
-        tuneBook.insert(pos, tune)
+        self.tuneBook.insert(pos, tune)
         self.tuneTable.reloadTable()
+        self.updateHistoryActions()
         self.tuneTable.proxyView.setCurrentIndex(self.tuneTable.proxyView.model().index(max(pos, 0), 0))
 
     def removeTune(self):
-        if tuneBook.ntunes:
+        if self.tuneBook.ntunes:
             row = self.tuneTable.proxyView.currentIndex().row()
             column = 0
             pos = self.tuneTable.getTableViewValue(row, column, self.tuneTable.proxyView)
-            tuneBook.remove(pos)
+            self.tuneBook.remove(pos)
             self.tuneTable.reloadTable()
+            self.updateHistoryActions()
             self.tuneTable.proxyView.setCurrentIndex(self.tuneTable.proxyView.model().index(max(row - 1, 0), 0))
             self.showTune()
 
+    def dropTunes(self, view, target, rows, move):
+        for source in self.tables():
+            if source.proxyView is view:
+                self.transferTunes(source, target, rows, move)
+
+    def copyTunesTo(self):
+        self.chooseTransfer(False)
+
+    def moveTunesTo(self):
+        self.chooseTransfer(True)
+
+    def chooseTransfer(self, move):
+        ''' Asks where the selected tunes go: other open tunebook or a file,
+        that is not read but appended '''
+        rows = self.tuneTable.selectedRows()
+        if not rows:
+            return(0)
+        targets = [t for t in self.tables() if t is not self.tuneTable]
+        names = [self.bookTabs.tabText(self.bookTabs.indexOf(t))
+                 for t in targets] + [_("Other file...")]
+        title = _("Move tunes") if move else _("Copy tunes")
+        name, ok = QInputDialog.getItem(
+            self, title, str(len(rows)) + " " + _("tunes to:"), names, 0,
+            False)
+        if not ok:
+            return(0)
+        if name in names[:-1]:
+            target = targets[names.index(name)]
+        else:
+            target = QFileDialog.getSaveFileName(
+                self, title, '', '', '', QFileDialog.DontConfirmOverwrite)[0]
+            if not target:
+                return(0)
+            if self.tuneBook.path and os.path.abspath(self.tuneBook.path) \
+                    == os.path.abspath(target):
+                QMessageBox.warning(self, title,
+                                    _("The tunes are in this tunebook yet"))
+                return(0)
+            for table in targets:  # Open yet
+                if table.book.path and os.path.abspath(table.book.path) \
+                        == os.path.abspath(target):
+                    target = table
+        self.transferTunes(self.tuneTable, target, rows, move)
+
+    def transferTunes(self, source, target, rows, move=False):
+        ''' Copies or moves tunes to other tab or appends them to a file,
+        renumbering them when their X: is used there '''
+        if not rows:
+            return(0)
+        if source is self.tuneTable:  # Keep the text being edited
+            self.tuneBook.setTune(self.tuneBook.index,
+                                  self.textEdit.toPlainText())
+        if isinstance(target, TuneTable) and (target.evicted or target.loader):
+            target = target.book.path  # Not read, so it can be appended
+        start = time.perf_counter()
+        if isinstance(target, TuneTable):
+            first = target.book.ntunes
+            target.book.merge(source.book.tunes, rows)
+            target.appendHeaders([TuneBook.headers(i)
+                                  for i in target.book.tunes[first:]])
+            target.checkTunes()
+            name = self.bookTabs.tabText(self.bookTabs.indexOf(target))
+        else:
+            try:
+                TuneBook.appendTo(target, source.book.tunes, rows)
+            except OSError:
+                print("I can't write the tunebook file")
+                return(0)
+            name = target
+        if move:
+            source.book.removeRows(rows)
+            source.reloadTable()
+        ms = round((time.perf_counter() - start) * 1000)
+        self.logView.append((_("MOVED: ") if move else _("COPIED: "))
+                            + str(len(rows)) + " " + _("tunes to") + " "
+                            + name + " " + _("in") + " " + str(ms) + " ms")
+        self.updateHistoryActions()
+        if move and source is self.tuneTable:
+            self.showTune()
+
     def showNewTuneForm(self):
-        formWin.show()
+        if self.newTuneForm is None:
+            self.newTuneForm = NewTuneForm()
+            self.newTuneForm.tuneAccepted.connect(self.acceptTune)
+        self.newTuneForm.show()
+
+    def showBatchEditForm(self):
+        if self.batchEditForm is None:
+            self.batchEditForm = BatchEditForm(self)
+        self.batchEditForm.show()
+
+    def rewriteTunes(self, rules, rows=None):
+        ''' Applies field rules to tunes and saves the tunebook once.
+        The rewrite is one operation of the tunebook history, which
+        revertTunes() undoes while no other operation follows it. '''
+        if not self.tuneBook.tunes:
+            return([])
+        self.tuneBook.setTune(self.tuneBook.index, self.textEdit.toPlainText())
+        changes = list(self.tuneBook.rewrite(rules, rows))
+        self.tuneBook.applyChanges(changes)
+        if changes:
+            self.rewritten = self.tuneBook.undoStack[-1]
+            self.saveRewrite(len(changes))
+        return(changes)
+
+    def canRevertTunes(self):
+        return(self.rewritten is not None and bool(self.tuneBook.undoStack)
+               and self.tuneBook.undoStack[-1] is self.rewritten)
+
+    def revertTunes(self):
+        ''' Undoes the last batch rewrite. Returns the number of tunes
+        restored, 0 if the tunebook or the tune being edited changed
+        since then. '''
+        if not self.canRevertTunes() or self.textEdit.toPlainText() \
+                != self.tuneBook.tunes[self.tuneBook.index]:
+            self.rewritten = None
+            self.updateHistoryActions()
+            return(0)
+        n = len(self.rewritten[1])
+        self.rewritten = None
+        self.tuneBook.undo()
+        self.saveRewrite(n)
+        return(n)
+
+    def saveRewrite(self, n):
+        self.tuneBook.write()
+        self.tuneTable.reloadTable()
+        self.updateHistoryActions()
+        self.showTune()
+        self.logView.append(_("REWRITTEN: ") + str(n) + " " + _("tunes"))
 
     def showAbout(self):
-        aboutDialog.show()
+        if self.aboutDialog is None:
+            self.aboutDialog = AboutDialog()
+        self.aboutDialog.show()
 
     def createActions(self):
         self.openFileAct = QAction(QIcon.fromTheme('document-open'),
@@ -872,10 +3026,16 @@ class MainWindow(QMainWindow):
                                    statusTip=_("Open a tune file"),
                                    triggered=self.openFile)
 
+        self.closeBookAct = QAction(QIcon.fromTheme('document-close'),
+                                    _("&Close"),
+                                    self, shortcut=QKeySequence.Close,
+                                    statusTip=_("Close the tunebook"),
+                                    triggered=self.closeCurrentBook)
+
         self.exitAct = QAction(QIcon.fromTheme('window-close'), _("E&xit"),
                                self, shortcut=QKeySequence.Quit,
                                statusTip=_("Exit the application"),
-                               triggered=self.closeEvent)
+                               triggered=self.close)
 
         self.copyTuneAct = QAction(QIcon.fromTheme('edit-copy'),
                                    _("&Copy"),
@@ -883,6 +3043,24 @@ class MainWindow(QMainWindow):
                                    statusTip=_("Copy tune to the clipboard"),
                                    triggered=self.copyTune)
 
+        self.addToSetListAct = QAction(QIcon.fromTheme('media-playlist-append'),
+                                       _("Add to &set list"),
+                                       self, shortcut='Ctrl+L',
+                                       statusTip=_("Queue the selected tunes to play them in a row"),
+                                       triggered=self.addToSetList)
+
+        self.copyTunesToAct = QAction(QIcon.fromTheme('edit-copy'),
+                                      _("Copy &to..."),
+                                      self, shortcut='Ctrl+Alt+C',
+                                      statusTip=_("Copy the selected tunes to other tunebook"),
+                                      triggered=self.copyTunesTo)
+
+        self.moveTunesToAct = QAction(QIcon.fromTheme('edit-cut'),
+                                      _("&Move to..."),
+                                      self, shortcut='Ctrl+Alt+M',
+                                      statusTip=_("Move the selected tunes to other tunebook"),
+                                      triggered=self.moveTunesTo)
+
         self.showAboutAct = QAction(QIcon.fromTheme(EXECUTABLE_NAME),
                                     _("&About") + " " + PROGRAM_NAME, self,
                                     statusTip=_("Information about"
@@ -926,6 +3104,27 @@ class MainWindow(QMainWindow):
                                         triggered=self.toggleShowLog)
         self.toggleShowLogAct.setCheckable(True)
 
+        self.toggleShowSetListAct = QAction(QIcon.fromTheme('view-media-playlist'),
+                                            _("Show set &list"),
+                                            self, shortcut='F7',
+                                            statusTip=_("View set list"),
+                                            triggered=self.toggleShowSetList)
+        self.toggleShowSetListAct.setCheckable(True)
+
+        self.toggleShowRelatedAct = QAction(QIcon.fromTheme('edit-find'),
+                                            _("Show &related tunes"),
+                                            self, shortcut='F8',
+                                            statusTip=_("View the tunes most similar to this one"),
+                                            triggered=self.toggleShowRelated)
+        self.toggleShowRelatedAct.setCheckable(True)
+
+        self.toggleShowStatisticsAct = QAction(QIcon.fromTheme('view-statistics'),
+                                               _("Show s&tatistics"),
+                                               self, shortcut='F9',
+                                               statusTip=_("View statistics of the tunebook"),
+                                               triggered=self.toggleShowStatistics)
+        self.toggleShowStatisticsAct.setCheckable(True)
+
         self.toggleHideToolbarAct = QAction(QIcon.fromTheme('configure-toolbars'),
                                             _("&Hide toolbar"),
                                             self, shortcut='Ctrl+T',
@@ -952,12 +3151,44 @@ class MainWindow(QMainWindow):
                                   statusTip=_("Reformat indices"),
                                   triggered=self.reindex)
 
+        self.batchEditAct = QAction(QIcon.fromTheme('document-edit'),
+                                    _("&Batch edit"),
+                                    self, shortcut='Ctrl+Alt+B',
+                                    statusTip=_("Rewrite fields of many tunes"),
+                                    triggered=self.showBatchEditForm)
+
+        self.memoryReportAct = QAction(QIcon.fromTheme('memory'),
+                                       _("&Memory report"),
+                                       self,
+                                       statusTip=_("Log the memory used by the tunebook"),
+                                       triggered=self.memoryReport)
+
+        self.renderReportAct = QAction(QIcon.fromTheme('chronometer'),
+                                       _("Render &timings"),
+                                       self,
+                                       statusTip=_("Log how long every render engine takes"),
+                                       triggered=self.renderReport)
+
         self.sortAct = QAction(QIcon.fromTheme('sort-name'),
                                _("&Sort"),
                                self, shortcut='Ctrl+J',
                                statusTip=_("Sort by title"),
                                triggered=self.sort)
 
+        self.undoAct = QAction(QIcon.fromTheme('edit-undo'),
+                               _("&Undo"),
+                               self, shortcut='Ctrl+Alt+Z',
+                               statusTip=_("Undo last tunebook change"),
+                               triggered=self.undo)
+        self.undoAct.setEnabled(False)
+
+        self.redoAct = QAction(QIcon.fromTheme('edit-redo'),
+                               _("Re&do"),
+                               self, shortcut='Ctrl+Alt+Shift+Z',
+                               statusTip=_("Redo last undone tunebook change"),
+                               triggered=self.redo)
+        self.redoAct.setEnabled(False)
+
         self.restoreAct = QAction(QIcon.fromTheme('restoration'),
                                   _("&Restore"),
                                   self, shortcut='Ctrl+Alt+R',
@@ -1012,11 +3243,17 @@ class MainWindow(QMainWindow):
     def createMenus(self):
         self.tunebookMenu = self.menuBar().addMenu(_("&Tunebook"))
         self.tunebookMenu.addAction(self.openFileAct)
+        self.tunebookMenu.addAction(self.closeBookAct)
         self.tunebookMenu.addAction(self.addTuneAct)
         self.tunebookMenu.addSeparator()
         self.tunebookMenu.addAction(self.reindexAct)
         self.tunebookMenu.addAction(self.sortAct)
+        self.tunebookMenu.addAction(self.batchEditAct)
+        self.tunebookMenu.addAction(self.memoryReportAct)
+        self.tunebookMenu.addAction(self.renderReportAct)
         self.tunebookMenu.addSeparator()
+        self.tunebookMenu.addAction(self.undoAct)
+        self.tunebookMenu.addAction(self.redoAct)
         self.tunebookMenu.addAction(self.restoreAct)
         self.tunebookMenu.addAction(self.saveAct)
         self.tunebookMenu.addSeparator()
@@ -1028,7 +3265,10 @@ class MainWindow(QMainWindow):
         self.tuneMenu.addSeparator()
         self.tuneMenu.addAction(self.copyTuneAct)
         self.tuneMenu.addAction(self.removeTuneAct)
+        self.tuneMenu.addAction(self.copyTunesToAct)
+        self.tuneMenu.addAction(self.moveTunesToAct)
         self.tuneMenu.addSeparator()
+        self.tuneMenu.addAction(self.addToSetListAct)
         self.tuneMenu.addAction(self.exportMIDIAct)
 
         self.viewMenu = self.menuBar().addMenu(_("View"))
@@ -1036,6 +3276,9 @@ class MainWindow(QMainWindow):
         self.viewMenu.addAction(self.toggleShowCodeAct)
         self.viewMenu.addAction(self.toggleShowSheetAct)
         self.viewMenu.addAction(self.toggleShowLogAct)
+        self.viewMenu.addAction(self.toggleShowSetListAct)
+        self.viewMenu.addAction(self.toggleShowRelatedAct)
+        self.viewMenu.addAction(self.toggleShowStatisticsAct)
         self.viewMenu.addSeparator()
         self.viewMenu.addAction(self.toggleShowIndexAct)
         self.viewMenu.addAction(self.toggleTearOffAct)
@@ -1060,24 +3303,18 @@ class MainWindow(QMainWindow):
         self.playToolBar.addSeparator()
         self.playToolBar.addWidget(self.sliderZoom)
 
-        self.filterToolBar = self.addToolBar(_("Filter"))
-        self.filterToolBar.addWidget(self.tuneTable.filterPatternLabel)
-        self.filterToolBar.addWidget(self.tuneTable.filterPatternLineEdit)
-        self.filterToolBar.addSeparator()
-        self.filterToolBar.addWidget(self.tuneTable.filterColumnComboBox)
-        self.filterToolBar.addSeparator()
-        self.filterToolBar.addWidget(self.tuneTable.filterSyntaxComboBox)
-        self.filterToolBar.addSeparator()
-        self.filterToolBar.addWidget(self.tuneTable.filterCaseSensitivityCheckBox)
+        self.filterToolBar = self.addToolBar(_("Filter"))  # Set by addBook()
 
     def createStatusBar(self):
         self.statusBar().addWidget(self.statusT, Qt.AlignLeft)
         self.statusBar().addWidget(self.statusK, Qt.AlignRight)
         self.statusBar().addWidget(self.statusR, Qt.AlignRight)
+        self.statusBar().addWidget(self.statusBars, Qt.AlignRight)
+        self.statusBar().addWidget(self.statusLint, Qt.AlignRight)
 
     def createDockWindows(self):
         self.tableDock = QDockWidget(_("Tunes"), self)
-        self.tableDock.setWidget(self.tuneTable)
+        self.tableDock.setWidget(self.bookTabs)
         self.addDockWidget(Qt.LeftDockWidgetArea, self.tableDock)
 
         self.logDock = QDockWidget(_("Log"), self)
@@ -1085,6 +3322,21 @@ class MainWindow(QMainWindow):
         self.addDockWidget(Qt.LeftDockWidgetArea, self.logDock)
         self.logDock.hide()
 
+        self.setListDock = QDockWidget(_("Set list"), self)
+        self.setListDock.setWidget(self.setList)
+        self.addDockWidget(Qt.LeftDockWidgetArea, self.setListDock)
+        self.setListDock.hide()
+
+        self.relatedDock = QDockWidget(_("Related tunes"), self)
+        self.relatedDock.setWidget(self.relatedView)
+        self.addDockWidget(Qt.LeftDockWidgetArea, self.relatedDock)
+        self.relatedDock.hide()
+
+        self.statisticsDock = QDockWidget(_("Statistics"), self)
+        self.statisticsDock.setWidget(self.statisticsView)
+        self.addDockWidget(Qt.RightDockWidgetArea, self.statisticsDock)
+        self.statisticsDock.hide()
+
         self.musicDock = SvgView(_("Music score"), self)
         self.musicDock.setWidget(self.svgScroll)
         self.addDockWidget(Qt.RightDockWidgetArea, self.musicDock)
@@ -1096,23 +3348,27 @@ class MainWindow(QMainWindow):
     def readSettings(self):
         settings = QSettings(PROGRAM_NAME, _("Settings"))
         size = settings.value("size", QSize(1280, 720))
+        # Megabytes of tunebooks kept open before freeing the hidden ones
+        self.memoryBudget = settings.value("memoryBudget", 256, type=int) \
+            * 1024 * 1024
         self.setWindowTitle(PROGRAM_NAME)
         self.setWindowIcon(QIcon.fromTheme(EXECUTABLE_NAME))
         self.resize(size)
 
 class SvgView(QDockWidget):
     def resizeEvent(self, QResizeEvent):
-        mainWindow.sliderZoom.setValue(0)
-        mainWindow.svgFit(self.width())
+        self.parent().sliderZoom.setValue(0)
+        self.parent().svgFit(self.width())
 
 if __name__ == '__main__':
 
-    import sys
+    if sys.argv[1:2] == ['serve']:
+        from qabcserve import main
+        sys.exit(main(sys.argv[2:]))
 
+    RenderService.loadPlugins()
     app = QApplication(sys.argv)
-    tuneBook = TuneBook()
-    mainWindow = MainWindow()
-    aboutDialog = AboutDialog()
-    formWin = NewTuneForm()
+    mainWindow = MainWindow(TuneBook())
     mainWindow.show()
+    QTimer.singleShot(0, mainWindow.openArgFile)
     sys.exit(app.exec_())
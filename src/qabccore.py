@@ -0,0 +1,1574 @@
+#!/usr/bin/python3
+''' Core of qabc: tunebooks, tunes, the abc linter and the render
+engines. It does not use Qt, and its only global state is the list of
+registered render engines, so it can be imported by headless tools.
+
+Thread safety: a TuneBook is changed only by the thread owning it. Other
+threads and processes read snapshot() copies of its tunes, which never
+change, because TuneStore buffers are only appended. Tune and AbcLinter
+keep no shared state, and RenderService locks its timings, so any thread
+can use them. '''
+
+import collections
+import csv
+import difflib
+import gettext
+import hashlib
+import importlib.util
+import json
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+from array import array
+from fractions import Fraction
+
+_ = gettext.translation("qabc", localedir="/usr/share/locale",
+                        fallback=True).gettext
+
+
+class TuneStore():
+    ''' Compact list of tune texts. Texts are kept as UTF-8 slices of a
+    few big buffers, located by offset arrays, and are decoded when they
+    are read. Edited texts are added as new slices, so copies of a store
+    share all its buffers and only copy their array of references. '''
+
+    def __init__(self, texts=()):
+        self.buffers = []  # Shared and only appended
+        self.slices = (array('i'), array('q'), array('q'))  # Buffer, start, end
+        self.refs = array('i')  # Slice of every tune
+        self.extend(texts)
+
+    def add(self, texts):
+        ''' Stores texts in a new buffer. Returns the first new slice. '''
+        first = len(self.slices[0])
+        data = [t.encode() for t in texts]
+        if not data:
+            return(first)
+        buffers, starts, ends = self.slices
+        number = len(self.buffers)
+        offset = 0
+        for d in data:
+            buffers.append(number)
+            starts.append(offset)
+            offset += len(d)
+            ends.append(offset)
+        self.buffers.append(b''.join(data))
+        return(first)
+
+    def extend(self, texts):
+        texts = list(texts)
+        first = self.add(texts)
+        self.refs.extend(range(first, first + len(texts)))
+
+    def text(self, ref):
+        buffers, starts, ends = self.slices
+        return(self.buffers[buffers[ref]][starts[ref]:ends[ref]].decode())
+
+    @staticmethod
+    def parseNumber(value):
+        ''' Number of the bytes after X:, which may end with a comment,
+        None if it is not a number '''
+        try:
+            return(int(value.split(b'%')[0]))
+        except ValueError:
+            return(None)
+
+    def number(self, ref):
+        ''' Number in the X: line of a tune, None if it has not one '''
+        buffers, starts, ends = self.slices
+        data, start, end = self.buffers[buffers[ref]], starts[ref], ends[ref]
+        if data[start:start + 2] != b'X:':
+            return(None)
+        eol = data.find(b'\n', start, end)
+        return(self.parseNumber(data[start + 2:end if eol < 0 else eol]))
+
+    def pieces(self, ref, number=None):
+        ''' UTF-8 bytes of a tune as views of its buffer, without copying
+        them. With a number, the number of the X: line is replaced, and
+        its comment kept. '''
+        buffers, starts, ends = self.slices
+        data, start, end = self.buffers[buffers[ref]], starts[ref], ends[ref]
+        view = memoryview(data)
+        if number is None or data[start:start + 2] != b'X:':
+            return((view[start:end],))
+        eol = data.find(b'\n', start, end)
+        eol = end if eol < 0 else eol
+        comment = data.find(b'%', start, eol)
+        if comment < 0:
+            return((b'X:%d' % number, view[eol:end]))
+        return((b'X:%d ' % number, view[comment:end]))
+
+    def addFrom(self, other, refs, numbers=None):
+        ''' Stores tunes of other store in a single new buffer, renumbered
+        with numbers if given. Returns the new slices. '''
+        buffers, starts, ends = self.slices
+        first = len(buffers)
+        data = []
+        offset = 0
+        for n, ref in enumerate(refs):
+            buffers.append(len(self.buffers))
+            starts.append(offset)
+            for piece in other.pieces(ref, numbers and numbers[n]):
+                data.append(piece)
+                offset += len(piece)
+            ends.append(offset)
+        self.buffers.append(b''.join(data))
+        return(array('i', range(first, len(buffers))))
+
+    def writeTo(self, f, refs=None):
+        ''' Writes tunes to a binary file straight from the buffers '''
+        for ref in self.refs if refs is None else refs:
+            f.writelines(self.pieces(ref))
+            f.write(b'\n')
+
+    def __len__(self):
+        return(len(self.refs))
+
+    def __iter__(self):
+        for ref in self.refs:
+            yield self.text(ref)
+
+    def __getitem__(self, n):
+        if isinstance(n, slice):
+            return([self.text(ref) for ref in self.refs[n]])
+        return(self.text(self.refs[n]))
+
+    def __setitem__(self, n, text):
+        if isinstance(n, slice):
+            texts = list(text)
+            first = self.add(texts)
+            self.refs[n] = array('i', range(first, first + len(texts)))
+        else:
+            self.refs[n] = self.add((text,))
+
+    def __eq__(self, other):
+        if len(self) != len(other):
+            return(False)
+        if isinstance(other, TuneStore) and other.slices is self.slices:
+            if self.refs == other.refs:
+                return(True)
+            return(all(a == b or self.text(a) == self.text(b)
+                       for a, b in zip(self.refs, other.refs)))
+        return(all(a == b for a, b in zip(self, other)))
+
+    def insert(self, pos, text):
+        self.refs.insert(pos, self.add((text,)))
+
+    def pop(self, pos=-1):
+        return(self.text(self.refs.pop(pos)))
+
+    def copy(self):
+        aux = TuneStore()
+        aux.buffers = self.buffers
+        aux.slices = self.slices
+        aux.refs = array('i', self.refs)
+        return(aux)
+
+    def permute(self, order):
+        ''' Reorders tunes, the new ones being the old ones in order '''
+        refs = self.refs
+        self.refs = array('i', (refs[i] for i in order))
+
+    def unpermute(self, order):
+        ''' Reverts permute(order) '''
+        refs = array('i', self.refs)
+        for new, old in enumerate(order):
+            refs[old] = self.refs[new]
+        self.refs = refs
+
+    def pack(self):
+        ''' Moves the texts to a single buffer, dropping the ones no longer
+        referenced. Copies of the store are not changed. '''
+        old, (buffers, starts, ends) = self.buffers, self.slices
+        data = [old[buffers[r]][starts[r]:ends[r]] for r in self.refs]
+        self.slices = (array('i', [0]) * len(data), array('q'), array('q'))
+        offset = 0
+        for d in data:
+            self.slices[1].append(offset)
+            offset += len(d)
+            self.slices[2].append(offset)
+        self.buffers = [b''.join(data)]
+        self.refs = array('i', range(len(data)))
+
+    def size(self):
+        ''' Bytes used by the store '''
+        return(sum(sys.getsizeof(i) for i in self.buffers)
+               + sum(sys.getsizeof(i) for i in self.slices)
+               + sys.getsizeof(self.refs))
+
+    def memory(self):
+        ''' Bytes used by the store and bytes the same texts would use as
+        a list of strings '''
+        used = self.size()
+        plain = sys.getsizeof([None] * len(self)) \
+            + sum(sys.getsizeof(i) for i in self)
+        return(used, plain)
+
+
+class TuneBook():
+    def __init__(self):
+        self.tunes = TuneStore()
+        self.index = 0
+        self.path = None
+        self.clearHistory()
+
+    def loadFile(self, path):
+        ''' Adds a tune file to the tunes DB '''
+        if not path:
+            return(0)
+        if not os.path.isfile(path):
+            return(1)
+
+        self.path = path
+        self.tunes = TuneStore()  # Database containing all tunes
+        self.tunesSaved = TuneStore()
+        self.clearHistory()
+        self.stamp = self.fileStamp()
+
+        try:
+            with open(self.path, "r") as f:
+                text = f.read()
+        except:
+            text = None
+
+        if text:
+            self.tunes = TuneStore(self.split(text.split('\n')))
+            self.ntunes = len(self.tunes)
+            # list.copy() is like list[:]
+            self.backup = self.tunes.copy()  # Backup tunebook for restore().
+
+    @staticmethod
+    def split(lines):
+        ''' Yields the text of every tune found in an iterable of lines '''
+        aux = []
+        for line in lines:
+            line = line.rstrip('\n')
+            if line.startswith('X:'):
+                if aux:
+                    yield '\n'.join(aux)
+                    aux = []
+            if line:
+                aux.append(line)
+        if aux:
+            yield '\n'.join(aux)  # Add last
+
+    @staticmethod
+    def headers(text, keys=('T:', 'R:', 'M:', 'K:')):
+        ''' Returns the values of the first lines starting with keys,
+        in one pass and with the same rules as Tune.getField() '''
+        values = dict.fromkeys(keys, '')
+        left = set(keys)
+        for line in text.split('\n'):
+            key = line[:2]
+            if key in left:
+                v = line.split(':')[1]
+                if '%' in v:
+                    v = v.split('%')[0]
+                values[key] = v.strip()
+                left.discard(key)
+                if not left:
+                    break
+        return(tuple(values[k] for k in keys))
+
+    @staticmethod
+    def normalize(key, value):
+        ''' Spelling used to index and query the value of a header field,
+        so "Reel" is "reel" and "D major" is "d" '''
+        value = value.lower().replace(' ', '')
+        if key == 'K:':
+            for long, short in (('major', ''), ('minor', 'm'), ('maj', ''),
+                                ('min', 'm'), ('ionian', ''), ('aeolian', 'm'),
+                                ('dorian', 'dor'), ('phrygian', 'phr'),
+                                ('lydian', 'lyd'), ('mixolydian', 'mix'),
+                                ('locrian', 'loc')):
+                if value[1:].startswith(long) or value[2:].startswith(long):
+                    value = value.replace(long, short, 1)
+                    break
+        return(value)
+
+    def begin(self, path):
+        ''' Empties the tunebook before a progressive load of path '''
+        self.path = path
+        self.tunes = TuneStore()
+        self.tunesSaved = TuneStore()
+        self.backup = TuneStore()
+        self.index = 0
+        self.ntunes = 0
+        self.clearHistory()
+        self.stamp = self.fileStamp()
+
+    def extend(self, tunes):
+        ''' Appends tunes coming from a progressive load '''
+        self.tunes.extend(tunes)
+        self.ntunes = len(self.tunes)
+
+    def finish(self):
+        ''' Takes the backup when a progressive load is done '''
+        self.tunes.pack()  # One buffer instead of one by batch
+        self.backup = self.tunes.copy()
+        self.tunesSaved = self.tunes.copy()
+
+    def save(self, text):
+        self.setTune(self.index, text)
+        self.write()
+
+    def write(self):
+        ''' Writes the whole tunebook to disk with a single write '''
+        try:
+            with open(self.path, "wb") as f:
+                self.tunes.writeTo(f)
+        except:
+            print("I can't save the tunebook file")
+
+        self.tunesSaved = self.tunes.copy()
+        self.stamp = self.fileStamp()
+
+    def fileStamp(self):
+        ''' Modification time and size of the file, to notice changes
+        made by other programs '''
+        try:
+            st = os.stat(self.path)
+        except (OSError, TypeError):
+            return(None)
+        return((st.st_mtime_ns, st.st_size))
+
+    def isModified(self):
+        return(self.tunes != self.tunesSaved)
+
+    def unload(self):
+        ''' Frees the tunes, keeping the path and the current position '''
+        index = self.index
+        self.begin(self.path)
+        self.index = index
+
+    def snapshot(self):
+        ''' Copy of the tunes that other threads can read while this
+        tunebook changes '''
+        return(self.tunes.copy())
+
+    def reread(self):
+        ''' Reads the file again and replaces only the tunes that changed,
+        found comparing content hashes. Returns the (start, end, tunes)
+        splices applied, last first, so positions stay valid if they are
+        applied in that order. History is lost. '''
+        self.stamp = self.fileStamp()
+        try:
+            with open(self.path, "r") as f:
+                new = list(self.split(f))
+        except:
+            print("I can't read the tunebook file")
+            return([])
+
+        matcher = difflib.SequenceMatcher(None,
+                                          [hash(t) for t in self.tunes],
+                                          [hash(t) for t in new],
+                                          autojunk=False)
+        splices = [(i1, i2, new[j1:j2])
+                   for tag, i1, i2, j1, j2 in reversed(matcher.get_opcodes())
+                   if tag != 'equal']
+        for start, end, tunes in splices:
+            self.tunes[start:end] = tunes
+        self.ntunes = len(self.tunes)
+        self.index = max(min(self.index, self.ntunes - 1), 0)
+        self.tunesSaved = self.tunes.copy()
+        self.clearHistory()
+        return(splices)
+
+    @staticmethod
+    def rewriteHeader(text, rules):
+        ''' Applies field rules to the header of a tune (lines until the
+        first K:). Rules are tuples like:
+            ('set', 'R:', 'reel')
+            ('delete', 'Z:')
+            ('replace', 'R:', pattern, replacement)
+        A set field missing in the header is inserted before K:. '''
+        lines = text.split('\n')
+        end = len(lines)
+        for n, line in enumerate(lines):
+            if line.startswith('K:'):
+                end = n + 1
+                break
+        header = lines[:end]
+
+        for rule in rules:
+            action, key = rule[0], rule[1]
+            if action == 'set':
+                value = key + rule[2]
+                found = [n for n, l in enumerate(header) if l.startswith(key)]
+                if found:
+                    header[found[0]] = value
+                elif header and header[-1].startswith('K:'):
+                    header.insert(len(header) - 1, value)
+                elif header and header[0].startswith('X:'):
+                    header.insert(1, value)
+                else:
+                    header.insert(0, value)
+            elif action == 'delete':
+                header = [l for l in header if not l.startswith(key)]
+            elif action == 'replace':
+                header = [key + re.sub(rule[2], rule[3], l[len(key):])
+                          if l.startswith(key) else l for l in header]
+
+        return('\n'.join(header + lines[end:]))
+
+    def rewrite(self, rules, rows=None):
+        ''' Yields (position, old text, new text) of every tune changed by
+        rules, for all tunes or those in rows. Tunebook is not changed. '''
+        if rows is None:
+            rows = range(len(self.tunes))
+        for row in rows:
+            old = self.tunes[row]
+            new = self.rewriteHeader(old, rules)
+            if new != old:
+                yield (row, old, new)
+
+    def numbers(self):
+        ''' Numbers used by the X: fields of the tunebook '''
+        return(set(self.tunes.number(ref) for ref in self.tunes.refs))
+
+    @staticmethod
+    def renumber(numbers, used):
+        ''' New numbers for tunes joining a tunebook that uses the numbers
+        in used: the same one if it is free, else the next after the
+        highest one. None means the number is kept. '''
+        used = set(used)
+        used.discard(None)
+        last = max(used, default=0)
+        new = []
+        for number in numbers:
+            if number is not None and number not in used:
+                new.append(None)  # Kept
+            else:
+                number = last + 1
+                new.append(number)
+            used.add(number)
+            last = max(last, number)
+        return(new)
+
+    def merge(self, tunes, rows):
+        ''' Appends the tunes in rows of other TuneStore, renumbering them
+        as needed. Their text is copied as bytes, never decoded. '''
+        refs = [tunes.refs[row] for row in rows]
+        numbers = self.renumber([tunes.number(ref) for ref in refs],
+                                self.numbers())
+        added = self.tunes.addFrom(tunes, refs, numbers)
+        self.tunes.refs.extend(added)
+        self.ntunes = len(self.tunes)
+        self.record(('extend', added))
+
+    @staticmethod
+    def appendTo(path, tunes, rows):
+        ''' Appends the tunes in rows of a TuneStore to a tunebook file
+        without reading it whole, renumbering them as needed '''
+        used = set()
+        last = b'\n'
+        if os.path.isfile(path):
+            with open(path, "rb") as f:
+                for line in f:
+                    if line.startswith(b'X:'):
+                        used.add(TuneStore.parseNumber(line[2:]))
+                    last = line[-1:]
+        refs = [tunes.refs[row] for row in rows]
+        numbers = TuneBook.renumber([tunes.number(ref) for ref in refs],
+                                    used)
+        with open(path, "ab") as f:
+            if last != b'\n':
+                f.write(b'\n')
+            for ref, number in zip(refs, numbers):
+                f.write(b'\n')
+                f.writelines(tunes.pieces(ref, number))
+            f.write(b'\n')
+
+    def removeRows(self, rows):
+        ''' Removes many tunes as one operation '''
+        rows = array('i', sorted(set(rows)))
+        refs = array('i', (self.tunes.refs[row] for row in rows))
+        for row in reversed(rows):
+            del self.tunes.refs[row]
+        self.ntunes = len(self.tunes)
+        self.index = max(min(self.index, self.ntunes - 1), 0)
+        self.record(('delete', rows, refs))
+
+    def applyChanges(self, changes):
+        ''' Replaces tunes from rewrite() as one operation, undone like
+        any other '''
+        self.edit((row, new) for row, old, new in changes)
+
+    # Undo history. Operations are stored as small deltas:
+    #     ('edit', ((pos, delta), ...))  line changes of some tunes
+    #     ('permute', order)             new tunes are old tunes[order]
+    #     ('insert', pos, text)
+    #     ('remove', pos, text)          tombstone of a removed tune
+    #     ('book', tunes)                other list of tunes, for restore()
+    #     ('extend', refs)               slices of tunes added to the end
+    #     ('delete', rows, refs)         slices of tunes removed from rows
+
+    def clearHistory(self):
+        self.undoStack = []
+        self.redoStack = []
+
+    def record(self, op):
+        self.undoStack.append(op)
+        self.redoStack = []
+
+    @staticmethod
+    def delta(old, new):
+        ''' Changed lines between two texts, as tuples of (line in old,
+        line in new, old lines, new lines) '''
+        a = old.split('\n')
+        b = new.split('\n')
+        matcher = difflib.SequenceMatcher(None, a, b, autojunk=False)
+        return(tuple((i1, j1, tuple(a[i1:i2]), tuple(b[j1:j2]))
+                     for tag, i1, i2, j1, j2 in matcher.get_opcodes()
+                     if tag != 'equal'))
+
+    @staticmethod
+    def patch(text, delta, forward=True):
+        ''' Applies a delta to the old text, or reverts it from the new '''
+        lines = text.split('\n')
+        for i, j, old, new in reversed(delta):
+            if forward:
+                lines[i:i + len(old)] = new
+            else:
+                lines[j:j + len(new)] = old
+        return('\n'.join(lines))
+
+    def setTune(self, pos, text):
+        self.edit(((pos, text),))
+
+    def edit(self, texts):
+        ''' Replaces tunes from (position, text) pairs as one operation '''
+        deltas = []
+        for pos, text in texts:
+            if text != self.tunes[pos]:
+                deltas.append((pos, self.delta(self.tunes[pos], text)))
+                self.tunes[pos] = text
+        if deltas:
+            self.record(('edit', tuple(deltas)))
+
+    def replay(self, op, forward):
+        kind = op[0]
+        if kind == 'edit':
+            for pos, delta in op[1]:
+                self.tunes[pos] = self.patch(self.tunes[pos], delta, forward)
+        elif kind == 'permute':
+            order = op[1]
+            if forward:
+                self.tunes.permute(order)
+            else:
+                self.tunes.unpermute(order)
+        elif kind == 'book':
+            other = op[1]
+            op[1] = self.tunes
+            self.tunes = other
+        elif kind == 'extend':
+            if forward:
+                self.tunes.refs.extend(op[1])
+            else:
+                del self.tunes.refs[len(self.tunes.refs) - len(op[1]):]
+        elif kind == 'delete':
+            if forward:
+                for row in reversed(op[1]):
+                    del self.tunes.refs[row]
+            else:
+                for row, ref in zip(op[1], op[2]):
+                    self.tunes.refs.insert(row, ref)
+        elif (kind == 'insert') == forward:
+            self.tunes.insert(op[1], op[2])
+        else:
+            self.tunes.pop(op[1])
+        self.ntunes = len(self.tunes)
+        self.index = max(min(self.index, self.ntunes - 1), 0)
+
+    def undo(self):
+        if self.undoStack:
+            op = self.undoStack.pop()
+            self.replay(op, False)
+            self.redoStack.append(op)
+
+    def redo(self):
+        if self.redoStack:
+            op = self.redoStack.pop()
+            self.replay(op, True)
+            self.undoStack.append(op)
+
+    def reindex(self):
+        texts = []
+        n = 0
+        for i in self.tunes:
+            tune = Tune()
+            tune.load(i)
+            tune.setField('X:', n + 1)
+            texts.append((n, tune.text))
+            n += 1
+        self.edit(texts)
+
+    def sort(self):
+        aux = []
+        n = 0
+        for i in self.tunes:
+            tune = Tune()
+            tune.load(i)
+            aux.append((tune.getField('T'), n))
+            n += 1
+        # Sorting array by first member (Title):
+        aux = sorted(aux, key=lambda t: t[0])
+        order = array('i', (i[1] for i in aux))
+        self.tunes.permute(order)
+        self.record(('permute', order))
+
+    def restore(self):
+        self.record(['book', self.tunes.copy()])
+        self.tunes = self.backup.copy()
+        self.ntunes = len(self.tunes)
+
+    def add(self, tune):  # To the last
+        self.insert(len(self.tunes), tune)
+
+    def insert(self, pos, tune):  # At the position + 1
+        self.tunes.insert(pos, tune)
+        self.ntunes += 1
+        self.record(('insert', pos, tune))
+
+    def remove(self, pos):
+        self.record(('remove', pos, self.tunes.pop(pos)))
+        self.ntunes -= 1
+
+
+class Tune():
+    def __init__(self, text=None, original=None):
+        self.load(text, original)
+
+    def load(self, text=None, original=None):
+        ''' The original text is the one transposed, the tune text if it
+        is not given '''
+        if text:
+            self.text = text
+        else:
+            self.text = ''
+        self.original = self.text if original is None else original
+
+    def hasField(self, key):
+        for i in self.text.split('\n'):
+            if i.startswith(key):
+                return(True)
+        return(False)
+
+    def getField(self, key):
+        sep = ':'
+        comment = '%'
+        for i in self.text.split('\n'):
+            if i.startswith(key):
+                v = i.split(sep)[1]
+                if comment in v:
+                    v = v.split(comment)[0]
+                return(v.strip())
+        return('')
+
+    def setField(self, key, value):
+        lines = []
+
+        if value == 'Default':
+            return(0)
+
+        if self.hasField(key):
+            for l in self.text.split('\n'):
+                if l.startswith(key):
+                    l = key + str(value)
+                lines.append(l)
+        else:
+            for l in self.text.split('\n'):
+                if l.startswith('X:'):
+                    lines.append(l)
+                    l = key + str(value)  # Insert value line
+                    lines.append(l)
+                else:
+                    lines.append(l)
+
+        self.text = '\n'.join(lines)
+
+    def transpose(self, semitones, render=None):
+        if render is None:
+            render = RenderService()
+        self.text = render.transpose(self.original, semitones)
+
+
+class RenderBackend():
+    ''' Engine of some render tasks. Subclasses name the tasks they do
+    and implement them with the signatures of RenderService:
+
+        svg(text)                    returns (SVG bytes, messages)
+        midi(text, outfile, tempo)   writes outfile, returns messages
+        transpose(text, semitones)   returns the transposed text
+
+    An engine fails by raising an exception or giving an empty result,
+    and then the next engine is tried. Engines are registered with
+    RenderService.register(), usually by a plugin module. '''
+
+    name = None
+    tasks = ()  # Of RenderService.TASKS
+    priority = 0  # Engines with higher priority are tried first
+
+    def available(self, task):
+        ''' If the engine can do a task in this system now '''
+        return(True)
+
+
+class ExternalTools(RenderBackend):
+    ''' abcm2ps, abc2midi and abc2abc, run for every render. It is the
+    engine tried last. '''
+
+    name = 'external'
+    tasks = ('svg', 'midi', 'transpose')
+    priority = -1
+
+    def svg(self, text):
+        svg = subprocess.run(
+            ('abcm2ps', '-q', '-g', '-', '-O', '-'),
+            input=text.encode(), stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE)
+        return(svg.stdout, svg.stderr.decode())
+
+    def midi(self, text, outfile, tempo=None):
+        if tempo:
+            cmd = ('abc2midi', '-', '-silent', '-Q', str(tempo), '-o', outfile)
+        else:
+            cmd = ('abc2midi', '-', '-silent', '-o', outfile)
+        midi = subprocess.run(cmd, input=text.encode(),
+                              stderr=subprocess.PIPE)
+        return(midi.stderr.decode())
+
+    def transpose(self, text, semitones):
+        t = subprocess.run(
+            ('abc2abc', '-', '-t', str(semitones)),
+            input=text.encode(), stdout=subprocess.PIPE)
+        return(t.stdout.decode())
+
+
+class RenderService():
+    ''' Renders with the best engine registered for every task, trying
+    the next one when an engine fails, and measures how long every
+    engine takes. Engines of the same priority are chosen by their mean
+    time, so the fastest is used, and engines that keep failing are
+    tried last. Threads can share an instance. '''
+
+    TASKS = ('svg', 'midi', 'transpose')
+    BACKENDS = [ExternalTools]  # Registered engine classes
+
+    def __init__(self, backends=None):
+        self.backends = []
+        for backend in self.BACKENDS if backends is None else backends:
+            try:
+                self.backends.append(backend())
+            except Exception as e:
+                print("I can't start the render backend", backend.name, e)
+        self.timings = {}  # [calls, failures, seconds, slowest] by engine
+        self.lock = threading.Lock()  # and task
+
+    @classmethod
+    def register(cls, backend):
+        ''' Adds an engine class. It can be used as a class decorator. '''
+        if backend not in cls.BACKENDS:
+            cls.BACKENDS.append(backend)
+        return(backend)
+
+    @staticmethod
+    def loadPlugins(folder=None):
+        ''' Imports the modules of folder, ~/.local/share/qabc/backends
+        by default, which register their engines '''
+        if folder is None:
+            folder = os.path.join(
+                os.environ.get('XDG_DATA_HOME')
+                or os.path.expanduser(os.path.join('~', '.local', 'share')),
+                'qabc', 'backends')
+        try:
+            names = sorted(os.listdir(folder))
+        except OSError:
+            return
+        for name in names:
+            if not name.endswith('.py'):
+                continue
+            spec = importlib.util.spec_from_file_location(
+                'qabc_backend_' + name[:-3], os.path.join(folder, name))
+            try:
+                spec.loader.exec_module(importlib.util.module_from_spec(spec))
+            except Exception as e:
+                print("I can't load the render backend", name, e)
+
+    FAILING = 3  # Engines that failed every one of these calls go last
+
+    def rank(self, backend, task):
+        ''' Sort key of an engine for a task '''
+        calls, failures, seconds, slowest = self.timings.get(
+            (backend.name, task), (0, 0, 0, 0))
+        return(calls >= self.FAILING and failures == calls,
+               -backend.priority, seconds / calls if calls else 0)
+
+    def engines(self, task):
+        ''' Engines able to do a task, in the order they are tried '''
+        engines = []
+        for backend in self.backends:
+            try:
+                if task in backend.tasks and backend.available(task):
+                    engines.append(backend)
+            except Exception:
+                pass
+        return(sorted(engines, key=lambda backend: self.rank(backend, task)))
+
+    @staticmethod
+    def stamp(path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return(None)
+        return((st.st_mtime_ns, st.st_size))
+
+    def succeeded(self, task, result, args, before):
+        ''' If a result is not empty. MIDI files must have been written,
+        as the file may be there from other render. '''
+        if task == 'svg':
+            return(bool(result[0]))
+        if task == 'midi':
+            after = self.stamp(args[1])
+            return(after is not None and after != before and after[1] > 0)
+        return(bool(result))
+
+    def run(self, task, *args):
+        ''' Does a task with every engine in turn until one succeeds.
+        Returns the last result, or raises the last error if no engine
+        gave a result. '''
+        result = error = None
+        for backend in self.engines(task):
+            before = self.stamp(args[1]) if task == 'midi' else None
+            start = time.perf_counter()
+            try:
+                result = getattr(backend, task)(*args)
+                failed = not self.succeeded(task, result, args, before)
+            except Exception as e:
+                error = e
+                failed = True
+            seconds = time.perf_counter() - start
+            with self.lock:
+                timing = self.timings.setdefault((backend.name, task),
+                                                 [0, 0, 0, 0])
+                timing[0] += 1
+                timing[1] += failed
+                timing[2] += seconds
+                timing[3] = max(timing[3], seconds)
+            if not failed:
+                return(result)
+        if result is None and error is not None:
+            raise error
+        return(result)
+
+    def report(self):
+        ''' (engine, task, calls, failures, mean and slowest seconds) of
+        every engine used '''
+        with self.lock:
+            return([(name, task, calls, failures, seconds / calls, slowest)
+                    for (name, task), (calls, failures, seconds, slowest)
+                    in sorted(self.timings.items())])
+
+    def svg(self, text):
+        ''' Returns the SVG of a tune and the messages of the engine '''
+        return(self.run('svg', text))
+
+    def midi(self, text, outfile, tempo=None):
+        ''' Writes the MIDI of a tune to outfile. Returns the messages of
+        the engine. '''
+        return(self.run('midi', text, outfile, tempo))
+
+    def midiFile(self, text, folder, tempo=None, semitones=0):
+        ''' Renders a tune, transposed if semitones is given, to a MIDI
+        file of folder named after what is rendered, so a file made before
+        is reused. Returns its path, None if no file was made, and the
+        messages of the engine. '''
+        name = hashlib.sha1(repr((text, tempo, semitones)).encode())
+        path = os.path.join(folder, name.hexdigest() + '.mid')
+        if os.path.isfile(path):
+            return(path, '')
+        if semitones:
+            text = self.transpose(text, semitones)
+        messages = self.midi(text, path + '.tmp', tempo)
+        if not os.path.isfile(path + '.tmp'):
+            return(None, messages)
+        os.replace(path + '.tmp', path)  # Never seen half written
+        return(path, messages)
+
+    def transpose(self, text, semitones):
+        return(self.run('transpose', text, semitones))
+
+
+class AbcLinter():
+    ''' Checks abc code without calling abcm2ps. Lines are checked one by
+    one with a context carried from the previous line, so an editor can
+    check only the lines that change. Problems are tuples of
+    (severity, message); errors mean abcm2ps would fail. '''
+
+    ERROR, WARNING = range(2)
+
+    # Context: (in body, unit note length, meter length, open slurs,
+    #           length of current bar, a bar was ended, last bar line)
+    START = (False, None, None, 0, Fraction(0), False, '')
+
+    DECORATIONS = frozenset((
+        'trill', 'trill(', 'trill)', 'lowermordent', 'uppermordent',
+        'mordent', 'pralltriller', 'roll', 'turn', 'turnx', 'invertedturn',
+        'invertedturnx', 'arpeggio', '>', 'accent', 'emphasis', 'fermata',
+        'invertedfermata', 'tenuto', '0', '1', '2', '3', '4', '5', '+',
+        'plus', 'snap', 'slide', 'wedge', 'upbow', 'downbow', 'open',
+        'thumb', 'breath', 'pppp', 'ppp', 'pp', 'p', 'mp', 'mf', 'f', 'ff',
+        'fff', 'ffff', 'sfz', 'crescendo(', '<(', 'crescendo)', '<)',
+        'diminuendo(', '>(', 'diminuendo)', '>)', 'segno', 'coda', 'D.S.',
+        'D.C.', 'dacoda', 'dacapo', 'fine', 'shortphrase', 'mediumphrase',
+        'longphrase', '/', '//', '///', 'editorial', 'courtesy', 'xstem',
+        'beambr1', 'beambr2', 'ped', 'ped-up', 'invisible', 'erased',
+        'mark', 'caesura', 'tremolo', 'ring', 'fingers', '^'))
+
+    TOKENS = re.compile(
+        r'(?P<comment>%.*)'
+        r'|(?P<chord>"[^"]*"?)'
+        r'|(?P<deco>![^!]*!?|\+[^+\s]*\+)'
+        r'|(?P<inline>\[[A-Za-z]:[^\]]*\]?)'
+        r'|(?P<bar>\[\||:*\|+[\]:]*[\d,-]*|::|\[\d[\d,-]*)'
+        r'|(?P<grace>\{[^}]*\}?)'
+        r'|(?P<tuplet>\((?P<p>\d)(?::(?P<q>\d*))?(?::(?P<r>\d*))?)'
+        r'|(?P<slur>[()])'
+        r'|(?P<chordstart>\[)'
+        r'|(?P<chordend>\](?P<clen>\d*/*\d*))'
+        r'|(?P<note>[_^=]*[A-Ga-gzx][,\']*(?P<len>\d*/*\d*))'
+        r'|(?P<mrest>[ZX]\d*)')
+
+    FIELD = re.compile(r'^([A-Za-z+]):')
+
+    @staticmethod
+    def length(text):
+        ''' Multiplier of a note length like 2, /, // or 3/2. Raises
+        ZeroDivisionError for a zero denominator, like 3/0. '''
+        m = re.match(r'(\d*)(/*)(\d*)', text)
+        n = int(m.group(1) or 1)
+        if not m.group(2):
+            return(Fraction(n))
+        if m.group(3):
+            return(Fraction(n, int(m.group(3))))
+        return(Fraction(n, 2 ** len(m.group(2))))
+
+    @staticmethod
+    def meter(text):
+        ''' Length of a bar in whole notes, or None if it is free. Raises
+        ZeroDivisionError for a zero denominator, like 3/0. '''
+        text = text.strip()
+        if text in ('C', 'C|'):
+            return(Fraction(1))
+        num, sep, den = text.partition('/')
+        try:
+            return(Fraction(sum(int(i) for i in num.strip('()').split('+')),
+                            int(den)))
+        except ValueError:
+            return(None)
+
+    def field(self, key, value, context):
+        body, unit, meter, slurs, length, started, last = context
+        if key == 'L:':
+            try:
+                unit = Fraction(value.split('%')[0].strip())
+            except (ValueError, ZeroDivisionError):
+                return([(self.WARNING, _("Wrong unit note length: ") + value)],
+                       context)
+        elif key == 'M:':
+            try:
+                meter = self.meter(value.split('%')[0])
+            except ZeroDivisionError:
+                return([(self.WARNING, _("Wrong meter: ") + value)], context)
+        elif key == 'K:':
+            body = True
+        if body and unit is None:  # Default unit depends on meter
+            unit = Fraction(1, 16) if meter and meter < Fraction(3, 4) \
+                else Fraction(1, 8)
+        return([], (body, unit, meter, slurs, length, started, last))
+
+    def lintLine(self, line, context):
+        ''' Returns the problems of a line and the context for the next '''
+        if not line or line.startswith('%'):
+            return([], context)
+        field = self.FIELD.match(line)
+        if field:
+            if field.group(0) in ('w:', 'W:'):  # Lyrics
+                return([], context)
+            return(self.field(field.group(0), line[2:], context))
+        if not context[0]:  # Free text in header
+            return([], context)
+
+        body, unit, meter, slurs, length, started, last = context
+        problems = []
+        chord = None  # Length of the first note of an open [chord]
+        tuplet = 0  # Notes left in the current tuplet
+        factor = Fraction(1)
+        inner = False  # A bar was ended in this line
+
+        for m in self.TOKENS.finditer(line):
+            kind = m.lastgroup
+            text = m.group(0)
+            if kind == 'comment':
+                break
+            elif kind == 'chord':
+                if len(text) == 1 or not text.endswith('"'):
+                    problems.append((self.ERROR, _("Unclosed chord symbol")))
+            elif kind == 'deco':
+                if text == '!' and not line[m.end():].strip():
+                    pass  # Old line break symbol
+                elif text[0] == '!' and (len(text) == 1 or text[-1] != '!'):
+                    problems.append((self.ERROR, _("Unclosed decoration")))
+                elif text[1:-1] not in self.DECORATIONS:
+                    problems.append((self.WARNING, _("Unknown decoration ")
+                                     + text))
+            elif kind == 'inline':
+                if not text.endswith(']'):
+                    problems.append((self.ERROR, _("Unclosed inline field")))
+                else:
+                    p, context = self.field(text[1:3], text[3:-1],
+                                            (body, unit, meter, slurs,
+                                             length, started, last))
+                    problems += p
+                    body, unit, meter = context[:3]
+            elif kind == 'grace' and not text.endswith('}'):
+                problems.append((self.ERROR, _("Unclosed grace notes")))
+            elif kind == 'tuplet':
+                p = int(m.group('p'))
+                q = m.group('q')
+                q = int(q) if q else (3 if p in (2, 4, 8) else 2)
+                if not p or not q:
+                    problems.append((self.ERROR, _("Wrong tuplet ") + text))
+                    continue
+                r = m.group('r')
+                tuplet = int(r) if r else p
+                factor = Fraction(q, p)
+            elif kind == 'slur':
+                slurs += 1 if text == '(' else -1
+            elif kind == 'chordstart':
+                if chord is not None:
+                    problems.append((self.ERROR, _("Nested chord")))
+                chord = Fraction(0)
+            elif kind == 'chordend':
+                if chord is None:
+                    problems.append((self.ERROR, _("Unbalanced ]")))
+                elif length is not None:
+                    try:
+                        length += chord * self.length(m.group('clen'))
+                    except ZeroDivisionError:
+                        problems.append((self.ERROR, _("Wrong length ")
+                                         + text))
+                chord = None
+            elif kind == 'note':
+                try:
+                    n = self.length(m.group('len'))
+                except ZeroDivisionError:
+                    problems.append((self.ERROR, _("Wrong length ") + text))
+                    continue
+                if tuplet:
+                    n *= factor
+                    tuplet -= 1
+                if chord is not None:
+                    if not chord:
+                        chord = n
+                elif length is not None:
+                    length += n
+            elif kind == 'mrest':
+                length = None
+            elif kind == 'bar':
+                if chord is not None:
+                    problems.append((self.ERROR, _("Unclosed chord")))
+                    chord = None
+                problems += self.checkBar(text, length, unit, meter,
+                                          started and inner, last)
+                if length != 0:
+                    started = inner = True
+                length = Fraction(0)
+                last = text
+
+        if chord is not None:
+            problems.append((self.ERROR, _("Unclosed chord")))
+        return(problems, (body, unit, meter, slurs, length, started, last))
+
+    def checkBar(self, bar, length, unit, meter, complete, last):
+        ''' Bars too long are always reported. Bars too short are only
+        reported if they should be complete: not the first of a line nor
+        around repeats or endings. '''
+        if not length or unit is None or meter is None:
+            return([])
+        plain = ('|', '||', '')
+        duration = length * unit
+        if duration > meter:
+            return([(self.WARNING, _("Bar too long: ") + str(duration)
+                     + " " + _("instead of") + " " + str(meter))])
+        if duration < meter and complete and bar in plain and last in plain:
+            return([(self.WARNING, _("Bar too short: ") + str(duration)
+                     + " " + _("instead of") + " " + str(meter))])
+        return([])
+
+    def finish(self, keys, context):
+        ''' Problems of a whole tune, from its field keys in order and
+        the context after its last line '''
+        problems = []
+        if not keys or keys[0] != 'X:':
+            problems.append((self.ERROR, _("X: must be the first field")))
+        if 'T:' not in keys:
+            problems.append((self.WARNING, _("Missing T: field")))
+        if 'K:' not in keys:
+            problems.append((self.ERROR, _("Missing K: field")))
+        if context[3]:
+            problems.append((self.ERROR, _("Unbalanced slurs")))
+        return(problems)
+
+    def lint(self, text):
+        ''' Returns (line number, severity, message) of all problems '''
+        problems = []
+        keys = []
+        context = self.START
+        for n, line in enumerate(text.split('\n'), 1):
+            field = self.FIELD.match(line)
+            if field:
+                keys.append(field.group(0))
+            p, context = self.lintLine(line, context)
+            problems += [(n, s, m) for s, m in p]
+        problems += [(0, s, m) for s, m in self.finish(keys, context)]
+        return(problems)
+
+
+def lintSummary(text):
+    ''' Number of errors and warnings of a tune. Used by worker processes. '''
+    problems = AbcLinter().lint(text)
+    errors = sum(1 for p in problems if p[1] == AbcLinter.ERROR)
+    return(errors, len(problems) - errors)
+
+
+def lintSummaries(texts):
+    ''' lintSummary() of many tunes, as one job of a worker process '''
+    return([lintSummary(text) for text in texts])
+
+
+class RenderCache():
+    ''' Results of renders by key, dropping the least recently used ones
+    when they take more bytes than the budget. Threads can share it. '''
+
+    def __init__(self, budget=64 * 1024 * 1024):
+        self.budget = budget
+        self.size = 0
+        self.items = collections.OrderedDict()  # (result, size) by key
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(kind, text, *args):
+        ''' Key of a render of text, made of a digest instead of the text
+        to keep the cache small '''
+        return((kind,) + args + (hashlib.sha1(text.encode()).digest(),))
+
+    def get(self, key):
+        with self.lock:
+            item = self.items.get(key)
+            if item is None:
+                self.misses += 1
+                return(None)
+            self.items.move_to_end(key)
+            self.hits += 1
+            return(item[0])
+
+    def put(self, key, result, size):
+        with self.lock:
+            if key in self.items:
+                self.size -= self.items.pop(key)[1]
+            if size > self.budget:
+                return
+            self.items[key] = (result, size)
+            self.size += size
+            while self.size > self.budget:
+                self.size -= self.items.popitem(last=False)[1][1]
+
+
+class TuneFeatures():
+    ''' Similarity vectors of tunes: histograms of pitch classes from the
+    tonic, of intervals and of pairs of intervals, of note lengths, and
+    the meter and rhythm. Vectors are kept as rows of a NumPy matrix by
+    TuneStore slice, so moving, removing or undoing tunes does not need
+    new vectors, and an edit only needs the vector of its new text.
+    NumPy is imported on first use. '''
+
+    STEPS = dict(zip('CDEFGAB', (0, 2, 4, 5, 7, 9, 11)))
+    FIFTHS = dict(zip('FCGDAEB', range(-1, 6)))  # Of the tonic from C
+    MODES = {'': 0, 'maj': 0, 'ion': 0, 'm': -3, 'min': -3, 'aeo': -3,
+             'mix': -1, 'dor': -2, 'phr': -4, 'lyd': 1, 'loc': -5}
+    ACCIDENTALS = {'^': 1, '^^': 2, '_': -1, '__': -2, '=': 0}
+    KEY = re.compile(r'([A-G])([#b]?)\s*([A-Za-z]*)')
+    SKIP = re.compile(r'%.*|"[^"]*"|![^!\n]*!|\+[^+\s]*\+'
+                      r'|\[[A-Za-z]:[^\]\n]*\]|\{[^}]*\}')
+    NOTES = re.compile(r"([_^=]*)([A-Ga-gzx])([,']*)(\d*/*\d*)")
+    LENGTHS = (Fraction(1, 4), Fraction(1, 3), Fraction(1, 2),
+               Fraction(3, 4), Fraction(1), Fraction(3, 2), Fraction(2),
+               Fraction(3), Fraction(4))  # In unit note lengths
+    BINS = {}  # Of LENGTHS, by length text, filled by lengthBin()
+    METERS = ('2/4', '3/4', '4/4', '6/8', '9/8', '12/8', '3/2', '2/2')
+    RHYTHMS = ('reel', 'jig', 'slip jig', 'hornpipe', 'polka', 'slide',
+               'waltz', 'strathspey', 'mazurka', 'march')
+    INTERVALS = 15  # From a fifth down to a fifth up, the wider clipped
+    PAIRS = 48  # Buckets of consecutive intervals
+    # Size and weight of every part of a vector
+    PARTS = ((12, 1.0), (INTERVALS, 1.0), (PAIRS, 1.0),
+             (len(LENGTHS) + 1, 0.5), (len(METERS) + 1, 0.5),
+             (len(RHYTHMS) + 1, 0.5))
+    SIZE = sum(part[0] for part in PARTS)
+
+    def __init__(self):
+        self.slices = None  # Of the TuneStore the vectors belong to
+        self.matrix = None  # Vector by slice
+        self.known = None  # Slices with vector
+
+    @classmethod
+    def signature(cls, key):
+        ''' Tonic and alterations by note name of a K: field '''
+        m = cls.KEY.match(key)
+        if not m:
+            return(0, {})
+        letter, accidental, mode = m.groups()
+        shift = {'#': 1, 'b': -1}.get(accidental, 0)
+        fifths = cls.FIFTHS[letter] + 7 * shift \
+            + cls.MODES.get(mode[:3].lower() if len(mode) > 1 else mode, 0)
+        if fifths >= 0:
+            altered = dict.fromkeys('FCGDAEB'[:fifths], 1)
+        else:
+            altered = dict.fromkeys('BEADGCF'[:-fifths], -1)
+        return(cls.STEPS[letter] + shift, altered)
+
+    @classmethod
+    def lengthBin(cls, text):
+        ''' Bin of a note length like 2, / or 3/2, cached in BINS '''
+        if text not in cls.BINS:
+            try:
+                length = AbcLinter.length(text)
+            except ZeroDivisionError:
+                length = None
+            cls.BINS[text] = cls.LENGTHS.index(length) \
+                if length in cls.LENGTHS else len(cls.LENGTHS)
+        return(cls.BINS[text])
+
+    @classmethod
+    def vector(cls, text):
+        ''' Normalized vector of a tune, so the dot product of two vectors
+        is their similarity, from 0 to 1 '''
+        import numpy
+        meter = rhythm = key = ''
+        music = []
+        body = False
+        for line in text.split('\n'):
+            if AbcLinter.FIELD.match(line):
+                value = line[2:].split('%')[0].strip()
+                if line.startswith('M:') and not meter:
+                    meter = {'C': '4/4', 'C|': '2/2'}.get(value, value)
+                elif line.startswith('R:') and not rhythm:
+                    rhythm = value.lower()
+                elif line.startswith('K:') and not body:
+                    key = value
+                    body = True
+            elif body:
+                music.append(line)
+        tonic, altered = cls.signature(key)
+        pitch = {}  # By accidental, letter and octave marks
+        pitches = []
+        lengths = []
+        for note in cls.NOTES.findall(cls.SKIP.sub('', '\n'.join(music))):
+            accidental, letter, octave, length = note
+            if letter in 'zx':
+                continue
+            sound = note[:3]
+            if sound not in pitch:
+                name = letter.upper()
+                pitch[sound] = cls.STEPS[name] \
+                    + (12 if letter.islower() else 0) \
+                    + 12 * (octave.count("'") - octave.count(',')) \
+                    + cls.ACCIDENTALS.get(accidental, altered.get(name, 0))
+            pitches.append(pitch[sound])
+            lengths.append(cls.lengthBin(length))
+        absolute = numpy.array(pitches, dtype=numpy.int64)
+        intervals = numpy.clip(numpy.diff(absolute), -7, 7) + 7
+        pairs = (intervals[:-1] * cls.INTERVALS + intervals[1:]) % cls.PAIRS
+        counts = (
+            numpy.bincount((absolute - tonic) % 12, minlength=12),
+            numpy.bincount(intervals, minlength=cls.INTERVALS),
+            numpy.bincount(pairs, minlength=cls.PAIRS),
+            numpy.bincount(numpy.array(lengths, dtype=numpy.int64),
+                           minlength=len(cls.LENGTHS) + 1),
+            numpy.bincount(
+                [cls.METERS.index(meter) if meter in cls.METERS
+                 else len(cls.METERS)], minlength=len(cls.METERS) + 1),
+            numpy.bincount(
+                [cls.RHYTHMS.index(rhythm) if rhythm in cls.RHYTHMS
+                 else len(cls.RHYTHMS)], minlength=len(cls.RHYTHMS) + 1))
+        parts = []
+        for count, (size, weight) in zip(counts, cls.PARTS):
+            count = count.astype(numpy.float32)
+            norm = numpy.linalg.norm(count)
+            parts.append(count * (weight / norm) if norm else count)
+        vector = numpy.concatenate(parts)
+        if not pitches:  # Only meter and rhythm would be alike
+            vector[:] = 0
+        norm = numpy.linalg.norm(vector)
+        return(vector / norm if norm else vector)
+
+    @classmethod
+    def compute(cls, tunes, refs):
+        ''' Vectors of some slices of a store, as a matrix. Other threads
+        can call it with a snapshot. '''
+        import numpy
+        matrix = numpy.zeros((len(refs), cls.SIZE), dtype=numpy.float32)
+        for n, ref in enumerate(refs):
+            matrix[n] = cls.vector(tunes.text(ref))
+        return(matrix)
+
+    def missing(self, tunes):
+        ''' Slices of the tunes without vector. Vectors of other stores
+        are dropped. '''
+        import numpy
+        if tunes.slices is not self.slices:
+            self.slices = tunes.slices
+            self.matrix = numpy.zeros((0, self.SIZE), dtype=numpy.float32)
+            self.known = numpy.zeros(0, dtype=bool)
+        refs = numpy.array(tunes.refs, dtype=numpy.intp)
+        lacking = refs >= len(self.known)
+        lacking[~lacking] = ~self.known[refs[~lacking]]
+        return(numpy.unique(refs[lacking]))
+
+    def store(self, tunes, refs, matrix):
+        ''' Keeps vectors computed for slices of tunes, unless the store
+        changed its slices meanwhile '''
+        import numpy
+        if tunes.slices is not self.slices or not len(refs):
+            return(False)
+        size = int(refs.max()) + 1
+        if size > len(self.known):
+            size = max(size, 2 * len(self.known))  # Room for edits
+            grown = numpy.zeros((size, self.SIZE), dtype=numpy.float32)
+            grown[:len(self.matrix)] = self.matrix
+            known = numpy.zeros(size, dtype=bool)
+            known[:len(self.known)] = self.known
+            self.matrix, self.known = grown, known
+        self.matrix[refs] = matrix
+        self.known[refs] = True
+        return(True)
+
+    def nearest(self, tunes, vector, count=10, exclude=None):
+        ''' Positions of the tunes most similar to a vector and their
+        similarity, the most similar first, leaving out position exclude
+        and tunes without vector '''
+        import numpy
+        if self.known is None or tunes.slices is not self.slices:
+            return([])
+        refs = numpy.array(tunes.refs, dtype=numpy.intp)
+        valid = refs < len(self.known)
+        valid[valid] = self.known[refs[valid]]
+        scores = numpy.zeros(len(refs), dtype=numpy.float32)
+        scores[valid] = (self.matrix @ vector)[refs[valid]]
+        if exclude is not None and 0 <= exclude < len(scores):
+            scores[exclude] = 0
+        count = min(count, len(scores))
+        if not count:
+            return([])
+        best = numpy.argpartition(-scores, count - 1)[:count]
+        best = best[numpy.argsort(-scores[best], kind='stable')]
+        return([(int(row), float(scores[row])) for row in best
+                if scores[row] > 0])
+
+    def size(self):
+        ''' Bytes used by the vectors '''
+        if self.matrix is None:
+            return(0)
+        return(self.matrix.nbytes + self.known.nbytes)
+
+
+class TuneStatistics():
+    ''' Statistics of a tunebook from its header index: tunes by header
+    value, missing fields and lengths in bars. Counts are NumPy
+    aggregations of the columns of value codes. Bar lines are counted in
+    whole buffers and kept by TuneStore slice, so after an edit only the
+    new texts are counted. NumPy is imported on first use. '''
+
+    FIELDS = (('R:', _("Rhythm")), ('M:', _("Meter")), ('K:', _("Key")))
+    BINS = (0, 8, 16, 24, 32, 48, 64, 96, 128)  # Least bars of the lengths
+
+    def __init__(self):
+        self.slices = None  # Of the TuneStore the bars belong to
+        self.bars = None  # Bar lines by slice, -1 if not counted
+
+    @staticmethod
+    def countBars(tunes, refs):
+        ''' Bar lines of some slices, counted like AbcHighlighter counts
+        the bar tokens of AbcLinter: only in the body, not in fields, w:
+        lyrics, comments nor quoted strings, a double bar line like || or
+        :| being one, and those starting a line not ending a bar '''
+        import numpy
+        refs = numpy.asarray(refs, dtype=numpy.intp)
+        buffers, starts, ends = (numpy.array(i)[refs] for i in tunes.slices)
+        bars = numpy.zeros(len(refs), dtype=numpy.int32)
+        for number in numpy.unique(buffers):
+            chosen = numpy.flatnonzero(buffers == number)
+            chosen = chosen[numpy.argsort(starts[chosen])]
+            first, last = starts[chosen], ends[chosen]
+            data = numpy.frombuffer(tunes.buffers[number], dtype=numpy.uint8)
+            size = len(data)
+            data = numpy.concatenate(  # data[-1] is 0 too
+                (data, numpy.zeros(2, dtype=numpy.uint8)))
+            lines = numpy.flatnonzero(data[:size] == 10) + 1
+            lines = numpy.concatenate(([0], lines[lines < size]))  # Starts
+            head, second = data[lines], data[lines + 1]
+            letter = head | 32  # Lower case
+            fields = (second == ord(':')) & (
+                (letter >= ord('a')) & (letter <= ord('z'))
+                | (head == ord('+')))
+
+            # Quoted strings and comments, by the first in every line
+            quotes = numpy.flatnonzero(data == ord('"'))
+            quoteLines = numpy.searchsorted(quotes, lines)
+            comments = numpy.flatnonzero(data == ord('%'))
+            n = numpy.searchsorted(lines, comments, 'right') - 1
+            comments = comments[(numpy.searchsorted(quotes, comments)
+                                 - quoteLines[n]) % 2 == 0]
+            commentLines = numpy.searchsorted(comments, lines)
+
+            # Body of every tune: the lines after its first K: field
+            keys = lines[fields & (head == ord('K'))]
+            n = numpy.searchsorted(keys, first)
+            key = keys[numpy.minimum(n, len(keys) - 1)] if len(keys) \
+                else first
+            keyed = (n < len(keys)) & (key < last)
+            n = numpy.searchsorted(lines, key, 'right')
+            body = numpy.where(keyed, numpy.append(lines, size)[n], last)
+
+            def tunesOf(pos):
+                ''' Tunes of the positions in their music '''
+                n = numpy.searchsorted(lines, pos, 'right') - 1
+                tune = numpy.searchsorted(first, pos, 'right') - 1
+                music = (tune >= 0) & ~fields[n] \
+                    & ((numpy.searchsorted(quotes, pos) - quoteLines[n]) % 2
+                       == 0) \
+                    & (numpy.searchsorted(comments, pos) == commentLines[n])
+                tune, pos = tune[music], pos[music]
+                return(tune[(pos >= body[tune]) & (pos < last[tune])])
+
+            # Bar tokens: runs of |, and :: without |
+            pipes = numpy.flatnonzero(data == ord('|'))
+            pipes = pipes[data[pipes - 1] != ord('|')]
+            colons = numpy.flatnonzero(data == ord(':'))
+            colons = colons[(data[colons + 1] == ord(':'))
+                            & (data[colons - 1] != ord(':'))
+                            & (data[colons - 1] != ord('|'))
+                            & (data[colons + 2] != ord('|'))]
+            found = numpy.bincount(tunesOf(pipes), minlength=len(chosen)) \
+                + numpy.bincount(tunesOf(colons), minlength=len(chosen))
+            # Bar lines at line start do not end a bar
+            starting = lines[(head == ord('|'))
+                             | (head == ord(':')) & ((second == ord('|'))
+                                                    | (second == ord(':')))
+                             | (head == ord('[')) & (second == ord('|'))]
+            found -= numpy.bincount(tunesOf(starting), minlength=len(chosen))
+            bars[chosen] = found
+        return(bars)
+
+    def lengths(self, tunes):
+        ''' Bar lines of every tune, counting only the slices not seen '''
+        import numpy
+        if tunes.slices is not self.slices:
+            self.slices = tunes.slices
+            self.bars = numpy.zeros(0, dtype=numpy.int32)
+        size = len(tunes.slices[0])
+        if size > len(self.bars):
+            grown = numpy.full(max(size, 2 * len(self.bars)), -1,
+                               dtype=numpy.int32)
+            grown[:len(self.bars)] = self.bars
+            self.bars = grown
+        refs = numpy.array(tunes.refs, dtype=numpy.intp)
+        missing = numpy.unique(refs[self.bars[refs] < 0])
+        if len(missing):
+            self.bars[missing] = self.countBars(tunes, missing)
+        return(self.bars[refs])
+
+    @staticmethod
+    def counts(rows, values, normalize=None):
+        ''' (value, tunes) of a column of value codes, the most frequent
+        first. Values with the same normalized spelling are counted
+        together, under the most used spelling. '''
+        import numpy
+        tunes = numpy.bincount(numpy.array(rows, dtype=numpy.intp),
+                               minlength=len(values))
+        groups = {}
+        for code in numpy.argsort(-tunes, kind='stable'):
+            if not tunes[code]:
+                break
+            value = values[code]
+            key = normalize(value) if normalize else value
+            if key in groups:
+                groups[key][1] += int(tunes[code])
+            else:
+                groups[key] = [value, int(tunes[code])]
+        return(sorted((tuple(i) for i in groups.values()),
+                      key=lambda i: -i[1]))
+
+    def report(self, tunes, columns, normalize=None):
+        ''' Statistics of tunes, whose header index columns are given as
+        (codes of every tune, values by code) by field. normalize(field,
+        value) gives the spelling used to join values. '''
+        import numpy
+        report = {'tunes': len(tunes), 'missing': {}}
+        for field, (rows, values) in columns.items():
+            empty = [code for code, value in enumerate(values) if not value]
+            report['missing'][field] = int(numpy.isin(
+                numpy.array(rows, dtype=numpy.intp), empty).sum())
+            if field in dict(self.FIELDS):
+                counts = self.counts(
+                    rows, values,
+                    normalize and (lambda value: normalize(field, value)))
+                report[field] = [i for i in counts if i[0]]
+        bars = self.lengths(tunes)
+        if len(bars):
+            report['bars'] = {'min': int(bars.min()),
+                              'median': float(numpy.median(bars)),
+                              'mean': round(float(bars.mean()), 1),
+                              'max': int(bars.max())}
+        histogram = numpy.bincount(
+            numpy.searchsorted(self.BINS, bars, side='right') - 1,
+            minlength=len(self.BINS))
+        names = ["%d-%d" % (low, high - 1)
+                 for low, high in zip(self.BINS, self.BINS[1:])]
+        names.append("%d+" % self.BINS[-1])
+        report['lengths'] = [(name, int(count))
+                             for name, count in zip(names, histogram)]
+        return(report)
+
+    def size(self):
+        ''' Bytes used by the bar counts '''
+        if self.bars is None:
+            return(0)
+        return(self.bars.nbytes)
+
+    @staticmethod
+    def export(report, path):
+        ''' Writes a report as JSON if path ends with .json, or as CSV
+        rows of section, value and tunes '''
+        with open(path, "w", newline='') as f:
+            if path.lower().endswith('.json'):
+                json.dump(report, f, indent=1, ensure_ascii=False)
+                return
+            writer = csv.writer(f)
+            writer.writerow(('section', 'value', 'tunes'))
+            writer.writerow(('tunes', '', report['tunes']))
+            for field, name in TuneStatistics.FIELDS:
+                for value, count in report.get(field, ()):
+                    writer.writerow((field, value, count))
+            for field, count in report['missing'].items():
+                writer.writerow(('missing', field, count))
+            for name, value in report.get('bars', {}).items():
+                writer.writerow(('bars', name, value))
+            for name, count in report['lengths']:
+                writer.writerow(('length', name, count))
@@ -0,0 +1,352 @@
+#!/usr/bin/python3
+''' HTTP server of the tunes of a tunebook, run by "qabc serve". Only the
+header index stays in memory: tunes are read from the file when they are
+asked for, and their scores and MIDI files are rendered by a bounded pool
+of threads and kept in a RenderCache, so popular tunes are rendered once.
+
+    GET /                       tunebook name and number of tunes
+    GET /tunes?q=&offset=&limit=
+                                headers of the tunes found by the query,
+                                like "K:D R:reel kid*"
+    GET /tunes/N                abc code of the tune at position N
+    GET /tunes/N.svg            score made by abcm2ps or other engine
+    GET /tunes/N.mid?tempo=&transpose=
+                                MIDI made by abc2midi or other engine
+    GET /timings                renders made by every engine and their
+                                times '''
+
+import argparse
+import asyncio
+import concurrent.futures
+import fnmatch
+import json
+import os
+import re
+import shlex
+import shutil
+import signal
+import sys
+import tempfile
+import threading
+import urllib.parse
+from array import array
+
+from qabccore import RenderCache, RenderService, TuneBook, _
+
+
+class Catalogue():
+    ''' Header index of a tunebook file: where every tune is in the file
+    and its X:, T:, R:, M: and K: fields. The file is read again when it
+    changes. '''
+
+    FIELDS = ('X:', 'T:', 'R:', 'M:', 'K:')
+    START = re.compile(rb'^X:', re.MULTILINE)
+
+    def __init__(self, path):
+        self.book = TuneBook()  # Only its path, for fileStamp()
+        self.book.path = path
+        self.stamp = None
+        self.index = (array('q'), array('q'), [])  # Offsets, sizes, headers
+        self.lock = threading.Lock()
+        self.refresh()
+
+    @staticmethod
+    def decode(data):
+        ''' Text of a tune as TuneBook reads it '''
+        text = data.decode(errors='replace')
+        text = text.replace('\r\n', '\n').replace('\r', '\n')
+        return(next(TuneBook.split(text.split('\n')), None))
+
+    def refresh(self):
+        ''' Reads the index again if the file changed '''
+        with self.lock:
+            stamp = self.book.fileStamp()
+            if stamp == self.stamp:
+                return
+            try:
+                with open(self.book.path, "rb") as f:
+                    data = f.read()
+            except OSError:
+                print("I can't read the tunebook file")
+                return
+            offsets, sizes, headers = array('q'), array('q'), []
+            values = {}  # Every header value once
+            starts = [m.start() for m in self.START.finditer(data)]
+            if not starts or starts[0]:
+                starts.insert(0, 0)  # Text before the first tune
+            for start, end in zip(starts, starts[1:] + [len(data)]):
+                text = self.decode(data[start:end])
+                if text is None:
+                    continue
+                offsets.append(start)
+                sizes.append(end - start)
+                headers.append(tuple(
+                    values.setdefault(value, value)
+                    for value in TuneBook.headers(text, self.FIELDS)))
+            self.index = (offsets, sizes, headers)  # At once for readers
+            self.stamp = stamp
+
+    def __len__(self):
+        return(len(self.index[0]))
+
+    def headers(self, pos):
+        ''' Fields of a tune as a dictionary for JSON '''
+        x, t, r, m, k = self.index[2][pos]
+        return({'index': pos, 'X': x, 'T': t, 'R': r, 'M': m, 'K': k})
+
+    def text(self, pos):
+        offsets, sizes, headers = self.index
+        with open(self.book.path, "rb") as f:
+            f.seek(offsets[pos])
+            return(self.decode(f.read(sizes[pos])) or '')
+
+    def find(self, query):
+        ''' Positions of the tunes matching every word of a query. Words
+        like K:D match a field, with the spelling of TuneBook.normalize()
+        and wildcards; other words match the title. '''
+        try:
+            words = shlex.split(query)
+        except ValueError:  # Unbalanced quotes
+            words = query.split()
+        tests = []
+        for word in words:
+            key, sep, value = word.partition(':')
+            key = key.upper() + ':'
+            if not sep or key not in self.FIELDS:
+                key, value = 'T:', '*' + word + '*'
+            pattern = TuneBook.normalize(key, value)
+            if key == 'T:' and not set(pattern) & set('*?['):
+                pattern = '*' + pattern + '*'
+            tests.append((self.FIELDS.index(key), key, pattern))
+        matches = {}  # By test and value, as values repeat in many tunes
+
+        def match(test, value):
+            if (test, value) not in matches:
+                n, key, pattern = test
+                matches[test, value] = fnmatch.fnmatchcase(
+                    TuneBook.normalize(key, value), pattern)
+            return(matches[test, value])
+        return([pos for pos, fields in enumerate(self.index[2])
+                if all(match(test, fields[test[0]]) for test in tests)])
+
+
+class TuneServer():
+    ''' Answers HTTP requests about a Catalogue '''
+
+    WORKERS = 2  # Renders at once
+    LIMIT = 100  # Tunes listed by default
+    MAXLIMIT = 1000
+    TYPES = {'json': 'application/json', 'abc': 'text/vnd.abc; charset=utf-8',
+             'svg': 'image/svg+xml', 'mid': 'audio/midi',
+             'text': 'text/plain; charset=utf-8'}
+    REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found',
+               405: 'Method Not Allowed', 422: 'Unprocessable Entity',
+               500: 'Internal Server Error'}
+    TUNE = re.compile(r'^/tunes/(\d+)(?:\.(svg|mid))?$')
+
+    def __init__(self, catalogue, workers=WORKERS, cache=None):
+        self.catalogue = catalogue
+        self.render = RenderService()
+        self.cache = RenderCache() if cache is None else cache
+        self.executor = concurrent.futures.ThreadPoolExecutor(workers)
+        self.running = {}  # Renders being made, by key
+        self.jobs = set()  # Of the executor, cancelled by close()
+        self.folder = tempfile.mkdtemp(prefix='qabc')  # Of MIDI files
+
+    async def call(self, function, *args):
+        job = self.executor.submit(function, *args)
+        self.jobs.add(job)
+        job.add_done_callback(self.jobs.discard)
+        return(await asyncio.wrap_future(job))
+
+    async def rendered(self, key, function):
+        ''' Result of a render from the cache, or from the render being
+        made for other request, or made now '''
+        result = self.cache.get(key)
+        if result is not None:
+            return(result)
+        if key not in self.running:
+            self.running[key] = asyncio.ensure_future(self.call(function))
+            self.running[key].add_done_callback(
+                lambda future: self.running.pop(key, None))
+        result = await asyncio.shield(self.running[key])
+        if result[0]:
+            self.cache.put(key, result, len(result[0]) + len(result[1]))
+        return(result)
+
+    def svg(self, text):
+        return(self.render.svg(text))
+
+    def midi(self, text, tempo, semitones):
+        ''' MIDI bytes and messages. The file is removed, as the bytes
+        are kept by the cache. '''
+        path, messages = self.render.midiFile(text, self.folder, tempo,
+                                              semitones)
+        if path is None:
+            return(b'', messages)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.remove(path)
+        except OSError:
+            data = b''
+        return(data, messages)
+
+    async def respond(self, method, target):
+        ''' Status, content type and body of the answer to a request '''
+        if method not in ('GET', 'HEAD'):
+            return(405, 'text', _("Only GET is served") + "\n")
+        query = {}
+
+        def number(name, default, low, high):
+            value = int(query.get(name, [default])[0])
+            if not low <= value <= high:
+                raise ValueError(name)
+            return(value)
+
+        catalogue = self.catalogue
+        try:
+            url = urllib.parse.urlsplit(target)
+            query = urllib.parse.parse_qs(url.query)
+            await self.call(catalogue.refresh)
+            if url.path == '/':
+                return(200, 'json', {
+                    'tunebook': os.path.basename(catalogue.book.path),
+                    'tunes': len(catalogue)})
+            if url.path == '/timings':
+                return(200, 'json', {'timings': [
+                    dict(zip(('engine', 'task', 'calls', 'failures', 'mean',
+                              'slowest'), timing))
+                    for timing in self.render.report()]})
+            if url.path == '/tunes':
+                offset = number('offset', 0, 0, sys.maxsize)
+                limit = number('limit', self.LIMIT, 0, self.MAXLIMIT)
+                found = await self.call(catalogue.find,
+                                        query.get('q', [''])[0])
+                return(200, 'json', {
+                    'total': len(found),
+                    'tunes': [catalogue.headers(pos)
+                              for pos in found[offset:offset + limit]]})
+            m = self.TUNE.match(url.path)
+            if not m or int(m.group(1)) >= len(catalogue):
+                return(404, 'text', _("Not found") + "\n")
+            text = await self.call(catalogue.text, int(m.group(1)))
+            kind = m.group(2)
+            if kind is None:
+                return(200, 'abc', text)
+            if kind == 'svg':
+                key = RenderCache.key('svg', text)
+                result = await self.rendered(key, lambda: self.svg(text))
+            else:
+                tempo = number('tempo', 0, 0, 1000) or None
+                semitones = number('transpose', 0, -24, 24)
+                key = RenderCache.key('midi', text, tempo, semitones)
+                result = await self.rendered(
+                    key, lambda: self.midi(text, tempo, semitones))
+        except UnicodeError as e:  # A ValueError, but not of the request
+            return(500, 'text', _("I can't read the tune: ") + str(e) + "\n")
+        except ValueError as e:
+            return(400, 'text', _("Wrong parameter: ") + str(e) + "\n")
+        except OSError as e:
+            return(500, 'text', _("I can't render the tune: ") + str(e)
+                   + "\n")
+        except Exception as e:  # Kept from the connection
+            return(500, 'text', _("Internal error: ") + str(e) + "\n")
+        data, messages = result
+        if not data:
+            return(422, 'text', messages)
+        return(200, kind, data)
+
+    async def handle(self, reader, writer):
+        ''' Answers the requests of a connection, kept open if the client
+        asks for it '''
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                headers = {}
+                while True:
+                    header = await reader.readline()
+                    if header in (b'\r\n', b'\n', b''):
+                        break
+                    name, sep, value = header.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip().lower()
+                try:
+                    method, target, version = line.decode('latin-1').split()
+                except ValueError:
+                    method, target, version = None, '/', 'HTTP/1.0'
+                    status, kind, body = 400, 'text', _("Bad request") + "\n"
+                else:
+                    status, kind, body = await self.respond(method, target)
+                if isinstance(body, dict):
+                    body = json.dumps(body, ensure_ascii=False)
+                if isinstance(body, str):
+                    body = body.encode()
+                keep = method is not None and (
+                    headers.get('connection') == 'keep-alive'
+                    if version == 'HTTP/1.0'
+                    else headers.get('connection') != 'close')
+                writer.write((
+                    "HTTP/1.1 %d %s\r\nContent-Type: %s\r\n"
+                    "Content-Length: %d\r\nConnection: %s\r\n\r\n"
+                    % (status, self.REASONS[status], self.TYPES[kind],
+                       len(body), 'keep-alive' if keep else 'close')
+                ).encode())
+                if method != 'HEAD':
+                    writer.write(body)
+                await writer.drain()
+                if not keep:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.handle, host, port)
+        print(_("Serving") + " " + self.catalogue.book.path + " "
+              + _("at") + " http://%s:%d/" % (host, port), flush=True)
+        async with server:
+            await server.serve_forever()
+
+    def close(self):
+        for job in list(self.jobs):
+            job.cancel()  # Only running jobs are waited for
+        self.executor.shutdown(wait=True)
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+
+def main(args):
+    ''' Runs "qabc serve" with the arguments after serve '''
+    parser = argparse.ArgumentParser(
+        prog='qabc serve',
+        description=_("Serves the tunes of a tunebook over HTTP"))
+    parser.add_argument('tunebook')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--workers', type=int, default=TuneServer.WORKERS,
+                        help=_("renders made at once"))
+    parser.add_argument('--cache', type=int, default=64,
+                        help=_("megabytes of renders kept"))
+    options = parser.parse_args(args)
+    RenderService.loadPlugins()
+    if not os.path.isfile(options.tunebook):
+        parser.error(_("No such file: ") + options.tunebook)
+    server = TuneServer(Catalogue(options.tunebook), max(options.workers, 1),
+                        RenderCache(options.cache * 1024 * 1024))
+    # Stopped by a service manager like by Ctrl+C
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        asyncio.run(server.serve(options.host, options.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for number in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(number, signal.SIG_IGN)  # While cleaning up
+        server.close()
+    return(0)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,55 @@
+''' Checks of AbcLinter with wrong abc code '''
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, 'src'))
+
+from qabccore import AbcLinter, lintSummary  # noqa: E402
+
+HEADER = "X:1\nT:Test\nM:3/4\nL:1/8\nK:D\n"
+
+
+class ZeroDenominatorTest(unittest.TestCase):
+    ''' A zero denominator is a problem of the tune, not a crash '''
+
+    def messages(self, text):
+        return([message for line, severity, message
+                in AbcLinter().lint(text)])
+
+    def assertReported(self, text, message):
+        self.assertTrue(any(m.startswith(message)
+                            for m in self.messages(text)),
+                        self.messages(text))
+
+    def test_meter(self):
+        self.assertReported("X:1\nT:Test\nM:3/0\nK:D\nabc|\n", "Wrong meter")
+
+    def test_inline_meter(self):
+        self.assertReported(HEADER + "abc [M:3/0] def|\n", "Wrong meter")
+
+    def test_tuplet(self):
+        self.assertReported(HEADER + "(0abc def|\n", "Wrong tuplet")
+
+    def test_tuplet_ratio(self):
+        self.assertReported(HEADER + "(3:0abc def|\n", "Wrong tuplet")
+
+    def test_note(self):
+        self.assertReported(HEADER + "a/0 bc def|\n", "Wrong length")
+
+    def test_chord(self):
+        self.assertReported(HEADER + "[ab]/0 cd ef|\n", "Wrong length")
+
+    def test_line(self):
+        body = (True,) + AbcLinter.START[1:]
+        problems, context = AbcLinter().lintLine("(0a/0[ab]/0|", body)
+        self.assertEqual(len(problems), 3)
+
+    def test_summary(self):
+        errors, warnings = lintSummary(HEADER + "(0a/0 [ab]/0 c|\n")
+        self.assertEqual(errors, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
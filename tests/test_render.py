@@ -0,0 +1,103 @@
+''' Checks of RenderService with stub engines '''
+
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, 'src'))
+
+from qabccore import RenderBackend, RenderService  # noqa: E402
+
+
+class Broken(RenderBackend):
+    name = 'broken'
+    tasks = ('svg', 'midi')
+    priority = 2
+
+    def svg(self, text):
+        raise OSError("no engine")
+
+    def midi(self, text, outfile, tempo=None):
+        return("nothing written")
+
+
+class Empty(RenderBackend):
+    name = 'empty'
+    tasks = ('svg',)
+    priority = 1
+
+    def svg(self, text):
+        return(b'', "empty score")
+
+
+class Working(RenderBackend):
+    name = 'working'
+    tasks = ('svg', 'midi')
+
+    def svg(self, text):
+        return(b'<svg/>', "")
+
+    def midi(self, text, outfile, tempo=None):
+        with open(outfile, "wb") as f:
+            f.write(b'MThd')
+        return("")
+
+
+class FallbackTest(unittest.TestCase):
+
+    def test_svg(self):
+        render = RenderService([Working, Empty, Broken])
+        self.assertEqual([b.name for b in render.engines('svg')],
+                         ['broken', 'empty', 'working'])
+        self.assertEqual(render.svg("X:1\nK:D\nabc|"), (b'<svg/>', ""))
+        report = render.report()
+        self.assertEqual([timing[:4] for timing in report],
+                         [('broken', 'svg', 1, 1), ('empty', 'svg', 1, 1),
+                          ('working', 'svg', 1, 0)])
+        for name, task, calls, failures, mean, slowest in report:
+            self.assertGreaterEqual(slowest, mean)
+            self.assertGreaterEqual(mean, 0)
+
+    def test_failing_go_last(self):
+        render = RenderService([Working, Empty, Broken])
+        for n in range(RenderService.FAILING):
+            render.svg("X:1\nK:D\nabc|")
+        self.assertEqual([b.name for b in render.engines('svg')],
+                         ['working', 'broken', 'empty'])
+        render.svg("X:1\nK:D\nabc|")
+        self.assertEqual([timing[2:4] for timing in render.report()],
+                         [(3, 3), (3, 3), (4, 0)])
+
+    def test_midi(self):
+        render = RenderService([Working, Broken])
+        with tempfile.TemporaryDirectory() as folder:
+            path, messages = render.midiFile("X:1\nK:D\nabc|", folder)
+            with open(path, "rb") as f:
+                self.assertEqual(f.read(), b'MThd')
+        self.assertEqual([timing[:4] for timing in render.report()],
+                         [('broken', 'midi', 1, 1),
+                          ('working', 'midi', 1, 0)])
+
+    def test_all_failing(self):
+        render = RenderService([Empty, Broken])
+        self.assertEqual(render.svg("X:1\nK:D\nabc|"), (b'', "empty score"))
+        render = RenderService([Broken])
+        with self.assertRaises(OSError):
+            render.svg("X:1\nK:D\nabc|")
+        with tempfile.TemporaryDirectory() as folder:
+            self.assertEqual(render.midiFile("X:1\nK:D\nabc|", folder),
+                             (None, "nothing written"))
+
+    def test_register(self):
+        backends = list(RenderService.BACKENDS)
+        try:
+            self.assertIs(RenderService.register(Working), Working)
+            RenderService.register(Working)
+            self.assertEqual(RenderService.BACKENDS, backends + [Working])
+        finally:
+            RenderService.BACKENDS[:] = backends
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+''' Checks of the Catalogue and the answers of TuneServer, without
+opening a socket '''
+
+import asyncio
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, 'src'))
+
+from qabcserve import Catalogue, TuneServer  # noqa: E402
+
+TEXT = ("% Notes before the first tune\n"
+        "\n"
+        "X:1\nT:The Kid on the Mountain\nR:slip jig\nM:9/8\nK:Em\nEFG|\n"
+        "\n"
+        "X:2\nT:Drowsy Maggie\nR:Reel\nM:4/4\nK:E dorian\nE2BE|\n"
+        "\n"
+        "X:3\nT:The Kesh\nR:jig\nM:6/8\nK:G major\nGAG|\n")
+
+
+class ServeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.folder.name, 'book.abc')
+        with open(self.path, "w") as f:
+            f.write(TEXT)
+        self.catalogue = Catalogue(self.path)
+        self.server = TuneServer(self.catalogue)
+
+    def tearDown(self):
+        self.server.close()
+        self.folder.cleanup()
+
+    def get(self, target):
+        return(asyncio.run(self.server.respond('GET', target)))
+
+    def test_find(self):
+        find = self.catalogue.find
+        self.assertEqual(len(self.catalogue), 4)  # With the notes
+        self.assertEqual(find('K:Edor'), [2])
+        self.assertEqual(find('k:"E Dorian"'), [2])
+        self.assertEqual(find('K:G'), [3])
+        self.assertEqual(find('R:*jig'), [1, 3])
+        self.assertEqual(find('R:jig the'), [3])
+        self.assertEqual(find('maggie'), [2])
+        self.assertEqual(find('M:4/4 R:jig'), [])
+
+    def test_tunes(self):
+        status, kind, body = self.get('/tunes?q=R:reel')
+        self.assertEqual((status, kind, body['total']), (200, 'json', 1))
+        self.assertEqual(body['tunes'][0]['T'], "Drowsy Maggie")
+        status, kind, body = self.get('/tunes?q=R:*jig&offset=1&limit=5')
+        self.assertEqual(body['total'], 2)
+        self.assertEqual([t['index'] for t in body['tunes']], [3])
+
+    def test_tune(self):
+        self.assertEqual(self.get('/tunes/3'),
+                         (200, 'abc', "X:3\nT:The Kesh\nR:jig\nM:6/8\n"
+                                      "K:G major\nGAG|"))
+
+    def test_not_found(self):
+        for target in ('/tunes/4', '/tunes/4.svg', '/tunes/x', '/other'):
+            self.assertEqual(self.get(target)[0], 404, target)
+
+    def test_bad_request(self):
+        self.assertEqual(self.get('/tunes?limit=x')[0], 400)
+        self.assertEqual(self.get('/tunes/1.mid?transpose=99')[0], 400)
+        self.assertEqual(asyncio.run(self.server.respond('POST', '/'))[0],
+                         405)
+
+    def test_internal_error(self):
+        def fail(pos):
+            raise KeyError(pos)
+        self.catalogue.text = fail
+        status, kind, body = self.get('/tunes/1')
+        self.assertEqual(status, 500)
+        self.assertIn("Internal error", body)
+
+    def test_unreadable(self):
+        def fail(pos):
+            raise UnicodeDecodeError('utf-8', b'\xff', 0, 1, 'bad')
+        self.catalogue.text = fail
+        self.assertEqual(self.get('/tunes/1')[0], 500)
+
+    def test_failed_refresh(self):
+        def fail():
+            raise RuntimeError("broken")
+        self.catalogue.refresh = fail
+        self.assertEqual(self.get('/'), (500, 'text',
+                                         "Internal error: broken\n"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+''' Checks of TuneStatistics '''
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, 'src'))
+
+from qabccore import AbcLinter, TuneStatistics, TuneStore  # noqa: E402
+
+try:
+    import numpy  # noqa: F401
+except ImportError:
+    numpy = None
+
+
+def highlighterBars(text):
+    ''' Bar lines counted like AbcHighlighter does, line by line '''
+    bars = 0
+    context = AbcLinter.START
+    linter = AbcLinter()
+    for line in text.split('\n'):
+        body = context[0]
+        problems, context = linter.lintLine(line, context)
+        if not body or line.startswith('%') or AbcLinter.FIELD.match(line):
+            continue
+        for m in AbcLinter.TOKENS.finditer(line):
+            bar = m.group(0)
+            if m.lastgroup == 'bar' and m.start() > 0 \
+                    and not (bar[0] == '[' and bar[1:2].isdigit()):
+                bars += 1
+    return(bars)
+
+
+@unittest.skipIf(numpy is None, "NumPy is not installed")
+class CountBarsTest(unittest.TestCase):
+    ''' Bars of the statistics are those of the status bar '''
+
+    TUNES = [
+        'X:1\nT:Two bars\nM:C|\nL:1/8\nK:D\n"A|B"abcd efga|gfed cBAG|]\n'
+        'w:la | la | la\n%|||\n',
+        'X:2\nT:Repeats\nK:D\n|:abc::def:|\n::abc|]\n',
+        'X:3\nT:Endings\nK:D\nab %c"|\nab"|"|c|\n[|ab|[1c:|2d|]\n',
+        'X:4\nT:Fields\nK:D\nabc|def|\nP:A|B\nW:x|y\n+:z|\nab!x!|c|',
+        'X:5\nT:No body|\nK:D',
+        'T:No key|\nabc|def|']
+
+    def check(self, tunes, refs):
+        self.assertEqual(
+            list(TuneStatistics.countBars(tunes, refs)),
+            [highlighterBars(tunes.text(ref)) for ref in refs])
+
+    def test_review_tune(self):
+        tunes = TuneStore(self.TUNES[:1])
+        self.assertEqual(list(TuneStatistics.countBars(tunes, tunes.refs)),
+                         [2])
+
+    def test_one_buffer(self):
+        tunes = TuneStore(self.TUNES)
+        self.check(tunes, tunes.refs)
+        self.check(tunes, list(reversed(tunes.refs)))
+
+    def test_buffer_by_tune(self):
+        tunes = TuneStore()
+        for text in self.TUNES:
+            tunes.refs.append(tunes.add([text]))
+        self.check(tunes, tunes.refs)
+
+
+if __name__ == '__main__':
+    unittest.main()
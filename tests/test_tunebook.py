@@ -0,0 +1,302 @@
+''' Checks of TuneStore and TuneBook '''
+
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, 'src'))
+
+from qabccore import TuneBook, TuneStore  # noqa: E402
+
+try:
+    import qabc
+except ImportError:  # Without PyQt5
+    qabc = None
+
+
+def tune(number, title, key='D', x=None):
+    return("X:%s\nT:%s\nM:4/4\nL:1/8\nK:%s\nabcd efga|\n"
+           % (number if x is None else x, title, key))
+
+
+class NumberTest(unittest.TestCase):
+    ''' X: numbers, which may be followed by a comment '''
+
+    def test_parse(self):
+        self.assertEqual(TuneStore.parseNumber(b'2'), 2)
+        self.assertEqual(TuneStore.parseNumber(b' 2 % comment'), 2)
+        self.assertEqual(TuneStore.parseNumber(b'2%comment\r\n'), 2)
+        self.assertIsNone(TuneStore.parseNumber(b''))
+        self.assertIsNone(TuneStore.parseNumber(b'two'))
+
+    def test_number(self):
+        tunes = TuneStore([tune(1, 'A'), tune(0, 'B', x='2 % second'),
+                           "T:No number\nK:D\nabc|\n"])
+        self.assertEqual([tunes.number(ref) for ref in tunes.refs],
+                         [1, 2, None])
+
+    def test_merge_keeps_number(self):
+        book = TuneBook()
+        book.tunes = TuneStore([tune(1, 'A')])
+        book.merge(TuneStore([tune(0, 'B', x='2 % second')]), [0])
+        self.assertEqual(book.tunes[1], tune(0, 'B', x='2 % second'))
+
+    def test_merge_keeps_comment(self):
+        book = TuneBook()
+        book.tunes = TuneStore([tune(2, 'A')])
+        book.merge(TuneStore([tune(0, 'B', x='2 % second')]), [0])
+        self.assertEqual(book.tunes[1], tune(0, 'B', x='3 % second'))
+
+    def test_append_to(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'book.abc')
+            with open(path, "w") as f:
+                f.write(tune(0, 'A', x='1 % first'))
+            TuneBook.appendTo(path, TuneStore([tune(1, 'B'), tune(3, 'C')]),
+                              [0, 1])
+            with open(path) as f:
+                text = f.read()
+        self.assertIn(tune(2, 'B'), text)
+        self.assertIn(tune(3, 'C'), text)
+
+
+class HistoryTest(unittest.TestCase):
+    ''' Undo and redo of the tunebook operations '''
+
+    def setUp(self):
+        self.book = TuneBook()
+        self.book.tunes = TuneStore([tune(3, 'C'), tune(1, 'A'),
+                                     tune(2, 'B')])
+        self.book.ntunes = len(self.book.tunes)
+        self.book.backup = self.book.tunes.copy()
+
+    def roundTrip(self, operation):
+        before = self.book.tunes[:]
+        operation()
+        after = self.book.tunes[:]
+        self.assertNotEqual(after, before)
+        self.book.undo()
+        self.assertEqual(self.book.tunes[:], before)
+        self.assertEqual(self.book.ntunes, len(before))
+        self.book.redo()
+        self.assertEqual(self.book.tunes[:], after)
+        self.assertEqual(self.book.ntunes, len(after))
+        self.book.undo()
+        self.assertEqual(self.book.tunes[:], before)
+
+    def test_sort(self):
+        self.roundTrip(self.book.sort)
+
+    def test_reindex(self):
+        self.roundTrip(self.book.reindex)
+
+    def test_remove(self):
+        self.roundTrip(lambda: self.book.remove(1))
+
+    def test_insert(self):
+        self.roundTrip(lambda: self.book.insert(1, tune(4, 'D')))
+
+    def test_restore(self):
+        self.book.setTune(0, tune(3, 'Changed'))
+        self.book.clearHistory()
+        self.roundTrip(self.book.restore)
+
+    def test_sequence(self):
+        before = self.book.tunes[:]
+        self.book.sort()
+        self.book.reindex()
+        self.book.remove(0)
+        self.book.insert(0, tune(4, 'D'))
+        after = self.book.tunes[:]
+        for n in range(4):
+            self.book.undo()
+        self.assertEqual(self.book.tunes[:], before)
+        for n in range(4):
+            self.book.redo()
+        self.assertEqual(self.book.tunes[:], after)
+
+    def test_shared_buffers(self):
+        tunes = self.book.tunes
+        buffers = list(tunes.buffers)
+        self.book.sort()
+        self.book.removeRows([0, 2])
+        self.book.undo()
+        self.book.undo()
+        self.book.redo()
+        self.book.redo()
+        self.assertIs(self.book.tunes, tunes)
+        self.assertEqual(len(tunes.buffers), len(buffers))  # No text added
+        self.assertTrue(all(a is b for a, b in zip(tunes.buffers, buffers)))
+
+    def test_shared_copies(self):
+        snapshot = self.book.snapshot()
+        self.book.setTune(1, tune(1, 'Changed'))
+        self.book.restore()
+        self.assertIs(self.book.tunes.slices, snapshot.slices)
+        self.assertIs(self.book.tunes.buffers, snapshot.buffers)
+        self.assertIs(self.book.backup.slices, snapshot.slices)
+        self.assertEqual(snapshot[1], tune(1, 'A'))  # Not changed
+        self.book.undo()
+        self.assertEqual(self.book.tunes[1], tune(1, 'Changed'))
+        self.assertIs(self.book.tunes.slices, snapshot.slices)
+
+
+class ReorderTest(unittest.TestCase):
+    ''' Reordered tunes keep their slices and get their order and numbers
+    back when undone '''
+
+    def setUp(self):
+        self.book = TuneBook()
+        self.book.tunes = TuneStore([tune(1, 'C'), tune(2, 'A'),
+                                     tune(3, 'D'), tune(4, 'B')])
+        self.book.ntunes = len(self.book.tunes)
+
+    def state(self):
+        return([TuneBook.headers(t, ('X:', 'T:')) for t in self.book.tunes])
+
+    def test_permute(self):
+        tunes = TuneStore(['a', 'b', 'c', 'd'])
+        refs = tunes.refs
+        order = [2, 0, 3, 1]
+        tunes.permute(order)
+        self.assertEqual(list(tunes), ['c', 'a', 'd', 'b'])
+        tunes.unpermute(order)
+        self.assertEqual(list(tunes), ['a', 'b', 'c', 'd'])
+        self.assertEqual(tunes.refs, refs)
+
+    def test_sort_and_reindex(self):
+        self.book.sort()
+        self.book.reindex()
+        self.assertEqual(self.state(),
+                         [('1', 'A'), ('2', 'B'), ('3', 'C'), ('4', 'D')])
+        self.book.undo()
+        self.assertEqual(self.state(),
+                         [('2', 'A'), ('4', 'B'), ('1', 'C'), ('3', 'D')])
+        self.book.undo()
+        self.assertEqual(self.state(),
+                         [('1', 'C'), ('2', 'A'), ('3', 'D'), ('4', 'B')])
+        self.book.redo()
+        self.book.redo()
+        self.assertEqual(self.state(),
+                         [('1', 'A'), ('2', 'B'), ('3', 'C'), ('4', 'D')])
+
+    def test_edit_after_sort(self):
+        self.book.sort()
+        self.book.setTune(0, tune(7, 'A'))
+        self.book.undo()
+        self.book.undo()
+        self.assertEqual(self.state(),
+                         [('1', 'C'), ('2', 'A'), ('3', 'D'), ('4', 'B')])
+
+
+class RereadTest(unittest.TestCase):
+    ''' Changes made to the tunebook file by other programs '''
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.folder.name, 'book.abc')
+        self.write('ABCDE')
+        self.book = TuneBook()
+        self.book.loadFile(self.path)
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def texts(self, titles):
+        return([tune(ord(title), title).rstrip('\n') for title in titles])
+
+    def write(self, titles):
+        with open(self.path, "w") as f:
+            f.write('\n\n'.join(self.texts(titles)) + '\n')
+
+    def test_splices(self):
+        refs = self.book.tunes.refs[:]
+        self.write('AbCEF')  # B changed, D removed and F added
+        splices = self.book.reread()
+        texts = self.texts('AbCEF')
+        self.assertEqual(splices, [(5, 5, texts[4:5]), (3, 4, []),
+                                   (1, 2, texts[1:2])])
+        self.assertEqual(self.book.tunes[:], texts)
+        self.assertEqual(self.book.ntunes, 5)
+        self.assertFalse(self.book.isModified())
+        # Untouched tunes keep their slices
+        self.assertEqual([self.book.tunes.refs[n] for n in (0, 2, 3)],
+                         [refs[n] for n in (0, 2, 4)])
+
+    def test_unchanged(self):
+        self.assertEqual(self.book.reread(), [])
+        self.assertEqual(self.book.tunes[:], self.texts('ABCDE'))
+
+    @unittest.skipUnless(qabc, "PyQt5 is needed")
+    def test_table(self):
+        model = qabc.TuneTableModel()
+        model.appendHeaders([TuneBook.headers(t) for t in self.book.tunes])
+        self.write('xABDEF')
+        for start, end, tunes in self.book.reread():
+            model.spliceHeaders(start, end,
+                                [TuneBook.headers(t) for t in tunes])
+        headers = [TuneBook.headers(t) for t in self.book.tunes]
+        self.assertEqual(list(zip(*(c[:] for c in model.columns))),
+                         headers)
+        self.assertEqual(model.rowCount(), len(headers))
+        for col, index in model.valueRows.items():
+            for value, rows in index.items():
+                self.assertEqual(list(rows),
+                                 [n for n, h in enumerate(headers)
+                                  if model.normalize(col, h[col - 1])
+                                  == value])
+
+
+class RewriteTest(unittest.TestCase):
+    ''' Header fields changed in many tunes at once '''
+
+    TEXT = ("X:1\nT:A\nR:Reel\nZ:someone\nK:D\n"
+            "R:not a header\nabcd efga|\n"
+            "\n"
+            "X:2\nT:B\nK:G\n"
+            "Z:not a header\ngabc defg|\n"
+            "\n"
+            "X:3 % kept\nT:C\nR:reel\nK:A\n"
+            "ABcd efga|\n")
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.folder.name, 'book.abc')
+        with open(self.path, "w") as f:
+            f.write(self.TEXT)
+        self.book = TuneBook()
+        self.book.loadFile(self.path)
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_rules(self):
+        rules = [('set', 'R:', 'jig'), ('delete', 'Z:'),
+                 ('replace', 'T:', '^(.*)$', r'The \1')]
+        changes = list(self.book.rewrite(rules, rows=[0, 1]))
+        self.assertEqual([row for row, old, new in changes], [0, 1])
+        self.book.applyChanges(changes)
+        self.book.write()
+        with open(self.path, "rb") as f:
+            data = f.read()
+        self.assertEqual(data,
+                         b"X:1\nT:The A\nR:jig\nK:D\n"
+                         b"R:not a header\nabcd efga|\n"
+                         b"X:2\nT:The B\nR:jig\nK:G\n"
+                         b"Z:not a header\ngabc defg|\n"
+                         b"X:3 % kept\nT:C\nR:reel\nK:A\n"
+                         b"ABcd efga|\n")
+        self.book.undo()
+        self.assertEqual(self.book.tunes[:],
+                         list(TuneBook.split(self.TEXT.split('\n'))))
+
+    def test_unchanged(self):
+        rules = [('set', 'R:', 'reel'), ('delete', 'Z:')]
+        self.assertEqual([row for row, old, new in self.book.rewrite(rules)],
+                         [0, 1])
+        self.assertEqual(list(self.book.rewrite([('delete', 'S:')])), [])
+
+
+if __name__ == '__main__':
+    unittest.main()